@@ -23,6 +23,54 @@ function themetest_user_scripts() {
 
 add_action( 'wp_enqueue_scripts', 'themetest_user_scripts' );
 
+/* The leaderboard `themetest.py rank` saves, decoded once per request and
+   kept in the object cache until the file changes */
+function themetest_leaderboard() {
+  static $leaderboard = null;
+  if ($leaderboard !== null) {
+    return $leaderboard;
+  }
+  $leaderboard = array('total' => 0, 'metrics' => array(), 'order' => array(), 'themes' => array());
+  $filename = defined('THEMETEST_LEADERBOARD') ? THEMETEST_LEADERBOARD : ABSPATH . 'theme-images/leaderboard.json';
+  if (!is_readable($filename)) {
+    return $leaderboard;
+  }
+  $mtime = filemtime($filename);
+  $cached = wp_cache_get('leaderboard', 'themetest');
+  if (is_array($cached) && $cached['mtime'] === $mtime) {
+    $leaderboard = $cached['leaderboard'];
+    return $leaderboard;
+  }
+  $data = json_decode(file_get_contents($filename), true);
+  if (is_array($data)) {
+    $leaderboard = $data;
+    wp_cache_set('leaderboard', array('mtime' => $mtime, 'leaderboard' => $data), 'themetest');
+  }
+  return $leaderboard;
+}
+
+/* A theme's leaderboard entry with its percentiles and deltas keyed by
+   metric, or null if it hasn't been ranked */
+function themetest_leaderboard_entry($slug) {
+  $leaderboard = themetest_leaderboard();
+  if (empty($leaderboard['themes'][$slug])) {
+    return null;
+  }
+  $entry = $leaderboard['themes'][$slug];
+  $entry['total'] = $leaderboard['total'];
+  $entry['percentiles'] = array_combine($leaderboard['metrics'], $entry['percentiles']);
+  $entry['deltas'] = isset($entry['deltas']) ? array_combine($leaderboard['metrics'], $entry['deltas']) : array();
+  return $entry;
+}
+
+/* "+120 ms" style change in a metric since the previous version */
+function themetest_change($entry, $metric, $unit) {
+  if (!$entry || !isset($entry['deltas'][$metric])) {
+    return '-';
+  }
+  return trim(sprintf('%+d %s', $entry['deltas'][$metric], $unit));
+}
+
 function themetest_results_full(){
   $theme_name = get_field('theme_name', $post_id);
   $theme_version = get_field('theme_version', $post_id);
@@ -49,6 +97,19 @@ function themetest_results_full(){
   $gt_connect_duration = get_field('gt_connect_duration', $post_id);
   $gt_redirect_duration = get_field('gt_redirect_duration', $post_id);
 
+  $rank = themetest_leaderboard_entry($theme_slug);
+  // The leaderboard only ranks a theme's latest run, which says nothing about
+  // a report for another version
+  if ($rank && (string) $rank['version'] !== (string) $theme_version) {
+    $rank = null;
+  }
+  $theme_rank = $rank ? "#{$rank['rank']} of {$rank['total']}" : '-';
+  $theme_score = ($rank && $rank['score'] !== null) ? $rank['score'] : '-';
+  $previous_version = ($rank && isset($rank['previous_version'])) ? $rank['previous_version'] : '-';
+  $load_time_change = themetest_change($rank, 'fully_loaded_time', 'ms');
+  $page_bytes_change = themetest_change($rank, 'page_bytes', 'B');
+  $pagespeed_change = themetest_change($rank, 'pagespeed_score', '');
+
   $res = <<<EOD
   <div class="container-fluid">
 
@@ -106,6 +167,14 @@ function themetest_results_full(){
         <div class="col-sm-12 col-xs-6 big_number_label">YSlow:</div>
         <div class="col-sm-12 col-xs-6 big_number">$gt_yslow_score</div>
       </div>
+      <div class="row no-gutter">
+        <div class="col-sm-12 col-xs-6 big_number_label">Rank:</div>
+        <div class="col-sm-12 col-xs-6 big_number">$theme_rank</div>
+      </div>
+      <div class="row no-gutter">
+        <div class="col-sm-12 col-xs-6 big_number_label">Score:</div>
+        <div class="col-sm-12 col-xs-6 big_number">$theme_score</div>
+      </div>
     </div>
     <div class="col-sm-4 col-xs-12 no-gutter">
       <div class="col-xs-6 themepage-label">Elements:</div>
@@ -126,6 +195,14 @@ function themetest_results_full(){
       <div class="col-xs-6 themepage-data">$gt_connect_duration ms</div>
       <div class="col-xs-6 themepage-label">Redirects:</div>
       <div class="col-xs-6 themepage-data">$gt_redirect_duration ms</div>
+      <div class="col-xs-6 themepage-label">Since:</div>
+      <div class="col-xs-6 themepage-data">$previous_version</div>
+      <div class="col-xs-6 themepage-label">Load Time:</div>
+      <div class="col-xs-6 themepage-data">$load_time_change</div>
+      <div class="col-xs-6 themepage-label">Page Bytes:</div>
+      <div class="col-xs-6 themepage-data">$page_bytes_change</div>
+      <div class="col-xs-6 themepage-label">PageSpeed:</div>
+      <div class="col-xs-6 themepage-data">$pagespeed_change</div>
     </div>
   
   </div>
@@ -137,33 +214,126 @@ EOD;
   return $res;
 }
 
+/* Fields the rundown shows for each theme */
+function themetest_rundown_fields() {
+  return array(
+    'theme_name', 'theme_slug', 'theme_author', 'theme_version', 'theme_rating',
+    'theme_last_updated', 'theme_downloaded', 'gt_page_elements', 'gt_page_bytes',
+    'gt_page_load_time', 'gt_html_bytes', 'gt_first_contentful_paint_time',
+    'gt_dom_interactive_time', 'gt_pagespeed_score', 'gt_yslow_score',
+  );
+}
+
+/* Whether the current visitor may see a report post's data: published
+   reports are public, anything else needs the right to read the post */
+function themetest_can_read_report($post) {
+  if (!$post || $post->post_type !== 'post') {
+    return false;
+  }
+  if ($post->post_status === 'publish' && !post_password_required($post)) {
+    return true;
+  }
+  return current_user_can('read_post', $post->ID);
+}
+
+/* Rundown data for a list of report posts, loaded with one query for the
+   posts, one for all of their meta and the same again for the thumbnails.
+   Posts the visitor can't read are left out */
+function themetest_rundown_data($post_ids) {
+  $post_ids = array_values(array_filter(array_map('intval', $post_ids)));
+  if (empty($post_ids)) {
+    return array();
+  }
+  _prime_post_caches($post_ids, false, true);
+
+  $thumbnail_ids = array();
+  foreach ($post_ids as $post_id) {
+    $thumbnail_id = (int) get_post_meta($post_id, '_thumbnail_id', true);
+    if ($thumbnail_id) {
+      $thumbnail_ids[] = $thumbnail_id;
+    }
+  }
+  if (!empty($thumbnail_ids)) {
+    _prime_post_caches($thumbnail_ids, false, true);
+  }
+
+  $rows = array();
+  foreach ($post_ids as $post_id) {
+    if (!themetest_can_read_report(get_post($post_id))) {
+      continue;
+    }
+    $row = array(
+      'id' => $post_id,
+      'permalink' => get_permalink($post_id),
+      'featured_image' => get_the_post_thumbnail_url($post_id),
+    );
+    foreach (themetest_rundown_fields() as $field) {
+      $row[$field] = get_post_meta($post_id, $field, true);
+    }
+    $rows[] = $row;
+  }
+  return $rows;
+}
+
+/* Leaderboard order, themes that haven't been ranked last */
+function themetest_compare_rank($a, $b) {
+  $a_rank = $a['leaderboard'] ? $a['leaderboard']['rank'] : PHP_INT_MAX;
+  $b_rank = $b['leaderboard'] ? $b['leaderboard']['rank'] : PHP_INT_MAX;
+  if ($a_rank == $b_rank) {
+    return 0;
+  }
+  return ($a_rank < $b_rank) ? -1 : 1;
+}
+
+function themetest_rest_rundown($request) {
+  return rest_ensure_response(themetest_rundown_data(wp_parse_id_list($request['ids'])));
+}
+
+add_action('rest_api_init', function () {
+  register_rest_route('themetest/v1', '/rundown', array(
+    'methods' => 'GET',
+    'callback' => 'themetest_rest_rundown',
+    'permission_callback' => '__return_true',
+    'args' => array(
+      'ids' => array('required' => true),
+    ),
+  ));
+});
+
 function themetest_results_rundown($atts = [], $content = null, $tag = '') {
   $res = <<<EODA
 <div id="themetest-rundown" class="container-fluid">
 
 EODA;
 
-  foreach ($atts as $att) {
-    $post_ids = explode(" ", $att);
+  $atts = shortcode_atts(array('post_ids' => ''), $atts, $tag);
+  $post_ids = preg_split('/[\s,]+/', trim($atts['post_ids']));
+  $rows = themetest_rundown_data($post_ids);
+  foreach ($rows as $i => $row) {
+    $rows[$i]['leaderboard'] = themetest_leaderboard_entry($row['theme_slug']);
   }
-  foreach ($post_ids as $post_id) {
-    $theme_name = get_field('theme_name', $post_id);
-    $theme_featured_image = get_the_post_thumbnail_url($post_id);
-    $theme_permalink = get_permalink($post_id);
-    $theme_slug = get_field('theme_slug', $post_id);
-    $theme_author = get_field('theme_author', $post_id);
-    $theme_version = get_field('theme_version', $post_id);
-    $theme_rating = get_field('theme_rating', $post_id);
-    $theme_last_updated = get_field('theme_last_updated', $post_id);
-    $theme_downloaded = get_field('theme_downloaded', $post_id);
-    $gt_page_elements = get_field('gt_page_elements', $post_id);
-    $gt_page_bytes = get_field('gt_page_bytes', $post_id);
-    $gt_page_load_time = get_field('gt_page_load_time', $post_id);
-    $gt_html_bytes = get_field('gt_html_bytes', $post_id);
-    $gt_first_contentful_paint_time = get_field('gt_first_contentful_paint_time', $post_id);
-    $gt_dom_interactive_time = get_field('gt_dom_interactive_time', $post_id);
-    $gt_pagespeed_score = get_field('gt_pagespeed_score', $post_id);
-    $gt_yslow_score = get_field('gt_yslow_score', $post_id);
+  usort($rows, 'themetest_compare_rank');
+  foreach ($rows as $row) {
+    $rank = $row['leaderboard'];
+    $theme_rank = $rank ? "#{$rank['rank']} of {$rank['total']}" : '-';
+    $theme_score = ($rank && $rank['score'] !== null) ? $rank['score'] : '-';
+    $theme_featured_image = $row['featured_image'];
+    $theme_permalink = $row['permalink'];
+    $theme_name = $row['theme_name'];
+    $theme_slug = $row['theme_slug'];
+    $theme_author = $row['theme_author'];
+    $theme_version = $row['theme_version'];
+    $theme_rating = $row['theme_rating'];
+    $theme_last_updated = $row['theme_last_updated'];
+    $theme_downloaded = $row['theme_downloaded'];
+    $gt_page_elements = $row['gt_page_elements'];
+    $gt_page_bytes = $row['gt_page_bytes'];
+    $gt_page_load_time = $row['gt_page_load_time'];
+    $gt_html_bytes = $row['gt_html_bytes'];
+    $gt_first_contentful_paint_time = $row['gt_first_contentful_paint_time'];
+    $gt_dom_interactive_time = $row['gt_dom_interactive_time'];
+    $gt_pagespeed_score = $row['gt_pagespeed_score'];
+    $gt_yslow_score = $row['gt_yslow_score'];
 
     $newrow = <<<EODB
       <div class="row no-gutter theme-panel">
@@ -178,6 +348,7 @@ EODA;
               <div class="themepage-label">Author:</div>
               <div class="themepage-label">Version:</div>
               <div class="themepage-label">Rating:</div>
+              <div class="themepage-label">Rank:</div>
               <div class="themepage-label hidden-md hidden-sm">Updated:</div>
               <div class="themepage-label hidden-md hidden-sm">DL Count:</div>
           </div>
@@ -186,6 +357,7 @@ EODA;
               <div class="themepage-data">$theme_author</div>
               <div class="themepage-data">$theme_version</div>
               <div class="themepage-data">$theme_rating</div>
+              <div class="themepage-data">$theme_rank</div>
               <div class="themepage-data hidden-md hidden-sm">$theme_last_updated</div>
               <div class="themepage-data hidden-md hidden-sm">$theme_downloaded</div>
           </div>
@@ -218,6 +390,10 @@ EODA;
           <div class="col-sm-12 col-xs-4 big_number_label">YSlow<div class="visible-xs visible-xs-inline-block">:</div></div>
           <div class="col-sm-12 col-xs-8 big_number">$gt_yslow_score</div>
           </div>
+          <div class="row no-gutter">
+          <div class="col-sm-12 col-xs-4 big_number_label">Score<div class="visible-xs visible-xs-inline-block">:</div></div>
+          <div class="col-sm-12 col-xs-8 big_number">$theme_score</div>
+          </div>
         </div>
     
       </div> <!-- row -->
@@ -0,0 +1,413 @@
+"""Content-addressed on-disk cache for downloaded artifacts.
+
+WordPress core, theme zips and screenshots are fetched through here. Entries
+are keyed by URL and an optional version; the bytes are stored once per
+sha256 under blobs/. Versioned entries are treated as immutable, unversioned
+ones are revalidated with If-None-Match/If-Modified-Since. If the network is
+unavailable a cached copy is served as-is, so a warm cache works offline.
+The least recently used entries are evicted once the cache exceeds max_bytes.
+
+Downloads stream in large chunks to a per-key partial file that is only
+renamed into the blob store once its size matches what the server sent, so
+an interrupted transfer never looks like a cached copy. The next attempt
+picks the partial file up with a Range request, sent with If-Range and the
+validator saved next to the partial file so a resource that changed in the
+meantime comes back whole instead of being spliced onto old bytes."""
+
+import os
+import json
+import time
+import errno
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import traceback
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+import httpclient
+import tracing
+
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+# Reads off the socket are kept moderate so little is lost when a transfer
+# breaks, writes go through a large file buffer
+CHUNK_SIZE = 64 * 1024
+WRITE_BUFFER = 1024 * 1024
+RESUME_ATTEMPTS = 3
+# Index keys of blobs that lost their entry while in use
+ORPHAN = 'orphan:'
+
+
+class IncompleteDownload(IOError):
+    """The connection ended before the whole body arrived"""
+
+
+class ArtifactCache(object):
+    """Any number of threads and processes can share one cache directory.
+    The index is re-read and written under an flock on the cache's lock
+    file, and every blob handed out is held open with a shared flock until
+    the caller is done with it, which keeps evict() in any process from
+    deleting it. Blobs that are in use when their entry goes are kept as
+    orphan entries and deleted by a later evict()."""
+
+    def __init__(self, cache_dir, max_bytes=DEFAULT_MAX_BYTES, http=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.http = http
+        self.index_filename = os.path.join(cache_dir, 'index.json')
+        self.lock_filename = os.path.join(cache_dir, 'lock')
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.log = logging.getLogger('artifactcache')
+        for directory in (cache_dir, os.path.join(cache_dir, 'blobs'), os.path.join(cache_dir, 'tmp')):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        self.index = {}
+        # Identity of the index file last read or written, to spot writes by
+        # other processes
+        self.index_stat = None
+
+    @staticmethod
+    def key(url, version=None):
+        return hashlib.sha1(('%s\0%s' % (url, version or '')).encode('utf-8')).hexdigest()
+
+    def blob_path(self, digest):
+        return os.path.join(self.cache_dir, 'blobs', digest[:2], digest)
+
+    @staticmethod
+    def file_id(filename):
+        stat = os.stat(filename)
+        return stat.st_ino, stat.st_size, stat.st_mtime
+
+    @contextmanager
+    def locked(self):
+        """Hold the thread lock and the cache's file lock, with the index
+        reloaded if another process wrote it"""
+
+        with self.lock:
+            with open(self.lock_filename, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    if os.path.isfile(self.index_filename) and \
+                            self.file_id(self.index_filename) != self.index_stat:
+                        with open(self.index_filename) as index:
+                            self.index = json.load(index)
+                        self.index_stat = self.file_id(self.index_filename)
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def save_index(self):
+        """Write the index atomically, call inside locked()"""
+
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.index, f)
+        os.rename(tmp, self.index_filename)
+        self.index_stat = self.file_id(self.index_filename)
+
+    def pin(self, digest):
+        """Open a blob with a shared flock, so it isn't deleted until the
+        file is closed. Returns None if the blob is gone. Call inside
+        locked()"""
+
+        try:
+            f = open(self.blob_path(digest), 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        fcntl.flock(f, fcntl.LOCK_SH)
+        return f
+
+    def unlink_blob(self, digest):
+        """Delete a blob unless it is pinned, returns whether it is gone.
+        Call inside locked()"""
+
+        path = self.blob_path(digest)
+        try:
+            f = open(path, 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return True
+        with f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                return False
+            os.unlink(path)
+        return True
+
+    @contextmanager
+    def key_lock(self, key):
+        """One download of an URL at a time, in this process and any other"""
+
+        with self.lock:
+            lock = self.key_locks.setdefault(key, threading.Lock())
+        # Lock files are shared between keys so there are at most 256
+        with lock, open(os.path.join(self.cache_dir, 'tmp', 'lock-' + key[:2]), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def partial_path(self, key):
+        return os.path.join(self.cache_dir, 'tmp', key + '.part')
+
+    @staticmethod
+    def validator(headers):
+        """What to send as If-Range to resume a download of a response with
+        these headers, None if it can't be resumed safely. Weak ETags don't
+        qualify."""
+
+        etag = headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            return etag
+        return headers.get('Last-Modified')
+
+    def discard_partial(self, partial):
+        for filename in (partial, partial + '.json'):
+            if os.path.isfile(filename):
+                os.unlink(filename)
+
+    def resume_validator(self, partial):
+        """The If-Range validator saved with a partial file, discarding the
+        partial file if there is none"""
+
+        try:
+            with open(partial + '.json') as f:
+                validator = json.load(f).get('validator')
+        except (IOError, ValueError):
+            validator = None
+        if not validator:
+            self.discard_partial(partial)
+        return validator
+
+    def fetch(self, url, version=None, auth=None):
+        """Return a local copy of url, downloading or revalidating it as
+        needed, as a pinned open file. Its blob stays on disk until the file
+        is closed, see use(). The file must not be modified."""
+
+        key = self.key(url, version)
+        with self.key_lock(key), tracing.span('download', url=url) as span:
+            return self.fetch_locked(key, url, version, auth, span)
+
+    def fetch_locked(self, key, url, version, auth, span):
+        with self.locked():
+            entry = self.index.get(key)
+            pinned = self.pin(entry['digest']) if entry else None
+        if pinned is None:
+            entry = None
+        headers = {}
+        if entry:
+            if version is not None:
+                span.status = 'hit'
+                return self.touch(key, pinned)
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        http = self.http or httpclient.get_session()
+        attempt = 1
+        while True:
+            partial = self.partial_path(key)
+            validator = self.resume_validator(partial) if os.path.isfile(partial) else None
+            offset = os.path.getsize(partial) if validator else 0
+            # Range offsets have to count the bytes as sent
+            request_headers = dict(headers, **{'Accept-Encoding': 'identity'})
+            if offset:
+                request_headers['Range'] = 'bytes=%s-' % offset
+                request_headers['If-Range'] = validator
+            try:
+                response = http.get(url, auth=auth, headers=request_headers, stream=True)
+                if entry and response.status_code == 304:
+                    response.close()
+                    self.log.debug('Not modified: %s' % url)
+                    span.status = 'not modified'
+                    return self.touch(key, pinned)
+                if response.status_code == 416:
+                    # The partial file doesn't fit what the server has now
+                    response.close()
+                    self.discard_partial(partial)
+                    continue
+                response.raise_for_status()
+                digest, size = self.store(response, partial)
+                span.bytes = size
+                span.status = 'downloaded'
+                break
+            except Exception as e:
+                if entry:
+                    self.log.warning('Could not revalidate %s (%s), using cached copy' % (url, e))
+                    span.status = 'stale'
+                    return self.touch(key, pinned)
+                if not isinstance(e, IncompleteDownload) or attempt >= RESUME_ATTEMPTS:
+                    raise
+                self.log.warning('%s, resuming (%s/%s)' % (e, attempt, RESUME_ATTEMPTS))
+                attempt += 1
+
+        if pinned is not None:
+            # The old copy is being replaced, let it go
+            pinned.close()
+        with self.locked():
+            replaced = self.index.get(key)
+            self.index[key] = {
+                'url': url,
+                'version': version,
+                'digest': digest,
+                'size': size,
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'fetched': time.time(),
+                'last_used': time.time(),
+            }
+            if replaced and replaced['digest'] != digest:
+                self.release(replaced)
+            pinned = self.pin(digest)
+            self.evict(keep=key)
+            self.save_index()
+        self.log.info('Cached %s (%s bytes)' % (url, size))
+        return pinned
+
+    @contextmanager
+    def use(self, url, version=None, auth=None):
+        """Fetch url and yield the path of the local copy, which is kept on
+        disk until the with block ends"""
+
+        pinned = self.fetch(url, version, auth)
+        try:
+            yield pinned.name
+        finally:
+            pinned.close()
+
+    @contextmanager
+    def use_many(self, downloads, workers=4):
+        """Fetch a list of (url, version, auth) concurrently and yield their
+        paths in the same order, None for any that failed. Like use(), the
+        copies are kept until the with block ends."""
+
+        # Pool threads don't inherit the stage/theme spans are attributed to
+        trace_context = tracing.current()
+
+        def fetch_one(download):
+            try:
+                with tracing.context(**trace_context):
+                    return self.fetch(*download)
+            except Exception:
+                self.log.error('Downloading %s failed\n%s' % (download[0], traceback.format_exc()))
+                return None
+
+        pins = []
+        if downloads:
+            pool = ThreadPool(max(1, min(workers, len(downloads))))
+            try:
+                pins = pool.map(fetch_one, downloads)
+            finally:
+                pool.close()
+                pool.join()
+        try:
+            yield [pinned.name if pinned else None for pinned in pins]
+        finally:
+            for pinned in pins:
+                if pinned:
+                    pinned.close()
+
+    def store(self, response, partial):
+        """Stream a response onto the partial file and move it into the blob
+        store, returns (sha256, size). A 206 response is appended to what is
+        already there, anything else starts over and saves the response's
+        validator for resuming. Raises IncompleteDownload, keeping the partial
+        file, if fewer bytes arrive than were announced."""
+
+        sha = hashlib.sha256()
+        if response.status_code == 206 and os.path.isfile(partial):
+            mode = 'ab'
+            with open(partial, 'rb') as f:
+                for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    sha.update(block)
+            size = os.path.getsize(partial)
+        else:
+            mode = 'wb'
+            size = 0
+            with open(partial + '.json', 'w') as f:
+                json.dump({'url': response.url, 'validator': self.validator(response.headers)}, f)
+        expected = response.headers.get('Content-Length')
+        if expected is not None:
+            expected = size + int(expected)
+        with open(partial, mode, WRITE_BUFFER) as f:
+            try:
+                for block in response.iter_content(CHUNK_SIZE):
+                    sha.update(block)
+                    size += len(block)
+                    f.write(block)
+            except (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError) as e:
+                raise IncompleteDownload('Lost %s after %s bytes: %s' % (response.url, size, e))
+        if expected is not None and size != expected:
+            raise IncompleteDownload('Got %s of %s bytes of %s' % (size, expected, response.url))
+
+        digest = sha.hexdigest()
+        path = self.blob_path(digest)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        os.rename(partial, path)
+        self.discard_partial(partial)
+        return digest, size
+
+    def touch(self, key, pinned):
+        with self.locked():
+            if key in self.index:
+                self.index[key]['last_used'] = time.time()
+                self.save_index()
+        return pinned
+
+    def evict(self, keep=None):
+        """Drop least recently used entries, other than keep, until under
+        max_bytes. Orphaned blobs go first whatever the size. Call inside
+        locked()"""
+
+        sizes = {}
+        for entry in self.index.values():
+            sizes[entry['digest']] = entry['size']
+        total = sum(sizes.values())
+        for key, entry in sorted(self.index.items(), key=lambda item: item[1]['last_used']):
+            if key == keep or (total <= self.max_bytes and not key.startswith(ORPHAN)):
+                continue
+            del self.index[key]
+            if self.release(entry):
+                total -= sizes[entry['digest']]
+                if not key.startswith(ORPHAN):
+                    self.log.info('Evicted %s' % entry['url'])
+
+    def release(self, entry):
+        """Delete the blob of an entry just dropped from the index if no other
+        entry shares it, returns whether it was deleted. A blob that is in use
+        is kept under an orphan entry for evict() to retry. Call inside
+        locked()"""
+
+        digest = entry['digest']
+        if any(e['digest'] == digest for e in self.index.values()):
+            return False
+        if self.unlink_blob(digest):
+            return True
+        self.index[ORPHAN + digest] = dict(entry, last_used=0)
+        return False
+
+    def copy_to(self, url, dest, version=None, auth=None):
+        """Fetch url through the cache and copy it to dest atomically"""
+
+        with self.use(url, version, auth) as path:
+            shutil.copyfile(path, dest + '.part')
+        os.rename(dest + '.part', dest)
+        return dest
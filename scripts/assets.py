@@ -0,0 +1,168 @@
+"""Static asset analysis of theme packages.
+
+Reads a theme zip in place, without extracting it, and reports the weight
+of its CSS, JS, fonts and images, how many wp_enqueue_script/style calls
+its PHP files make (functions.php and whatever it includes) and which
+CSS/JS files ship unminified. Zips are analyzed across a process pool and
+results are cached per slug and version, so a catalogue can be swept
+cheaply before a live test is spent on any theme."""
+
+import os
+import re
+import json
+import logging
+import tempfile
+import threading
+import traceback
+import zipfile
+from multiprocessing import Pool, cpu_count
+
+KINDS = {
+    'css': ('.css',),
+    'js': ('.js',),
+    'font': ('.woff', '.woff2', '.ttf', '.otf', '.eot'),
+    'image': ('.png', '.jpg', '.jpeg', '.gif', '.svg', '.webp', '.ico'),
+}
+
+# Fields every analysis has, in the order they are published
+FIELDS = ['total_bytes', 'css_bytes', 'js_bytes', 'font_bytes', 'image_bytes', 'files',
+          'css_files', 'js_files', 'font_files', 'image_files', 'enqueued_scripts',
+          'enqueued_styles', 'unminified_files', 'unminified_bytes']
+
+ENQUEUE_RE = re.compile(r'\bwp_enqueue_(script|style)\s*\(')
+
+# Only this much of each CSS/JS file is read to decide if it is minified
+MINIFY_SAMPLE = 64 * 1024
+
+# Change whenever the analysis changes so cached results are redone
+VERSION = 1
+
+
+def kind(filename):
+    name = filename.lower()
+    for kind_name, extensions in KINDS.items():
+        if name.endswith(extensions):
+            return kind_name
+    return None
+
+
+def looks_minified(sample):
+    """Minified CSS/JS has long lines and little indentation"""
+
+    lines = sample.splitlines() or ['']
+    if len(sample) < 1024:
+        # Too small to matter either way
+        return True
+    average = len(sample) / float(len(lines))
+    indented = sum(1 for line in lines if line[:1] in (' ', '\t')) / float(len(lines))
+    return average > 200 or indented < 0.1
+
+
+def analyze_zip(filename):
+    """Analyze one theme zip, returns a dict with the FIELDS plus the list
+    of unminified paths"""
+
+    res = dict((field, 0) for field in FIELDS)
+    res['unminified'] = []
+    enqueued = {'script': 0, 'style': 0}
+    with zipfile.ZipFile(filename) as archive:
+        for info in archive.infolist():
+            if info.filename.endswith('/'):
+                continue
+            res['files'] += 1
+            res['total_bytes'] += info.file_size
+            name = info.filename
+            kind_name = kind(name)
+            if kind_name:
+                res[kind_name + '_bytes'] += info.file_size
+                res[kind_name + '_files'] += 1
+            if kind_name in ('css', 'js') and '.min.' not in os.path.basename(name).lower():
+                with archive.open(info) as f:
+                    sample = f.read(MINIFY_SAMPLE).decode('utf-8', 'replace')
+                if not looks_minified(sample):
+                    res['unminified'].append(name)
+                    res['unminified_files'] += 1
+                    res['unminified_bytes'] += info.file_size
+            elif name.lower().endswith('.php'):
+                with archive.open(info) as f:
+                    source = f.read().decode('utf-8', 'replace')
+                for match in ENQUEUE_RE.finditer(source):
+                    enqueued[match.group(1)] += 1
+    res['enqueued_scripts'] = enqueued['script']
+    res['enqueued_styles'] = enqueued['style']
+    return res
+
+
+def analyze_job(job):
+    key, filename = job
+    try:
+        return key, analyze_zip(filename), None
+    except Exception:
+        return key, None, traceback.format_exc()
+
+
+class AssetCache(object):
+    """Analysis results keyed by slug and version, saved as JSON"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.results = {}
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                self.results = json.load(f)
+
+    @staticmethod
+    def key(slug, version):
+        return '%s@%s' % (slug, version)
+
+    def get(self, slug, version):
+        res = self.results.get(self.key(slug, version))
+        if res and res.get('analysis_version') == VERSION:
+            return res
+        return None
+
+    def put(self, slug, version, res):
+        with self.lock:
+            self.results[self.key(slug, version)] = dict(res, analysis_version=VERSION)
+
+    def save(self):
+        with self.lock:
+            directory = os.path.dirname(os.path.abspath(self.filename))
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix='.json')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.results, f, indent=1, sort_keys=True)
+            os.rename(tmp, self.filename)
+
+
+def analyze_many(cache, packages, processes=None):
+    """Analyze (slug, version, zip path) packages that aren't cached yet
+    across a process pool. Returns {(slug, version): result} for all of them
+    that succeeded."""
+
+    log = logging.getLogger('assets')
+    res = {}
+    jobs = []
+    for slug, version, filename in packages:
+        cached = cache.get(slug, version)
+        if cached:
+            res[(slug, version)] = cached
+        elif filename:
+            jobs.append(((slug, version), filename))
+    if jobs:
+        processes = processes or min(cpu_count(), len(jobs))
+        log.info('Analyzing %s theme packages with %s processes, %s cached' % (len(jobs), processes, len(res)))
+        pool = Pool(processes)
+        try:
+            for key, analysis, error in pool.imap_unordered(analyze_job, jobs):
+                if error:
+                    log.error('%s %s: analysis failed\n%s' % (key[0], key[1], error))
+                    continue
+                cache.put(key[0], key[1], analysis)
+                res[key] = cache.get(*key)
+                log.debug('%s %s: %s bytes' % (key[0], key[1], analysis['total_bytes']))
+        finally:
+            pool.close()
+            pool.join()
+        cache.save()
+    return res
@@ -0,0 +1,198 @@
+"""Pluggable page test backends.
+
+A backend takes a list of (key, url) tests and reports each one through
+on_complete(key, data) or on_error(key, data), where data is shaped like a
+GTMetrix test (state/results/resources) so build_acfdata can consume it
+whichever backend produced it."""
+
+import ssl
+import time
+import socket
+import logging
+import traceback
+from urlparse import urljoin, urlparse
+from HTMLParser import HTMLParser
+from multiprocessing.pool import ThreadPool
+
+import httpclient
+from resultstore import METRICS
+from gtscheduler import GTmetrixScheduler, GTMETRIX_API_URL
+
+RESOURCE_KEYS = ['screenshot', 'report_pdf', 'pagespeed', 'report_pdf_full',
+                 'pagespeed_files', 'har', 'yslow']
+
+
+class TestBackend(object):
+    """Base class, subclasses implement run()"""
+
+    name = None
+
+    def run(self, tests, on_complete=None, on_error=None):
+        raise NotImplementedError
+
+
+class GTmetrixBackend(TestBackend):
+    """Tests on gtmetrix.com through the GTmetrixScheduler"""
+
+    name = 'gtmetrix'
+
+    def __init__(self, username, password, api_url=GTMETRIX_API_URL, concurrency=2, options=None):
+        self.username = username
+        self.password = password
+        self.api_url = api_url
+        self.concurrency = concurrency
+        self.options = options or {}
+
+    def run(self, tests, on_complete=None, on_error=None):
+        scheduler = GTmetrixScheduler(
+            self.username, self.password, api_url=self.api_url,
+            concurrency=self.concurrency, on_complete=on_complete, on_error=on_error)
+        for key, url in tests:
+            scheduler.add(key, url, self.options)
+        scheduler.run()
+        return scheduler.results
+
+
+class ResourceParser(HTMLParser):
+    """Collects the stylesheet, script and image URLs a page links to"""
+
+    def __init__(self, base_url):
+        HTMLParser.__init__(self)
+        self.base_url = base_url
+        self.resources = []
+
+    def add(self, url, kind):
+        if url and not url.startswith('data:'):
+            url = urljoin(self.base_url, url.strip())
+            if url not in [r[0] for r in self.resources]:
+                self.resources.append((url, kind))
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == 'link' and 'stylesheet' in (attrs.get('rel') or '').lower():
+            self.add(attrs.get('href'), 'css')
+        elif tag == 'link' and 'icon' in (attrs.get('rel') or '').lower():
+            self.add(attrs.get('href'), 'image')
+        elif tag == 'script' and attrs.get('src'):
+            self.add(attrs.get('src'), 'js')
+        elif tag == 'img':
+            self.add(attrs.get('src'), 'image')
+
+
+class LocalBackend(TestBackend):
+    """Tests on our own hardware: fetch the page over the pooled client,
+    find its CSS, JS and images and load them concurrently. Only the timing
+    and size fields can be measured, the scores are left empty."""
+
+    name = 'local'
+
+    def __init__(self, concurrency=8, resource_workers=8, http=None):
+        self.concurrency = concurrency
+        self.resource_workers = resource_workers
+        self.http = http
+        self.log = logging.getLogger('localbackend')
+
+    def connect_time(self, url):
+        """TCP (and TLS) connect time in ms on a fresh connection, the pooled
+        session would otherwise hide it"""
+
+        parts = urlparse(url)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        started = time.time()
+        sock = socket.create_connection((parts.hostname, port), timeout=10)
+        try:
+            if parts.scheme == 'https':
+                context = ssl.create_default_context()
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+                sock = context.wrap_socket(sock, server_hostname=parts.hostname)
+            return (time.time() - started) * 1000
+        finally:
+            sock.close()
+
+    def fetch(self, url):
+        """Returns (bytes, ms to first byte, ms to last byte)"""
+
+        http = self.http or httpclient.get_session()
+        started = time.time()
+        response = http.get(url, stream=True)
+        first_byte = (time.time() - started) * 1000
+        body = response.content
+        response.raise_for_status()
+        return body, first_byte, (time.time() - started) * 1000
+
+    def test(self, url):
+        started = time.time()
+        connect_duration = self.connect_time(url)
+        html, backend_duration, html_load_time = self.fetch(url)
+        parser = ResourceParser(url)
+        parser.feed(html.decode('utf-8', 'replace'))
+        dom_time = (time.time() - started) * 1000
+
+        def load(resource):
+            try:
+                return resource, len(self.fetch(resource[0])[0])
+            except Exception as e:
+                self.log.warning('%s: %s' % (resource[0], e))
+                return resource, 0
+
+        page_bytes = len(html)
+        page_elements = 1
+        if parser.resources:
+            pool = ThreadPool(min(self.resource_workers, len(parser.resources)))
+            try:
+                for resource, size in pool.imap_unordered(load, parser.resources):
+                    page_bytes += size
+                    page_elements += 1
+            finally:
+                pool.close()
+                pool.join()
+        fully_loaded_time = (time.time() - started) * 1000
+
+        results = dict((metric, None) for metric in METRICS)
+        results.update({
+            'report_url': None,
+            'page_elements': page_elements,
+            'html_bytes': len(html),
+            'page_bytes': page_bytes,
+            'connect_duration': int(connect_duration),
+            'backend_duration': int(backend_duration),
+            'html_load_time': int(html_load_time),
+            'dom_interactive_time': int(dom_time),
+            'onload_time': int(fully_loaded_time),
+            'page_load_time': int(fully_loaded_time),
+            'fully_loaded_time': int(fully_loaded_time),
+        })
+        return {
+            'state': 'completed',
+            'results': results,
+            'resources': dict((key, None) for key in RESOURCE_KEYS),
+        }
+
+    def run(self, tests, on_complete=None, on_error=None):
+        def run_one(test):
+            key, url = test
+            try:
+                return key, self.test(url), None
+            except Exception as e:
+                self.log.error('%s: test failed\n%s' % (key, traceback.format_exc()))
+                return key, None, {'error': str(e)}
+
+        results = {}
+        pool = ThreadPool(max(1, min(self.concurrency, len(tests))))
+        try:
+            for key, data, error in pool.imap_unordered(run_one, tests):
+                if error:
+                    if on_error:
+                        on_error(key, error)
+                    continue
+                results[key] = data
+                if on_complete:
+                    try:
+                        on_complete(key, data)
+                    except Exception:
+                        self.log.error('%s: storing result failed\n%s' % (key, traceback.format_exc()))
+        finally:
+            pool.close()
+            pool.join()
+        return results
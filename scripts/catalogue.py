@@ -0,0 +1,154 @@
+"""Paginated WordPress.org theme catalogue fetcher and line-delimited store.
+
+fetch_catalogue walks every page of a browse (featured, new, updated,
+popular) or tag/search query concurrently and appends each theme to a
+CatalogueStore as its page arrives. The store is one compact JSON object
+per line plus a slug -> byte offset index, so tens of thousands of themes
+can be iterated or looked up without loading them all."""
+
+import os
+import json
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+import httpclient
+
+THEMES_API_URL = 'https://api.wordpress.org/themes/info/1.1/'
+
+THEME_FIELDS = [
+    'description', 'sections', 'rating', 'ratings', 'downloaded', 'download_link',
+    'last_updated', 'homepage', 'tags', 'template', 'parent', 'versions',
+    'screenshot_url', 'active_installs',
+]
+
+
+def query_params(page=1, browse=None, tag=None, search=None, per_page=None):
+    """POST data for a query_themes call with all of the fields we use"""
+
+    data = {
+        'action': 'query_themes',
+        'request[page]': str(page),
+    }
+    if browse:
+        data['request[browse]'] = browse
+    if tag:
+        data['request[tag]'] = tag
+    if search:
+        data['request[search]'] = search
+    if per_page:
+        data['request[per_page]'] = str(per_page)
+    for field in THEME_FIELDS:
+        data['request[fields][%s]' % field] = 'true'
+    return data
+
+
+def query_page(page, **query):
+    r = httpclient.get_session().post(THEMES_API_URL, data=query_params(page, **query))
+    r.raise_for_status()
+    return r.json()
+
+
+class CatalogueStore(object):
+    """Themes stored one JSON object per line, with a slug index alongside"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.index_filename = filename + '.idx'
+        self.offsets = {}
+        self.info = {}
+        if os.path.isfile(self.index_filename):
+            with open(self.index_filename) as f:
+                index = json.load(f)
+            self.offsets = index['offsets']
+            self.info = index.get('info', {})
+        self.lock = threading.Lock()
+        self.out = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, slug):
+        return slug in self.offsets
+
+    def __iter__(self):
+        with open(self.filename) as f:
+            for line in f:
+                yield json.loads(line)
+
+    def get(self, slug):
+        offset = self.offsets.get(slug)
+        if offset is None:
+            return None
+        with open(self.filename) as f:
+            f.seek(offset)
+            return json.loads(f.readline())
+
+    def begin(self):
+        """Start writing a fresh copy, readers see the old one until commit()"""
+
+        self.out = open(self.filename + '.part', 'w')
+        self.offsets = {}
+
+    def add(self, theme):
+        """Append a theme, returns False if its slug is already stored"""
+
+        line = json.dumps(theme, separators=(',', ':')) + '\n'
+        with self.lock:
+            if theme['slug'] in self.offsets:
+                return False
+            self.offsets[theme['slug']] = self.out.tell()
+            self.out.write(line)
+        return True
+
+    def commit(self):
+        self.out.close()
+        self.out = None
+        os.rename(self.filename + '.part', self.filename)
+        with open(self.index_filename + '.part', 'w') as f:
+            json.dump({'info': self.info, 'offsets': self.offsets}, f)
+        os.rename(self.index_filename + '.part', self.index_filename)
+
+    def abort(self):
+        """Throw away a copy begin() started, whether or not commit() got
+        part of the way"""
+
+        if self.out is not None:
+            self.out.close()
+            self.out = None
+        for filename in (self.filename + '.part', self.index_filename + '.part'):
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+
+def fetch_catalogue(filename, workers=4, per_page=100, **query):
+    """Fetch every page of a catalogue query into a CatalogueStore at
+    filename. query takes browse, tag and/or search."""
+
+    log = logging.getLogger('catalogue')
+    store = CatalogueStore(filename)
+    store.begin()
+    try:
+        first = query_page(1, per_page=per_page, **query)
+        pages = int(first['info']['pages'])
+        log.info('%s themes across %s pages for %s' % (first['info']['results'], pages, query))
+        for theme in first['themes']:
+            store.add(theme)
+
+        def fetch(page):
+            return page, query_page(page, per_page=per_page, **query)
+
+        pool = ThreadPool(max(1, min(workers, pages - 1)))
+        try:
+            for page, data in pool.imap_unordered(fetch, range(2, pages + 1)):
+                added = sum(1 for theme in data['themes'] if store.add(theme))
+                log.info('Page %s/%s: %s themes stored (%s total)' % (page, pages, added, len(store)))
+        finally:
+            pool.close()
+            pool.join()
+        store.info = {'results': first['info']['results'], 'pages': pages, 'query': query}
+        store.commit()
+    except Exception:
+        store.abort()
+        raise
+    return store
@@ -0,0 +1,244 @@
+"""Synthetic test content at a chosen scale.
+
+A profile says how many posts, pages, terms, comments and attachments a
+site gets, how deep comment threads go and how many images each post shows.
+generate() makes the rows deterministically from a seed, and load() replaces
+a site's content with them using multi-row INSERTs streamed through one
+mysql session, which takes seconds where the importer takes minutes. The
+attachment files themselves are a handful of generated JPEGs in the site's
+uploads directory."""
+
+import os
+import random
+import logging
+import datetime
+
+from sitedb import insert_statements, quote_name
+
+PROFILES = {
+    'small': dict(posts=10, pages=5, categories=3, tags=10, comments=3, comment_depth=2,
+                  attachments=10, images_per_post=1, paragraphs=4, featured_images=0.5),
+    'medium': dict(posts=1000, pages=20, categories=20, tags=200, comments=10, comment_depth=3,
+                   attachments=200, images_per_post=2, paragraphs=6, featured_images=0.8),
+    'large': dict(posts=10000, pages=50, categories=50, tags=1000, comments=25, comment_depth=5,
+                  attachments=2000, images_per_post=3, paragraphs=8, featured_images=1.0),
+}
+
+# Tables load() empties and refills, without the site's prefix
+CONTENT_TABLES = ['posts', 'postmeta', 'comments', 'commentmeta', 'terms', 'termmeta',
+                  'term_taxonomy', 'term_relationships']
+
+# Distinct image files the attachments share
+IMAGE_FILES = 12
+IMAGE_SIZE = (1200, 800)
+UPLOADS_SUBDIR = 'themetest'
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut '
+         'labore et dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris '
+         'nisi aliquip ex ea commodo consequat duis aute irure in reprehenderit voluptate velit esse '
+         'cillum fugiat nulla pariatur excepteur sint occaecat cupidatat non proident sunt culpa qui '
+         'officia deserunt mollit anim id est laborum').split()
+
+POST_COLUMNS = ['ID', 'post_author', 'post_date', 'post_date_gmt', 'post_content', 'post_title',
+                'post_excerpt', 'post_status', 'comment_status', 'ping_status', 'post_password',
+                'post_name', 'to_ping', 'pinged', 'post_modified', 'post_modified_gmt',
+                'post_content_filtered', 'post_parent', 'guid', 'menu_order', 'post_type',
+                'post_mime_type', 'comment_count']
+POSTMETA_COLUMNS = ['post_id', 'meta_key', 'meta_value']
+TERM_COLUMNS = ['term_id', 'name', 'slug', 'term_group']
+TAXONOMY_COLUMNS = ['term_taxonomy_id', 'term_id', 'taxonomy', 'description', 'parent', 'count']
+RELATIONSHIP_COLUMNS = ['object_id', 'term_taxonomy_id', 'term_order']
+COMMENT_COLUMNS = ['comment_ID', 'comment_post_ID', 'comment_author', 'comment_author_email',
+                   'comment_author_url', 'comment_author_IP', 'comment_date', 'comment_date_gmt',
+                   'comment_content', 'comment_karma', 'comment_approved', 'comment_agent',
+                   'comment_type', 'comment_parent', 'user_id']
+
+
+def get_profile(name, custom=None):
+    """A profile by name, custom profiles (e.g. from THEMETEST_CONFIG) win"""
+
+    profiles = dict(PROFILES, **(custom or {}))
+    if name not in profiles:
+        raise ValueError('Unknown content profile %s, expected one of %s' % (name, ', '.join(sorted(profiles))))
+    return profiles[name]
+
+
+def php_serialize(value):
+    """Enough of PHP's serialize() for attachment metadata"""
+
+    if isinstance(value, bool):
+        return 'b:%d;' % value
+    if isinstance(value, (int, long)):
+        return 'i:%d;' % value
+    if isinstance(value, dict):
+        return 'a:%d:{%s}' % (len(value), ''.join(
+            php_serialize(k) + php_serialize(v) for k, v in sorted(value.items())))
+    value = str(value)
+    return 's:%d:"%s";' % (len(value), value)
+
+
+def sentence(rng, words):
+    text = ' '.join(rng.choice(WORDS) for i in range(words))
+    return text[0].upper() + text[1:]
+
+
+# Text is drawn from pools this size, writing every word fresh is the slow part
+TEXT_POOL = 500
+
+
+def write_images(uploads_path, count=IMAGE_FILES, seed=0):
+    """Write the shared attachment JPEGs, returns their paths relative to
+    uploads_path"""
+
+    from PIL import Image, ImageDraw
+
+    directory = os.path.join(uploads_path, UPLOADS_SUBDIR)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    rng = random.Random(seed)
+    files = []
+    for n in range(count):
+        name = os.path.join(UPLOADS_SUBDIR, 'synthetic-%02d.jpg' % n)
+        files.append(name)
+        path = os.path.join(uploads_path, name)
+        if os.path.isfile(path):
+            continue
+        image = Image.new('RGB', IMAGE_SIZE, tuple(rng.randint(0, 255) for i in range(3)))
+        draw = ImageDraw.Draw(image)
+        for i in range(40):
+            x, y = rng.randint(0, IMAGE_SIZE[0]), rng.randint(0, IMAGE_SIZE[1])
+            r = rng.randint(20, 200)
+            draw.ellipse((x - r, y - r, x + r, y + r), fill=tuple(rng.randint(0, 255) for i in range(3)))
+        image.save(path + '.part', 'JPEG', quality=80)
+        os.rename(path + '.part', path)
+    return files
+
+
+def generate(profile, site_url, image_files, seed=0):
+    """Rows for every content table as a dict of table: (columns, rows)"""
+
+    rng = random.Random(seed)
+    paragraph_pool = ['<p>%s.</p>' % sentence(rng, rng.randint(30, 90)) for i in range(TEXT_POOL)]
+    comment_pool = [sentence(rng, rng.randint(10, 60)) + '.' for i in range(TEXT_POOL)]
+    site_url = site_url.rstrip('/')
+    now = datetime.datetime(2018, 1, 1)
+    posts, postmeta, terms, taxonomy, relationships, comments = [], [], [], [], [], []
+
+    def date(days_ago):
+        return (now - datetime.timedelta(days=days_ago, seconds=rng.randint(0, 86399))).strftime('%Y-%m-%d %H:%M:%S')
+
+    def post_row(post_id, title, content, status, post_type, parent=0, guid=None, mime='',
+                 comment_count=0, posted=None):
+        posted = posted or date(rng.randint(0, 730))
+        slug = '%s-%s' % ('-'.join(title.lower().split()[:5]), post_id)
+        return [post_id, 1, posted, posted, content, title, '', status, 'open', 'open', '', slug, '', '',
+                posted, posted, '', parent, guid or '%s/?p=%s' % (site_url, post_id), 0, post_type, mime,
+                comment_count]
+
+    # Terms, Uncategorized keeps id 1 as the default category
+    term_counts = {}
+    categories = [1]
+    terms.append([1, 'Uncategorized', 'uncategorized', 0])
+    taxonomy.append([1, 1, 'category', '', 0, 0])
+    for n in range(profile['categories']):
+        term_id = len(terms) + 1
+        name = sentence(rng, 2)
+        terms.append([term_id, name, '%s-%s' % ('-'.join(name.lower().split()), term_id), 0])
+        taxonomy.append([term_id, term_id, 'category', '', 0, 0])
+        categories.append(term_id)
+    tags = []
+    for n in range(profile['tags']):
+        term_id = len(terms) + 1
+        name = rng.choice(WORDS) + ' ' + rng.choice(WORDS)
+        terms.append([term_id, name, '%s-%s' % ('-'.join(name.split()), term_id), 0])
+        taxonomy.append([term_id, term_id, 'post_tag', '', 0, 0])
+        tags.append(term_id)
+
+    next_id = [1]
+
+    def new_id():
+        next_id[0] += 1
+        return next_id[0] - 1
+
+    # Attachments first so posts can show them
+    attachments = []
+    for n in range(profile['attachments']):
+        attachment_id = new_id()
+        filename = image_files[n % len(image_files)]
+        url = '%s/wp-content/uploads/%s' % (site_url, filename)
+        posts.append(post_row(attachment_id, 'Image %s' % n, '', 'inherit', 'attachment', guid=url,
+                              mime='image/jpeg'))
+        postmeta.append([attachment_id, '_wp_attached_file', filename])
+        postmeta.append([attachment_id, '_wp_attachment_metadata', php_serialize({
+            'width': IMAGE_SIZE[0], 'height': IMAGE_SIZE[1], 'file': filename, 'sizes': {}})])
+        attachments.append((attachment_id, url))
+
+    comment_id = 1
+    for n in range(profile['posts'] + profile['pages']):
+        is_page = n >= profile['posts']
+        post_id = new_id()
+        content = '\n\n'.join(rng.choice(paragraph_pool) for i in range(profile['paragraphs']))
+        if attachments:
+            for attachment_id, url in rng.sample(attachments, min(profile['images_per_post'], len(attachments))):
+                content += '\n\n<img class="wp-image-%s" src="%s" alt="" width="%s" height="%s" />' % (
+                    attachment_id, url, IMAGE_SIZE[0], IMAGE_SIZE[1])
+        posted = date(rng.randint(0, 730))
+        thread = []
+        comment_count = 0 if is_page else profile['comments']
+        for c in range(comment_count):
+            parent, depth = 0, 1
+            candidates = [(cid, d) for cid, d in thread if d < profile['comment_depth']]
+            if candidates and rng.random() < 0.6:
+                parent, parent_depth = rng.choice(candidates)
+                depth = parent_depth + 1
+            comments.append([comment_id, post_id, 'Commenter %s' % rng.randint(1, 500), 'commenter@example.com',
+                             '', '127.0.0.1', posted, posted, rng.choice(comment_pool), 0, '1',
+                             '', '', parent, 0])
+            thread.append((comment_id, depth))
+            comment_id += 1
+        posts.append(post_row(post_id, sentence(rng, rng.randint(3, 8)), content, 'publish',
+                              'page' if is_page else 'post', comment_count=comment_count, posted=posted))
+        if is_page:
+            continue
+        if attachments and rng.random() < profile['featured_images']:
+            postmeta.append([post_id, '_thumbnail_id', rng.choice(attachments)[0]])
+        post_terms = [rng.choice(categories)] + rng.sample(tags, min(len(tags), rng.randint(0, 5)))
+        for term_id in post_terms:
+            relationships.append([post_id, term_id, 0])
+            term_counts[term_id] = term_counts.get(term_id, 0) + 1
+
+    for row in taxonomy:
+        row[5] = term_counts.get(row[0], 0)
+
+    return {
+        'posts': (POST_COLUMNS, posts),
+        'postmeta': (POSTMETA_COLUMNS, postmeta),
+        'terms': (TERM_COLUMNS, terms),
+        'term_taxonomy': (TAXONOMY_COLUMNS, taxonomy),
+        'term_relationships': (RELATIONSHIP_COLUMNS, relationships),
+        'comments': (COMMENT_COLUMNS, comments),
+    }
+
+
+def load(db, prefix, profile, site_url, uploads_path, seed=0, batch_size=1000):
+    """Replace a site's content with a generated profile in one transaction,
+    so a load that fails part way leaves the old content. Returns a dict of
+    table: rows loaded."""
+
+    log = logging.getLogger('content')
+    image_files = write_images(uploads_path, seed=seed) if not db.dry_run else ['dry-run.jpg']
+    tables = generate(profile, site_url, image_files, seed=seed)
+
+    def statements():
+        # Not TRUNCATE, which commits on its own and can't be rolled back
+        yield 'START TRANSACTION;\n'
+        for table in CONTENT_TABLES:
+            yield 'DELETE FROM %s;\n' % quote_name(prefix + table)
+        for table, (columns, rows) in sorted(tables.items()):
+            for statement in insert_statements(prefix + table, columns, rows, batch_size):
+                yield statement
+
+    db.load(statements())
+    counts = dict((table, len(rows)) for table, (columns, rows) in tables.items())
+    log.info('Loaded %s' % ', '.join('%s %s' % (counts[table], table) for table in sorted(counts)))
+    return counts
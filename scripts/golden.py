@@ -0,0 +1,130 @@
+"""Golden site cloning.
+
+A golden site is a fully installed WordPress with the test data already
+imported. Each theme's site is made from it by copying the file tree
+(reflinks where the filesystem allows, else hardlinks for the core files
+nothing writes to) and cloning its prefixed tables, so the only per-theme
+work left is installing the theme."""
+
+import os
+import re
+import shutil
+import logging
+import subprocess
+
+import tracing
+from sitedb import quote_name, quote_value, like_escape
+
+GOLDEN_MARKER = '.themetest-golden'
+
+# WordPress core, which nothing in a running site writes to, so clones can
+# share it by hardlink. wp-content, wp-config.php and .htaccess are written
+# in place by WordPress, themes and plugins and always get their own copy.
+SHARED_DIRS = ('wp-admin', 'wp-includes')
+PRIVATE_FILES = ('wp-config.php',)
+
+
+def is_golden(site_path):
+    """True if site_path holds a finished golden site"""
+
+    return os.path.isfile(os.path.join(site_path, GOLDEN_MARKER))
+
+
+def mark_golden(site_path):
+    with open(os.path.join(site_path, GOLDEN_MARKER), 'w') as f:
+        f.write('golden\n')
+
+
+def shared(relpath):
+    """Whether a file, relative to the site root, can be hardlinked into
+    clones without a write to it reaching the golden site"""
+
+    parts = relpath.split(os.sep)
+    if len(parts) == 1:
+        return parts[0].endswith('.php') and parts[0] not in PRIVATE_FILES
+    return parts[0] in SHARED_DIRS
+
+
+def clone_tree(src, dst):
+    """Copy src to dst as cheaply as the filesystem allows: reflinks first,
+    then hardlinks for the core files and plain copies of the rest. Returns
+    the method used."""
+
+    log = logging.getLogger('golden')
+    with open(os.devnull, 'w') as devnull:
+        if subprocess.call(['cp', '-a', '--reflink=always', src, dst], stderr=devnull) == 0:
+            return 'reflink'
+    if os.path.exists(dst):
+        shutil.rmtree(dst)
+    method = 'hardlink'
+    for root, dirs, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        if not os.path.isdir(target):
+            os.makedirs(target)
+        for name in files:
+            if name == GOLDEN_MARKER:
+                continue
+            source = os.path.join(root, name)
+            if shared(os.path.relpath(source, src)):
+                try:
+                    os.link(source, os.path.join(target, name))
+                    continue
+                except OSError:
+                    method = 'copy'
+            shutil.copy2(source, os.path.join(target, name))
+    log.debug('Cloned %s to %s (%s)' % (src, dst, method))
+    return method
+
+
+def rewrite_config(site_path, prefix):
+    """Point the cloned wp-config.php at the new table prefix. The file is
+    replaced rather than written in place."""
+
+    config_filename = os.path.join(site_path, 'wp-config.php')
+    with open(config_filename) as f:
+        config = f.read()
+    config = re.sub(r"\$table_prefix\s*=\s*'[^']*';", "$table_prefix = '%s';" % prefix, config)
+    os.unlink(config_filename)
+    with open(config_filename, 'w') as f:
+        f.write(config)
+    marker = os.path.join(site_path, GOLDEN_MARKER)
+    if os.path.exists(marker):
+        os.unlink(marker)
+
+
+def clone_tables(db, golden_prefix, prefix, site_url):
+    """Copy every golden_prefix table to prefix in one mysql call, then fix up
+    the rows WordPress keys by table prefix and the site URL options"""
+
+    tables = db.tables(golden_prefix)
+    statements = []
+    existing = db.tables(prefix)
+    if existing:
+        statements.append('DROP TABLE IF EXISTS %s;' % ', '.join(quote_name(t) for t in existing))
+    for table in tables:
+        new_table = prefix + table[len(golden_prefix):]
+        statements.append('CREATE TABLE %s LIKE %s;' % (quote_name(new_table), quote_name(table)))
+        statements.append('INSERT INTO %s SELECT * FROM %s;' % (quote_name(new_table), quote_name(table)))
+    options = quote_name(prefix + 'options')
+    usermeta = quote_name(prefix + 'usermeta')
+    statements.append("UPDATE %s SET option_name = %s WHERE option_name = %s;" % (
+        options, quote_value(prefix + 'user_roles'), quote_value(golden_prefix + 'user_roles')))
+    statements.append("UPDATE %s SET meta_key = CONCAT(%s, SUBSTRING(meta_key, %s)) WHERE meta_key LIKE '%s%%';" % (
+        usermeta, quote_value(prefix), len(golden_prefix) + 1, like_escape(golden_prefix)))
+    statements.append("UPDATE %s SET option_value = %s WHERE option_name IN ('siteurl', 'home');" % (
+        options, quote_value(site_url)))
+    db.query('\n'.join(statements))
+    return tables
+
+
+def clone_site(db, golden_path, golden_prefix, site_path, prefix, site_url):
+    """Create a site at site_path from the golden site, returns the copy method"""
+
+    if os.path.exists(site_path):
+        shutil.rmtree(site_path)
+    with tracing.span('clone_tree', path=site_path) as span:
+        method = clone_tree(golden_path, site_path)
+        span.status = method
+    rewrite_config(site_path, prefix)
+    clone_tables(db, golden_prefix, prefix, site_url)
+    return method
@@ -0,0 +1,202 @@
+"""Overlapping GTMetrix test scheduler.
+
+Keeps up to `concurrency` tests queued on GTMetrix at once and polls all of
+them from a single loop, backing off per test while it is still running,
+and gives up on a test that hasn't finished within max_test_age seconds.
+Point api_url at a local stand-in server, like the one in
+tests/gtmetrix_standin.py, to exercise it without spending credits."""
+
+import time
+import logging
+import traceback
+from requests.auth import HTTPBasicAuth
+import httpclient
+import tracing
+
+GTMETRIX_API_URL = 'https://gtmetrix.com/api/0.1'
+
+
+class GTmetrixScheduler(object):
+    """Submit, poll and collect GTMetrix tests, `concurrency` at a time.
+
+    on_complete(key, data) is called as soon as each test reaches the
+    completed state, on_error(key, data) when it fails, can't be queued, runs
+    out of time or on_complete raises."""
+
+    def __init__(self, username, password, api_url=GTMETRIX_API_URL,
+                 concurrency=2, poll_interval=3, max_poll_interval=30,
+                 backoff=1.5, max_attempts=3, max_test_age=900, on_complete=None, on_error=None,
+                 http=None):
+        self.auth = HTTPBasicAuth(username, password)
+        self.api_url = api_url.rstrip('/')
+        self.concurrency = max(1, concurrency)
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.backoff = backoff
+        self.max_attempts = max_attempts
+        self.max_test_age = max_test_age
+        self.attempts = {}
+        self.on_complete = on_complete
+        self.on_error = on_error
+        self.http = http or httpclient.get_session()
+        self.credits_left = None
+        self.pending = []
+        self.in_flight = {}
+        self.results = {}
+        self.errors = {}
+        self.log = logging.getLogger('gtscheduler')
+
+    def add(self, key, url, options=None):
+        """Queue a test of url, results are reported under key"""
+
+        data = {'url': url}
+        if options:
+            data.update(options)
+        self.pending.append((key, data))
+
+    def check_credits(self):
+        """Ask the API how many credits are left, None if it won't say"""
+
+        try:
+            r = self.http.get(self.api_url + '/status', auth=self.auth)
+            if r.status_code == 200:
+                self.credits_left = int(r.json()['api_credits'])
+                self.log.info('%s API credits available' % self.credits_left)
+        except Exception:
+            self.log.debug('Could not read API status\n%s' % traceback.format_exc())
+        return self.credits_left
+
+    def has_credits(self):
+        return self.credits_left is None or self.credits_left > 0
+
+    def submit(self, key, data):
+        """Start a test, returns False if it should be retried later"""
+
+        r = self.http.post(self.api_url + '/test', auth=self.auth, data=data)
+        self.log.info('%s: submit returned %s' % (key, r.status_code))
+        if r.status_code == 429:
+            # Too many tests queued for this account, wait for one to finish
+            return False
+        try:
+            body = r.json()
+        except ValueError:
+            body = {'error': r.text[:500]}
+        if 'test_id' not in body:
+            self.log.error('%s: could not queue test: %s' % (key, body.get('error', body)))
+            if r.status_code == 402:
+                self.credits_left = 0
+            self.fail(key, body)
+            return True
+        if 'credits_left' in body:
+            self.credits_left = int(body['credits_left'])
+        self.log.info('Test %s for %s successfully queued. %s credits left.' %
+                      (body['test_id'], key, self.credits_left))
+        self.in_flight[key] = {
+            'test_id': body['test_id'],
+            'poll_url': body.get('poll_state_url', '%s/test/%s' % (self.api_url, body['test_id'])),
+            'interval': self.poll_interval,
+            'next_poll': time.time() + self.poll_interval,
+            'submitted': time.time(),
+        }
+        return True
+
+    def poll(self, key):
+        test = self.in_flight[key]
+        with tracing.span('gtmetrix.poll', test=key, test_id=test['test_id']) as span:
+            r = self.http.get(test['poll_url'], auth=self.auth)
+            self.log.debug('%s: poll returned %s' % (key, r.status_code))
+            state = None
+            if r.status_code == 200:
+                data = r.json()
+                state = data.get('state')
+            span.bytes = len(r.content)
+            span.status = state or r.status_code
+        if state == 'completed':
+            del self.in_flight[key]
+            self.log.info('%s: test %s completed' % (key, test['test_id']))
+            if self.on_complete:
+                try:
+                    self.on_complete(key, data)
+                except Exception:
+                    self.log.error('%s: storing result failed\n%s' % (key, traceback.format_exc()))
+                    self.fail(key, {'error': 'storing result failed'})
+                    return
+            self.results[key] = data
+        elif state == 'error':
+            del self.in_flight[key]
+            self.log.error('%s: test %s errored: %s' % (key, test['test_id'], data.get('error')))
+            self.fail(key, data)
+        else:
+            self.log.debug('%s: %s' % (key, state))
+            test['interval'] = min(test['interval'] * self.backoff, self.max_poll_interval)
+            test['next_poll'] = time.time() + test['interval']
+
+    def fail(self, key, data):
+        self.errors[key] = data
+        if self.on_error:
+            try:
+                self.on_error(key, data)
+            except Exception:
+                self.log.error('%s: storing error failed\n%s' % (key, traceback.format_exc()))
+
+    def expire(self, now):
+        """Give up on tests that have been in flight for too long, an
+        expired test can 404 or stay queued forever"""
+
+        for key, test in list(self.in_flight.items()):
+            if now - test['submitted'] > self.max_test_age:
+                del self.in_flight[key]
+                self.log.error('%s: test %s not finished after %ss, giving up' % (
+                    key, test['test_id'], self.max_test_age))
+                self.fail(key, {'error': 'test %s not finished after %ss' % (test['test_id'], self.max_test_age)})
+
+    def run(self):
+        """Work through the queue, returns a dict of key: completed test data"""
+
+        if self.credits_left is None:
+            self.check_credits()
+        retry_at = 0
+        while self.pending or self.in_flight:
+            while (self.pending and len(self.in_flight) < self.concurrency
+                   and self.has_credits() and time.time() >= retry_at):
+                key, data = self.pending.pop(0)
+                try:
+                    submitted = self.submit(key, data)
+                except Exception:
+                    self.log.warning('%s: submit failed\n%s' % (key, traceback.format_exc()))
+                    self.attempts[key] = self.attempts.get(key, 0) + 1
+                    if self.attempts[key] >= self.max_attempts:
+                        self.fail(key, {'error': 'could not submit test'})
+                        continue
+                    submitted = False
+                if not submitted:
+                    self.pending.insert(0, (key, data))
+                    retry_at = time.time() + self.poll_interval
+                    break
+
+            if self.pending and not self.in_flight and not self.has_credits():
+                self.log.error('Out of GTMetrix credits, %s tests not run' % len(self.pending))
+                for key, data in self.pending:
+                    self.fail(key, {'error': 'no credits left'})
+                self.pending = []
+                break
+
+            if self.in_flight:
+                wake = min(test['next_poll'] for test in self.in_flight.values())
+            else:
+                wake = retry_at
+            delay = wake - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+            now = time.time()
+            self.expire(now)
+            for key in [k for k, t in self.in_flight.items() if t['next_poll'] <= now]:
+                try:
+                    self.poll(key)
+                except Exception:
+                    self.log.warning('%s: poll failed, will retry\n%s' % (key, traceback.format_exc()))
+                    test = self.in_flight.get(key)
+                    if test:
+                        test['next_poll'] = time.time() + test['interval']
+        return self.results
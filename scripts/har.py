@@ -0,0 +1,226 @@
+"""HAR ingestion into a per-resource SQLite index.
+
+A HAR is reduced to one row per request: URL, domain, resource type, sizes,
+timings and whether it is first or third party to the tested site. Entries
+are read one at a time with ijson so memory stays flat however large the
+page is (without ijson installed the whole HAR is loaded instead). Rows are
+keyed by run, and runs by theme, version and label, so questions across all
+runs, like which themes load the most third-party JS, are a single query."""
+
+import json
+import sqlite3
+import logging
+import threading
+from urlparse import urlparse
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+TIMINGS = ['blocked', 'dns', 'connect', 'ssl', 'send', 'wait', 'receive']
+
+TYPES = [
+    ('css', ('text/css',), ('.css',)),
+    ('js', ('javascript', 'ecmascript'), ('.js',)),
+    ('font', ('font', 'woff', 'opentype', 'truetype'), ('.woff', '.woff2', '.ttf', '.otf', '.eot')),
+    ('image', ('image/',), ('.png', '.jpg', '.jpeg', '.gif', '.svg', '.webp', '.ico')),
+    ('html', ('text/html',), ('.html', '.htm')),
+]
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    theme TEXT NOT NULL,
+    version TEXT NOT NULL,
+    label TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    page_url TEXT,
+    har_url TEXT,
+    UNIQUE (theme, version, label, timestamp)
+);
+CREATE INDEX IF NOT EXISTS runs_theme ON runs (theme, version);
+CREATE TABLE IF NOT EXISTS resources (
+    run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+    url TEXT NOT NULL,
+    domain TEXT NOT NULL,
+    type TEXT NOT NULL,
+    status INTEGER,
+    size INTEGER,
+    transfer_size INTEGER,
+    blocked REAL, dns REAL, connect REAL, ssl REAL, send REAL, wait REAL, receive REAL,
+    time REAL,
+    first_party INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS resources_run ON resources (run_id);
+CREATE INDEX IF NOT EXISTS resources_type ON resources (type, first_party);
+'''
+
+RESOURCE_COLUMNS = ['run_id', 'url', 'domain', 'type', 'status', 'size', 'transfer_size'] + TIMINGS + [
+    'time', 'first_party']
+
+
+def iter_entries(f):
+    """The log.entries of a HAR file object, one at a time"""
+
+    if ijson is not None:
+        return ijson.items(f, 'log.entries.item')
+    return iter(json.load(f)['log']['entries'])
+
+
+def resource_type(mime_type, url):
+    mime_type = (mime_type or '').lower()
+    path = urlparse(url).path.lower()
+    for name, mime_parts, extensions in TYPES:
+        if any(part in mime_type for part in mime_parts):
+            return name
+    for name, mime_parts, extensions in TYPES:
+        if path.endswith(extensions):
+            return name
+    return 'other'
+
+
+def number(value):
+    """A HAR number, -1 and missing mean not applicable"""
+
+    if value is None:
+        return None
+    value = float(value)
+    return value if value >= 0 else None
+
+
+def is_first_party(domain, site_domain):
+    return domain == site_domain or domain.endswith('.' + site_domain)
+
+
+def resource_row(entry, site_domain):
+    """Reduce a HAR entry to a resources row, without run_id"""
+
+    request = entry.get('request', {})
+    response = entry.get('response', {})
+    content = response.get('content', {})
+    url = request.get('url', '')
+    domain = (urlparse(url).hostname or '').lower()
+    size = number(content.get('size'))
+    transfer_size = number(response.get('_transferSize'))
+    if transfer_size is None:
+        body, headers = number(response.get('bodySize')), number(response.get('headersSize'))
+        if body is not None:
+            transfer_size = body + (headers or 0)
+    timings = entry.get('timings', {})
+    row = [url, domain, resource_type(content.get('mimeType'), url), response.get('status'),
+           int(size) if size is not None else None,
+           int(transfer_size) if transfer_size is not None else None]
+    row.extend(number(timings.get(name)) for name in TIMINGS)
+    row.append(number(entry.get('time')))
+    row.append(1 if is_first_party(domain, site_domain) else 0)
+    return row
+
+
+class HarIndex(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.log = logging.getLogger('har')
+        db = self.connect()
+        try:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(SCHEMA)
+        finally:
+            db.close()
+
+    def connect(self):
+        db = sqlite3.connect(self.filename, timeout=60)
+        db.execute('PRAGMA foreign_keys=ON')
+        return db
+
+    def ingest(self, har_file, theme, version, label, timestamp, page_url, har_url=None, batch_size=500):
+        """Add one run's HAR, read from the file object har_file. A run that
+        is already indexed is replaced. Returns the number of resources."""
+
+        site_domain = (urlparse(page_url).hostname or '').lower()
+        rows = (resource_row(entry, site_domain) for entry in iter_entries(har_file))
+        count = self.add_run(dict(theme=theme, version=version, label=label, timestamp=timestamp,
+                                  page_url=page_url, har_url=har_url), rows, batch_size)
+        self.log.info('%s %s: indexed %s resources' % (theme, version, count))
+        return count
+
+    def add_run(self, run, rows, batch_size=500):
+        """Add a run (a dict of the runs columns) and its resource rows, in
+        RESOURCE_COLUMNS order without run_id. Returns the number of rows."""
+
+        count = 0
+        key = (run['theme'], run['version'], run['label'], run['timestamp'])
+        with self.lock:
+            db = self.connect()
+            try:
+                with db:
+                    db.execute('DELETE FROM runs WHERE theme = ? AND version = ? AND label = ? AND timestamp = ?',
+                               key)
+                    run_id = db.execute(
+                        'INSERT INTO runs (theme, version, label, timestamp, page_url, har_url) '
+                        'VALUES (?, ?, ?, ?, ?, ?)', key + (run.get('page_url'), run.get('har_url'))).lastrowid
+                    insert = 'INSERT INTO resources (%s) VALUES (%s)' % (
+                        ', '.join(RESOURCE_COLUMNS), ', '.join('?' * len(RESOURCE_COLUMNS)))
+                    batch = []
+                    for row in rows:
+                        batch.append([run_id] + list(row))
+                        if len(batch) >= batch_size:
+                            db.executemany(insert, batch)
+                            count += len(batch)
+                            batch = []
+                    if batch:
+                        db.executemany(insert, batch)
+                        count += len(batch)
+            finally:
+                db.close()
+        return count
+
+    def export_run(self, theme, version, label, timestamp):
+        """A run and its resource rows as add_run() takes them, or None"""
+
+        db = self.connect()
+        try:
+            db.row_factory = sqlite3.Row
+            run = db.execute('SELECT * FROM runs WHERE theme = ? AND version = ? AND label = ? AND timestamp = ?',
+                             (theme, version, label, timestamp)).fetchone()
+            if run is None:
+                return None
+            rows = db.execute('SELECT %s FROM resources WHERE run_id = ?' % ', '.join(RESOURCE_COLUMNS[1:]),
+                              (run['id'],)).fetchall()
+            run = dict(run)
+            del run['id']
+            return {'run': run, 'resources': [list(row) for row in rows]}
+        finally:
+            db.close()
+
+    def query(self, sql, params=()):
+        db = self.connect()
+        try:
+            return db.execute(sql, params).fetchall()
+        finally:
+            db.close()
+
+    def third_party(self, resource='js', label=None, limit=20):
+        """Themes ranked by the third-party bytes of one resource type they
+        load per run, averaged over all their runs. Returns (theme, runs,
+        average bytes, average requests) tuples."""
+
+        return self.query(
+            'SELECT runs.theme, COUNT(DISTINCT runs.id), '
+            '  COALESCE(SUM(resources.transfer_size), 0) * 1.0 / COUNT(DISTINCT runs.id), '
+            '  COUNT(resources.run_id) * 1.0 / COUNT(DISTINCT runs.id) '
+            'FROM runs LEFT JOIN resources ON resources.run_id = runs.id '
+            '  AND resources.type = ? AND resources.first_party = 0 '
+            'WHERE ? IS NULL OR runs.label = ? '
+            'GROUP BY runs.theme ORDER BY 3 DESC LIMIT ?', (resource, label, label, limit))
+
+    def breakdown(self, theme, version=None, label=None):
+        """Bytes and requests by type and party for a theme's latest run"""
+
+        return self.query(
+            'SELECT type, first_party, COUNT(*), SUM(transfer_size), SUM(time) FROM resources '
+            'WHERE run_id = (SELECT id FROM runs WHERE theme = ? AND (? IS NULL OR version = ?) '
+            '  AND (? IS NULL OR label = ?) ORDER BY timestamp DESC LIMIT 1) '
+            'GROUP BY type, first_party ORDER BY 4 DESC', (theme, version, version, label, label))
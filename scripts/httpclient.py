@@ -0,0 +1,88 @@
+"""Shared HTTP client for every GTMetrix, WordPress.org and WP REST call.
+
+One requests.Session is kept for the whole run so connections are pooled and
+kept alive per host, every request gets a default timeout and idempotent
+requests are retried with jittered exponential backoff."""
+
+import random
+import threading
+from urlparse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+import tracing
+
+DEFAULT_TIMEOUT = (10, 60)  # (connect, read) seconds
+
+_session = None
+_settings = {}
+_lock = threading.Lock()
+
+
+class JitteredRetry(Retry):
+    """Retry whose backoff is drawn uniformly from [0, exponential backoff]
+    so parallel clients don't retry in lockstep"""
+
+    def get_backoff_time(self):
+        backoff = super(JitteredRetry, self).get_backoff_time()
+        if backoff <= 0:
+            return 0
+        return random.uniform(0, backoff)
+
+
+class TimeoutSession(requests.Session):
+    """requests.Session that applies a default timeout to every request"""
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT):
+        super(TimeoutSession, self).__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        parts = urlparse(url)
+        with tracing.span('http', method=method, host=parts.netloc, path=parts.path) as span:
+            r = super(TimeoutSession, self).request(method, url, **kwargs)
+            span.status = r.status_code
+            if kwargs.get('stream'):
+                # The body hasn't been read yet, count what was announced
+                span.bytes = int(r.headers.get('Content-Length') or 0)
+            else:
+                span.bytes = len(r.content)
+            return r
+
+
+def new_session(timeout=DEFAULT_TIMEOUT, retries=3, backoff_factor=0.5,
+                pool_hosts=10, pool_size=20):
+    """Build a pooled session, pool_size connections are kept per host"""
+
+    retry = JitteredRetry(
+        total=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=(429, 500, 502, 503, 504),
+        raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size,
+                          max_retries=retry)
+    session = TimeoutSession(timeout)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def configure(**settings):
+    """Set new_session arguments for the shared session, call before first use"""
+
+    global _session
+    with _lock:
+        _settings.update(settings)
+        _session = None
+
+
+def get_session():
+    """Return the process-wide pooled session, creating it on first use"""
+
+    global _session
+    with _lock:
+        if _session is None:
+            _session = new_session(**_settings)
+        return _session
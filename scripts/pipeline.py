@@ -0,0 +1,165 @@
+"""Resumable, streaming stage runner.
+
+Each theme flows through the stages independently: as soon as one stage
+finishes with a theme it is handed to the next stage's workers, so a site
+can be under test while others are still being provisioned. Every stage
+completion or failure is appended to a journal, and a resumed run skips the
+stages the journal already has as done for that theme and version."""
+
+import os
+import json
+import time
+import logging
+import threading
+import traceback
+from Queue import Queue, Empty, Full
+
+import tracing
+
+
+class Journal(object):
+    """Append-only JSON lines record of per-theme, per-stage outcomes"""
+
+    def __init__(self, filename, resume=False):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.done = set()
+        if resume and os.path.isfile(filename):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A torn last line from a crash
+                        continue
+                    key = (entry['slug'], entry['version'], entry['stage'])
+                    if entry['status'] == 'done':
+                        self.done.add(key)
+                    else:
+                        self.done.discard(key)
+        elif os.path.isfile(filename):
+            os.rename(filename, filename + '.prev')
+        self.out = open(filename, 'a')
+
+    def is_done(self, slug, version, stage):
+        return (slug, version, stage) in self.done
+
+    def record(self, slug, version, stage, status, **extra):
+        entry = dict(extra, slug=slug, version=version, stage=stage, status=status, time=time.time())
+        with self.lock:
+            self.out.write(json.dumps(entry) + '\n')
+            self.out.flush()
+            os.fsync(self.out.fileno())
+            if status == 'done':
+                self.done.add((slug, version, stage))
+
+    def close(self):
+        self.out.close()
+
+
+class Stage(object):
+    """A named step run by `workers` threads. func(theme) raises on failure."""
+
+    def __init__(self, name, func, workers=1):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+
+
+class Pipeline(object):
+
+    def __init__(self, stages, journal):
+        self.stages = stages
+        self.journal = journal
+        self.log = logging.getLogger('pipeline')
+
+    def run(self, themes, on_done=None):
+        """Push every theme through the stages, reading themes only as fast
+        as the first stage takes them. on_done(theme) is called for each theme
+        that gets through all of them. Returns a dict of (slug, version):
+        'done' or the name of the stage it failed in."""
+
+        # The first queue is bounded so a long listing isn't read in up front
+        queues = [Queue(self.stages[0].workers * 2)] + [Queue() for stage in self.stages[1:]]
+        finished = Queue()
+
+        def forward(index, theme):
+            """Hand theme to the first stage from index on that isn't done"""
+
+            while index < len(self.stages):
+                if not self.journal.is_done(theme['slug'], theme['version'], self.stages[index].name):
+                    while True:
+                        try:
+                            # Only the first queue fills up, the timeout keeps
+                            # the wait for it interruptible
+                            queues[index].put(theme, timeout=1)
+                            return
+                        except Full:
+                            continue
+                self.log.info('%s: %s already done, skipping' % (theme['slug'], self.stages[index].name))
+                index += 1
+            if on_done is not None:
+                on_done(theme)
+            finished.put(((theme['slug'], theme['version']), 'done'))
+
+        def worker(index):
+            stage = self.stages[index]
+            while True:
+                theme = queues[index].get()
+                if theme is None:
+                    return
+                # Anything but handing the theme on finishes it here, even
+                # if the journal can't be written
+                outcome = stage.name
+                try:
+                    started = time.time()
+                    try:
+                        with tracing.span('stage', stage=stage.name, theme=theme['slug']):
+                            stage.func(theme)
+                    except Exception:
+                        self.log.error('%s: %s failed\n%s' % (theme['slug'], stage.name, traceback.format_exc()))
+                        self.journal.record(theme['slug'], theme['version'], stage.name, 'failed',
+                                            duration=time.time() - started)
+                        continue
+                    self.journal.record(theme['slug'], theme['version'], stage.name, 'done',
+                                        duration=time.time() - started)
+                    self.log.info('%s: %s done' % (theme['slug'], stage.name))
+                    forward(index + 1, theme)
+                    outcome = None
+                except Exception:
+                    self.log.error('%s: recording %s failed\n%s' % (theme['slug'], stage.name,
+                                                                   traceback.format_exc()))
+                finally:
+                    if outcome is not None:
+                        finished.put(((theme['slug'], theme['version']), outcome))
+
+        threads = []
+        for index, stage in enumerate(self.stages):
+            for i in range(stage.workers):
+                thread = threading.Thread(target=worker, args=(index,), name='%s-%s' % (stage.name, i))
+                thread.daemon = True
+                thread.start()
+                threads.append((index, thread))
+
+        listed = set()
+        for theme in themes:
+            key = (theme['slug'], theme['version'])
+            if key in listed:
+                self.log.warning('%s %s: listed twice, running it once' % key)
+                continue
+            listed.add(key)
+            forward(0, theme)
+        outcome = {}
+        while len(outcome) < len(listed):
+            try:
+                # A timeout keeps the wait interruptible with Ctrl-C
+                key, status = finished.get(timeout=1)
+            except Empty:
+                continue
+            outcome[key] = status
+
+        for index, thread in threads:
+            queues[index].put(None)
+        for index, thread in threads:
+            thread.join()
+        return outcome
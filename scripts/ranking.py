@@ -0,0 +1,193 @@
+"""Catalogue-wide ranking of the latest test results.
+
+rank() takes a ResultStore snapshot and, in a few NumPy passes over every
+run, picks each theme's latest run and the latest run of its previous
+version, then computes per-metric percentile ranks against all themes, a
+weighted composite score and the change in each metric since the previous
+version. leaderboard() turns that into a JSON file keyed by theme slug,
+which the plugin's shortcodes read instead of working anything out per
+page view. Each theme's
+percentiles and deltas are lists in the order of the leaderboard's
+'metrics', which keeps the file small enough to decode on a page view with
+tens of thousands of themes in it."""
+
+import os
+import json
+import time
+
+import numpy as np
+
+
+# The metrics the report and rundown shortcodes show
+METRICS = [
+    'pagespeed_score', 'yslow_score', 'page_elements', 'page_bytes', 'html_bytes',
+    'page_load_time', 'fully_loaded_time', 'first_contentful_paint_time',
+    'dom_interactive_time', 'dom_content_loaded_duration', 'backend_duration', 'connect_duration',
+]
+
+# Scores are better high, everything else (times, bytes, counts) low
+HIGHER_IS_BETTER = set(['pagespeed_score', 'yslow_score'])
+
+COMPOSITE_WEIGHTS = {
+    'pagespeed_score': 2.0,
+    'yslow_score': 1.0,
+    'fully_loaded_time': 2.0,
+    'first_contentful_paint_time': 2.0,
+    'dom_interactive_time': 1.0,
+    'backend_duration': 1.0,
+    'page_bytes': 1.0,
+    'page_elements': 1.0,
+}
+
+
+def column(columns, name, dtype):
+    return np.frombuffer(columns[name], dtype=dtype)
+
+
+def last_per_group(groups):
+    """Positions of the last element of each run of equal values in the
+    sorted array groups"""
+
+    if not groups.size:
+        return groups.astype(np.intp)
+    return np.flatnonzero(np.r_[groups[1:] != groups[:-1], True])
+
+
+def percentile_ranks(values):
+    """Mid-rank percentile (0-100, higher is better) of every row in each
+    column of values against the rest of its column, NaN stays NaN. One
+    sort of all the columns at once, ties are found as runs of equal
+    values in it."""
+
+    n, k = values.shape
+    order = np.argsort(values, axis=0, kind='mergesort')
+    columns = np.arange(k)
+    ranked = values[order, columns]
+    positions = np.arange(n)[:, np.newaxis]
+    starts = np.ones(ranked.shape, dtype=bool)
+    starts[1:] = ranked[1:] != ranked[:-1]
+    ends = np.ones(ranked.shape, dtype=bool)
+    ends[:-1] = starts[1:]
+    first = np.maximum.accumulate(np.where(starts, positions, 0), axis=0)
+    last = np.minimum.accumulate(np.where(ends, positions, n)[::-1], axis=0)[::-1]
+    missing = np.isnan(values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ranked_percentiles = 100.0 * (first + 0.5 * (last - first + 1)) / (n - missing.sum(axis=0))
+    res = np.empty(values.shape)
+    res[order, columns] = ranked_percentiles
+    res[missing] = np.nan
+    return res
+
+
+def nullable(values, digits):
+    """Rows of values as lists for JSON, rounded, with None for NaN"""
+
+    return [[None if value != value else value for value in row] for row in np.round(values, digits).tolist()]
+
+
+def rank(snapshot, label, metrics=METRICS, weights=COMPOSITE_WEIGHTS):
+    """Rank every theme with a run under label in one pass over a
+    ResultStore.snapshot(). Returns a dict of arrays with one entry per
+    theme: the row of its latest run ('latest') and of its previous
+    version's ('previous', -1 for none), 'values', 'percentiles' and
+    'deltas' by metric, the composite 'score' and its 'rank' (1 is best)."""
+
+    columns, strings = snapshot
+    themes = column(columns, 'theme', np.intc)
+    versions = column(columns, 'version', np.intc)
+    if label in strings:
+        rows = np.flatnonzero(column(columns, 'label', np.intc) == strings.index(label))
+    else:
+        rows = np.zeros(0, dtype=np.intp)
+
+    # Every run under label by theme then time, the last of each theme is its
+    # latest. The store is normally in time order, and then a stable sort by
+    # theme keeps each theme's runs in time order.
+    timestamps = column(columns, 'timestamp', np.float64)
+    if np.all(timestamps[1:] >= timestamps[:-1]):
+        rows = rows[np.argsort(themes[rows], kind='mergesort')]
+    else:
+        rows = rows[np.lexsort((timestamps[rows], themes[rows]))]
+    theme_of_row = themes[rows]
+    group = np.cumsum(np.r_[0, theme_of_row[1:] != theme_of_row[:-1]]) if rows.size else rows
+    latest = rows[last_per_group(theme_of_row)]
+
+    # And the last run of any other version is the previous version's
+    older = np.flatnonzero(versions[rows] != versions[latest][group])
+    previous = np.full(latest.size, -1, dtype=np.intp)
+    ends = last_per_group(group[older])
+    previous[group[older][ends]] = rows[older][ends]
+    has_previous = previous >= 0
+
+    values = np.empty((latest.size, len(metrics)))
+    previous_values = np.full(values.shape, np.nan)
+    for j, name in enumerate(metrics):
+        metric = column(columns, name, np.float64)
+        values[:, j] = metric[latest]
+        previous_values[has_previous, j] = metric[previous[has_previous]]
+    sign = np.array([1.0 if name in HIGHER_IS_BETTER else -1.0 for name in metrics])
+    percentiles = percentile_ranks(values * sign)
+
+    w = np.array([weights.get(name, 0.0) for name in metrics])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        score = np.nansum(percentiles * w, axis=1) / (~np.isnan(percentiles) * w).sum(axis=1)
+
+    order = np.argsort(-np.where(np.isnan(score), -np.inf, score), kind='mergesort')
+    ranks = np.empty(latest.size, dtype=np.intp)
+    ranks[order] = np.arange(1, latest.size + 1)
+    return {
+        'latest': latest,
+        'previous': previous,
+        'values': values,
+        'percentiles': percentiles,
+        'deltas': values - previous_values,
+        'score': score,
+        'rank': ranks,
+        'order': order,
+    }
+
+
+def leaderboard(ranked, snapshot, label, metrics=METRICS):
+    """The JSON-ready leaderboard of a rank() result"""
+
+    columns, strings = snapshot
+    timestamps = column(columns, 'timestamp', np.float64)
+    themes = column(columns, 'theme', np.intc)
+    versions = column(columns, 'version', np.intc)
+    latest, previous = ranked['latest'], ranked['previous']
+    slugs = [strings[theme] for theme in themes[latest].tolist()]
+    res = {
+        'generated': time.time(),
+        'label': label,
+        'metrics': list(metrics),
+        'total': len(slugs),
+        'order': [slugs[i] for i in ranked['order'].tolist()],
+        'themes': {},
+    }
+    entries = zip(slugs, versions[latest].tolist(), timestamps[latest].tolist(), ranked['rank'].tolist(),
+                  nullable(ranked['score'][:, np.newaxis], 1), nullable(ranked['percentiles'], 1),
+                  previous.tolist(), nullable(ranked['deltas'], 2))
+    for slug, version, timestamp, position, score, percentiles, prev, deltas in entries:
+        entry = {
+            'rank': position,
+            'score': score[0],
+            'version': strings[version],
+            'timestamp': timestamp,
+            'percentiles': percentiles,
+        }
+        if prev >= 0:
+            entry['previous_version'] = strings[versions[prev]]
+            entry['deltas'] = deltas
+        res['themes'][slug] = entry
+    return res
+
+
+def save(leaderboard, filename):
+    """Write the leaderboard where the plugin reads it, atomically"""
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(filename + '.part', 'w') as f:
+        json.dump(leaderboard, f, separators=(',', ':'))
+    os.rename(filename + '.part', filename)
@@ -0,0 +1,213 @@
+"""Append-only columnar store for test result history.
+
+Every test run is one row: a timestamp, dictionary-encoded theme, version
+and label (which backend/profile produced it), and one float64 column per
+metric in METRICS. Each column is a flat binary file that is only ever
+appended to, so thousands of runs load in a few reads and range queries on
+the timestamp column are a bisect as long as runs were appended in time
+order."""
+
+import os
+import json
+import time
+import array
+import fcntl
+import bisect
+import threading
+from contextlib import contextmanager
+
+METRICS = [
+    'pagespeed_score', 'yslow_score', 'page_elements', 'html_bytes', 'page_bytes',
+    'page_load_time', 'fully_loaded_time', 'rum_speed_index', 'html_load_time',
+    'first_paint_time', 'dom_content_loaded_time', 'onload_time', 'backend_duration',
+    'onload_duration', 'connect_duration', 'first_contentful_paint_time',
+    'dom_content_loaded_duration', 'redirect_duration', 'dom_interactive_time',
+]
+
+KEY_COLUMNS = ['theme', 'version', 'label']
+NAN = float('nan')
+
+
+class ResultStore(object):
+    """Any number of threads and processes can append to and read one
+    store. An flock on the store's lock file serializes appends and keeps
+    readers from seeing half-appended rows, and each process picks up the
+    rows the others appended as it takes the lock."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock_filename = os.path.join(directory, 'lock')
+        self.strings_filename = os.path.join(directory, 'strings.json')
+        self.strings = []
+        self.string_ids = {}
+        self.strings_size = 0
+        # Whether timestamps never go down, so range queries can bisect
+        self.sorted = True
+        self.columns = {'timestamp': array.array('d')}
+        for name in KEY_COLUMNS:
+            self.columns[name] = array.array('i')
+        for name in METRICS:
+            self.columns[name] = array.array('d')
+        with self.locked(exclusive=True):
+            self.repair()
+            self.refresh()
+
+    @contextmanager
+    def locked(self, exclusive=False):
+        """Hold the thread lock and the file lock, shared for reading"""
+
+        with self.lock:
+            with open(self.lock_filename, 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def column_filename(self, name):
+        return os.path.join(self.directory, name + '.col')
+
+    def file_rows(self, name):
+        filename = self.column_filename(name)
+        if not os.path.isfile(filename):
+            return 0
+        return os.path.getsize(filename) // self.columns[name].itemsize
+
+    def repair(self):
+        """A crash mid-append can leave some column files a row ahead, or
+        part of a value at the end of one, drop it. Call with the file lock
+        held exclusively."""
+
+        rows = min(self.file_rows(name) for name in self.columns)
+        for name, column in self.columns.items():
+            filename = self.column_filename(name)
+            if os.path.isfile(filename) and os.path.getsize(filename) != rows * column.itemsize:
+                with open(filename, 'r+b') as f:
+                    f.truncate(rows * column.itemsize)
+
+    def refresh(self):
+        """Load the strings and rows appended since the last refresh, by this
+        or any other process. Call with the file lock held."""
+
+        if os.path.isfile(self.strings_filename):
+            size = os.path.getsize(self.strings_filename)
+            if size != self.strings_size:
+                with open(self.strings_filename) as f:
+                    self.strings = json.load(f)
+                self.string_ids = dict((s, i) for i, s in enumerate(self.strings))
+                self.strings_size = size
+        # Rows another process is halfway through appending don't count yet
+        rows = min(self.file_rows(name) for name in self.columns)
+        timestamps = self.columns['timestamp']
+        loaded = len(timestamps)
+        for name, column in self.columns.items():
+            if len(column) < rows:
+                with open(self.column_filename(name), 'rb') as f:
+                    f.seek(len(column) * column.itemsize)
+                    column.fromfile(f, rows - len(column))
+        for i in range(max(1, loaded), len(timestamps)):
+            if timestamps[i] < timestamps[i - 1]:
+                self.sorted = False
+                break
+
+    def __len__(self):
+        return len(self.columns['timestamp'])
+
+    def string_id(self, value):
+        """Dictionary-encode value, call with the file lock held exclusively"""
+
+        if value not in self.string_ids:
+            self.string_ids[value] = len(self.strings)
+            self.strings.append(value)
+            with open(self.strings_filename + '.part', 'w') as f:
+                json.dump(self.strings, f)
+            os.rename(self.strings_filename + '.part', self.strings_filename)
+            self.strings_size = os.path.getsize(self.strings_filename)
+        return self.string_ids[value]
+
+    def append(self, theme, version, timestamp, results, label=''):
+        """Add one run. results is a dict with any of the METRICS, anything
+        missing or non-numeric is stored as NaN. With timestamp None the run
+        is stamped with the time it is appended, which keeps the store in
+        time order. Returns the timestamp."""
+
+        with self.locked(exclusive=True):
+            self.repair()
+            self.refresh()
+            if timestamp is None:
+                timestamp = time.time()
+            row = {
+                'timestamp': float(timestamp),
+                'theme': self.string_id(theme),
+                'version': self.string_id(version or ''),
+                'label': self.string_id(label),
+            }
+            for name in METRICS:
+                try:
+                    row[name] = float(results.get(name))
+                except (TypeError, ValueError):
+                    row[name] = NAN
+            timestamps = self.columns['timestamp']
+            if timestamps and row['timestamp'] < timestamps[-1]:
+                self.sorted = False
+            for name, value in row.items():
+                column = self.columns[name]
+                column.append(value)
+                with open(self.column_filename(name), 'ab') as f:
+                    array.array(column.typecode, [value]).tofile(f)
+            return row['timestamp']
+
+    def query(self, theme=None, version=None, label=None, start=None, end=None, columns=None):
+        """Rows with start <= timestamp < end matching theme/version/label, as
+        a dict of column name -> list. Keys come back decoded."""
+
+        with self.locked():
+            self.refresh()
+            timestamps = self.columns['timestamp']
+            lo, hi = 0, len(timestamps)
+            if self.sorted:
+                if start is not None:
+                    lo = bisect.bisect_left(timestamps, start)
+                if end is not None:
+                    hi = bisect.bisect_left(timestamps, end)
+            filters = []
+            for name, value in (('theme', theme), ('version', version), ('label', label)):
+                if value is not None:
+                    if value not in self.string_ids:
+                        lo = hi
+                    else:
+                        filters.append((self.columns[name], self.string_ids[value]))
+            rows = [i for i in range(lo, hi) if all(column[i] == wanted for column, wanted in filters)]
+            if not self.sorted and (start is not None or end is not None):
+                rows = [i for i in rows if (start is None or timestamps[i] >= start) and
+                        (end is None or timestamps[i] < end)]
+            names = columns or ['timestamp'] + KEY_COLUMNS + METRICS
+            res = {}
+            for name in names:
+                column = self.columns[name]
+                if name in KEY_COLUMNS:
+                    res[name] = [self.strings[column[i]] for i in rows]
+                else:
+                    res[name] = [column[i] for i in rows]
+            return res
+
+    def snapshot(self, columns=None):
+        """Copies of the raw columns (keys still encoded) and the string
+        table, for bulk work outside the lock"""
+
+        with self.locked():
+            self.refresh()
+            names = columns or ['timestamp'] + KEY_COLUMNS + METRICS
+            return dict((name, self.columns[name][:]) for name in names), list(self.strings)
+
+    def latest(self, theme, label=None):
+        """The most recent run of a theme as a dict, or None"""
+
+        res = self.query(theme=theme, label=label)
+        if not res['timestamp']:
+            return None
+        newest = max(range(len(res['timestamp'])), key=res['timestamp'].__getitem__)
+        return dict((name, values[newest]) for name, values in res.items())
@@ -0,0 +1,167 @@
+"""Repeated-sample benchmarking and statistics.
+
+benchmark() warms each site and then takes N samples per theme through a
+test backend. Themes are sampled concurrently but each theme's samples run
+one after another so they don't compete with each other. Samples are
+reduced to median, p90, min and max per metric, and compare() uses a
+Mann-Whitney U test to say whether two sets of samples really differ."""
+
+import math
+import logging
+import traceback
+from multiprocessing.pool import ThreadPool
+
+import httpclient
+from resultstore import METRICS
+
+
+def percentile(values, p):
+    """Linearly interpolated percentile, p in [0, 100]"""
+
+    values = sorted(values)
+    if not values:
+        return None
+    k = (len(values) - 1) * p / 100.0
+    lo = int(math.floor(k))
+    hi = int(math.ceil(k))
+    if lo == hi:
+        return values[lo]
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+def numeric(samples, metric):
+    values = []
+    for sample in samples:
+        value = sample.get(metric)
+        if isinstance(value, (int, long, float)) and not isinstance(value, bool) and value == value:
+            values.append(value)
+    return values
+
+
+def summarize(samples, metrics=METRICS):
+    """Per metric median/p90/min/max of a list of results dicts"""
+
+    summary = {}
+    for metric in metrics:
+        values = numeric(samples, metric)
+        if not values:
+            continue
+        summary[metric] = {
+            'median': percentile(values, 50),
+            'p90': percentile(values, 90),
+            'min': min(values),
+            'max': max(values),
+            'n': len(values),
+        }
+    return summary
+
+
+def mann_whitney(a, b):
+    """Two-sided Mann-Whitney U test with the normal approximation and tie
+    correction, returns (U, p). Needs a handful of samples on each side to
+    mean much."""
+
+    n1, n2 = len(a), len(b)
+    if not n1 or not n2:
+        return None, 1.0
+    combined = sorted([(value, 0) for value in a] + [(value, 1) for value in b])
+    ranks = [0.0] * len(combined)
+    ties = 0.0
+    i = 0
+    while i < len(combined):
+        j = i
+        while j + 1 < len(combined) and combined[j + 1][0] == combined[i][0]:
+            j += 1
+        for k in range(i, j + 1):
+            ranks[k] = (i + j) / 2.0 + 1
+        t = j - i + 1
+        ties += t ** 3 - t
+        i = j + 1
+    r1 = sum(rank for rank, (value, group) in zip(ranks, combined) if group == 0)
+    u1 = r1 - n1 * (n1 + 1) / 2.0
+    u = min(u1, n1 * n2 - u1)
+    n = n1 + n2
+    sigma = math.sqrt(n1 * n2 / 12.0 * ((n + 1) - ties / (n * (n - 1))))
+    if sigma == 0:
+        return u, 1.0
+    z = (abs(u1 - n1 * n2 / 2.0) - 0.5) / sigma
+    return u, min(1.0, math.erfc(max(z, 0) / math.sqrt(2)))
+
+
+def compare(samples_a, samples_b, metrics=METRICS, alpha=0.05):
+    """Compare two lists of results dicts metric by metric"""
+
+    res = {}
+    for metric in metrics:
+        a = numeric(samples_a, metric)
+        b = numeric(samples_b, metric)
+        if not a or not b:
+            continue
+        u, p = mann_whitney(a, b)
+        median_a = percentile(a, 50)
+        median_b = percentile(b, 50)
+        res[metric] = {
+            'median_a': median_a,
+            'median_b': median_b,
+            'change': median_b - median_a,
+            'change_pct': (median_b - median_a) * 100.0 / median_a if median_a else None,
+            'u': u,
+            'p': p,
+            'significant': p < alpha,
+        }
+    return res
+
+
+def benchmark(backend, tests, samples=5, warmup=1, concurrency=4, on_sample=None):
+    """Take `samples` results from backend for each (key, url) in tests.
+
+    Returns {key: {'samples': [data, ...], 'summary': {...}}}. on_sample(key,
+    data) is called for every sample as it is taken."""
+
+    log = logging.getLogger('sampling')
+
+    def sample_site(test):
+        key, url = test
+        for i in range(warmup):
+            try:
+                httpclient.get_session().get(url).content
+            except Exception as e:
+                log.warning('%s: warmup request failed: %s' % (key, e))
+        taken = []
+        for i in range(samples):
+            results = backend.run([(key, url)])
+            if key not in results:
+                log.warning('%s: sample %s/%s failed' % (key, i + 1, samples))
+                continue
+            log.info('%s: sample %s/%s done' % (key, i + 1, samples))
+            taken.append(results[key])
+            if on_sample:
+                try:
+                    on_sample(key, results[key])
+                except Exception:
+                    log.error('%s: storing sample failed\n%s' % (key, traceback.format_exc()))
+        return key, taken
+
+    res = {}
+    pool = ThreadPool(max(1, min(concurrency, len(tests))))
+    try:
+        for key, taken in pool.imap_unordered(sample_site, tests):
+            res[key] = {
+                'samples': taken,
+                'summary': summarize([data['results'] for data in taken]),
+            }
+    finally:
+        pool.close()
+        pool.join()
+    return res
+
+
+def median_result(benchmarked):
+    """A single test result for publishing: the median of every metric,
+    with the other fields taken from the last sample"""
+
+    data = dict(benchmarked['samples'][-1])
+    data['results'] = dict(data['results'])
+    for metric, stats in benchmarked['summary'].items():
+        data['results'][metric] = stats['median']
+    return data
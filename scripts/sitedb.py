@@ -0,0 +1,150 @@
+"""Direct access to the shared test site database through the mysql client.
+
+Used for the bulk table work wp-cli can't do in one call, like cloning or
+dropping every table that belongs to a prefix."""
+
+import os
+import logging
+import tempfile
+import subprocess
+
+import tracing
+
+
+def like_escape(value):
+    """Escape a table prefix for use in a LIKE pattern"""
+
+    return value.replace('\\', '\\\\').replace('_', '\\_').replace('%', '\\%')
+
+
+def quote_name(name):
+    return '`%s`' % name.replace('`', '``')
+
+
+def quote_value(value):
+    if value is None:
+        return 'NULL'
+    if isinstance(value, (int, long, float)):
+        return str(value)
+    return "'%s'" % value.replace('\\', '\\\\').replace("'", "\\'")
+
+
+def insert_statements(table, columns, rows, batch_size=1000, max_bytes=1024 * 1024):
+    """Multi-row INSERT statements for rows, up to batch_size rows and about
+    max_bytes (to stay under max_allowed_packet) per statement"""
+
+    head = 'INSERT INTO %s (%s) VALUES ' % (quote_name(table), ', '.join(quote_name(c) for c in columns))
+    batch = []
+    size = 0
+    for row in rows:
+        values = '(%s)' % ', '.join(quote_value(value) for value in row)
+        if batch and (len(batch) >= batch_size or size + len(values) > max_bytes):
+            yield head + ',\n'.join(batch) + ';\n'
+            batch = []
+            size = 0
+        batch.append(values)
+        size += len(values) + 2
+    if batch:
+        yield head + ',\n'.join(batch) + ';\n'
+
+
+class SiteDB(object):
+    """Runs SQL against the test site database with the mysql client"""
+
+    def __init__(self, dbhost, dbname, dbuser, dbpass, mysql_path='mysql', dry_run=False):
+        self.dbhost = dbhost
+        self.dbname = dbname
+        self.dbuser = dbuser
+        self.dbpass = dbpass
+        self.mysql_path = mysql_path
+        self.dry_run = dry_run
+        self.log = logging.getLogger('sitedb')
+
+    @classmethod
+    def from_config(cls, config, dry_run=False):
+        return cls(config['dbhost'], config['dbname'], config['dbuser'], config['dbpass'],
+                   config.get('mysql_path', 'mysql'), dry_run)
+
+    def query(self, sql):
+        """Run one or more statements, returns the result rows as tuples"""
+
+        self.log.debug('SQL: %s' % sql[:500])
+        if self.dry_run:
+            self.log.info('Dry run, not executing %s bytes of SQL' % len(sql))
+            return []
+        if isinstance(sql, unicode):
+            sql = sql.encode('utf-8')
+        env = dict(os.environ, MYSQL_PWD=self.dbpass)
+        with tracing.span('mysql', statement=sql.split(None, 1)[0].upper() if sql.strip() else '') as span:
+            proc = subprocess.Popen(
+                [self.mysql_path, '--batch', '--skip-column-names', '--default-character-set=utf8mb4',
+                 '--host=%s' % self.dbhost, '--user=%s' % self.dbuser, self.dbname],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+            out, err = proc.communicate(sql)
+            span.bytes = len(sql) + len(out)
+            span.status = proc.returncode
+            span.error = proc.returncode != 0
+        if proc.returncode != 0:
+            raise RuntimeError('mysql exited with %s: %s' % (proc.returncode, err.strip()))
+        return [tuple(line.split('\t')) for line in out.splitlines()]
+
+    def load(self, statements):
+        """Stream statements into a single mysql session as one transaction,
+        with the per-row checks a bulk load doesn't need turned off. Returns
+        the number of statements sent."""
+
+        if self.dry_run:
+            count = sum(1 for statement in statements)
+            self.log.info('Dry run, not loading %s statements' % count)
+            return count
+        env = dict(os.environ, MYSQL_PWD=self.dbpass)
+        count = 0
+        with tracing.span('mysql', statement='LOAD') as span, tempfile.TemporaryFile() as errors:
+            proc = subprocess.Popen(
+                [self.mysql_path, '--batch', '--default-character-set=utf8mb4',
+                 '--host=%s' % self.dbhost, '--user=%s' % self.dbuser, self.dbname],
+                stdin=subprocess.PIPE, stdout=errors, stderr=errors, env=env)
+            try:
+                proc.stdin.write('SET autocommit=0, unique_checks=0, foreign_key_checks=0;\n')
+                for statement in statements:
+                    if isinstance(statement, unicode):
+                        statement = statement.encode('utf-8')
+                    proc.stdin.write(statement)
+                    span.bytes += len(statement)
+                    count += 1
+                proc.stdin.write('COMMIT;\n')
+            except IOError:
+                # mysql quit early, its exit status and output say why
+                pass
+            finally:
+                try:
+                    proc.stdin.close()
+                except IOError:
+                    pass
+                proc.wait()
+            span.status = proc.returncode
+            span.error = proc.returncode != 0
+            if proc.returncode != 0:
+                errors.seek(0)
+                raise RuntimeError('mysql exited with %s: %s' % (proc.returncode, errors.read()[-2000:].strip()))
+        self.log.debug('Loaded %s statements' % count)
+        return count
+
+    def tables(self, prefix=None):
+        """Every table in the database, or those that start with prefix"""
+
+        if prefix is None:
+            return [row[0] for row in self.query('SHOW TABLES;')]
+        rows = self.query("SHOW TABLES LIKE '%s%%';" % like_escape(prefix))
+        return [row[0] for row in rows]
+
+    def drop_prefixes(self, prefixes):
+        """Drop the tables of many prefixes with one listing and one DROP"""
+
+        prefixes = tuple(prefixes)
+        if not prefixes:
+            return []
+        tables = [t for t in self.tables() if t.startswith(prefixes)]
+        if tables:
+            self.query('DROP TABLE IF EXISTS %s;' % ', '.join(quote_name(t) for t in tables))
+        return tables
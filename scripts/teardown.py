@@ -0,0 +1,174 @@
+"""Tracking and teardown of provisioned test sites.
+
+generate_sites records every site it creates in a manifest: its directory,
+table prefix and uploads directory. Teardown drops the tables of all the
+sites being removed in one statement, and moves their directories into a
+trash directory on the same filesystem, which is a rename and frees the
+path straight away. The trash is then emptied by a pool of threads in the
+background while the run carries on."""
+
+import os
+import json
+import time
+import shutil
+import logging
+import tempfile
+import threading
+import traceback
+from multiprocessing.pool import ThreadPool
+
+TRASH_DIR = '.themetest-trash'
+
+
+class SiteManifest(object):
+    """JSON record of the sites that exist, keyed by instance name"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.sites = {}
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                self.sites = json.load(f)
+
+    def __len__(self):
+        return len(self.sites)
+
+    def save(self):
+        """Write the manifest atomically, call with self.lock held"""
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.filename)), suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.sites, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.filename)
+
+    def add(self, name, path, prefix, url=None, uploads=None):
+        """Record a site before it is built, so half-built ones are cleaned
+        up too"""
+
+        with self.lock:
+            self.sites[name] = {
+                'path': os.path.abspath(path),
+                'prefix': prefix,
+                'url': url,
+                'uploads': os.path.abspath(uploads or os.path.join(path, 'wp-content', 'uploads')),
+                'created': time.time(),
+            }
+            self.save()
+
+    def remove(self, names):
+        with self.lock:
+            for name in names:
+                self.sites.pop(name, None)
+            self.save()
+
+
+class Teardown(object):
+    """Removes sites: tables in one batch, trees renamed to the trash and
+    deleted concurrently in the background"""
+
+    def __init__(self, db, trash_dir, workers=4, dry_run=False):
+        self.db = db
+        self.trash_dir = trash_dir
+        self.workers = max(1, workers)
+        self.dry_run = dry_run
+        # One background reclaimer at a time, reclaim() while it runs has it
+        # look at the trash again once it is through
+        self.lock = threading.Lock()
+        self.reclaimer = None
+        self.rescan = False
+        self.log = logging.getLogger('teardown')
+
+    def trash(self, path):
+        """Move path into the trash, returns where it went or None"""
+
+        if not os.path.lexists(path):
+            return None
+        if self.dry_run:
+            self.log.info('Dry run, not deleting %s' % path)
+            return None
+        try:
+            # Held so the reclaimer doesn't list the directory before the rename
+            with self.lock:
+                if not os.path.isdir(self.trash_dir):
+                    os.makedirs(self.trash_dir)
+                target = os.path.join(tempfile.mkdtemp(
+                    dir=self.trash_dir, prefix=os.path.basename(path.rstrip('/')) + '.'), 'tree')
+                os.rename(path, target)
+        except OSError:
+            # Another filesystem, delete it in place instead
+            self.log.debug('Cannot rename %s into the trash, deleting it now' % path)
+            self.remove(path)
+            return None
+        self.log.info('Moved %s to the trash' % path)
+        return target
+
+    def remove(self, path):
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+        except OSError:
+            self.log.error('Could not delete %s\n%s' % (path, traceback.format_exc()))
+        return path
+
+    def reclaim(self):
+        """Empty the trash with a pool of threads in the background, wait()
+        blocks until it is done. Never blocks itself, so it can be called
+        from any thread."""
+
+        if self.dry_run:
+            return
+        with self.lock:
+            self.rescan = True
+            if self.reclaimer is None:
+                self.reclaimer = threading.Thread(target=self.empty_trash, name='reclaim')
+                self.reclaimer.daemon = True
+                self.reclaimer.start()
+
+    def empty_trash(self):
+        """The reclaimer thread: delete what is in the trash until a scan
+        finds nothing new was asked for"""
+
+        while True:
+            with self.lock:
+                if not self.rescan or not os.path.isdir(self.trash_dir):
+                    self.reclaimer = None
+                    return
+                self.rescan = False
+                entries = [os.path.join(self.trash_dir, name) for name in os.listdir(self.trash_dir)]
+            if not entries:
+                continue
+            started = time.time()
+            pool = ThreadPool(min(self.workers, len(entries)))
+            try:
+                for path in pool.imap_unordered(self.remove, entries):
+                    self.log.debug('Deleted %s' % path)
+            finally:
+                pool.close()
+                pool.join()
+            self.log.info('Reclaimed %s trashed directories in %.1fs' % (len(entries), time.time() - started))
+
+    def wait(self):
+        while True:
+            with self.lock:
+                reclaimer = self.reclaimer
+            if reclaimer is None:
+                return
+            reclaimer.join()
+
+    def teardown(self, sites):
+        """Remove sites, a list of manifest entries. Returns the tables
+        dropped. Disk space is reclaimed in the background."""
+
+        prefixes = [site['prefix'] for site in sites if site.get('prefix')]
+        tables = self.db.drop_prefixes(prefixes)
+        self.log.info('Dropped %s tables for %s prefixes' % (len(tables), len(prefixes)))
+        for site in sites:
+            self.trash(site['path'])
+            uploads = site.get('uploads')
+            if uploads and not uploads.startswith(os.path.join(site['path'], '')):
+                self.trash(uploads)
+        self.reclaim()
+        return tables
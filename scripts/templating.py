@@ -0,0 +1,59 @@
+"""Cached Jinja template rendering.
+
+One Environment is kept per template directory for the life of the
+process, so each template is compiled once. Compiled bytecode is also kept
+on disk to save recompiling on the next run, and a template is reloaded only
+when its file changes. HTML and XML templates are autoescaped."""
+
+import os
+import threading
+
+import jinja2
+
+# Compiled templates kept in memory per environment
+CACHE_SIZE = 1000
+
+_environments = {}
+_lock = threading.Lock()
+
+
+def environment(search_path, cache_dir=None):
+    """The shared Environment for templates under search_path. DebugUndefined
+    leaves undefined variables in place."""
+
+    search_path = os.path.abspath(search_path)
+    with _lock:
+        if search_path not in _environments:
+            bytecode_cache = None
+            if cache_dir:
+                if not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                bytecode_cache = jinja2.FileSystemBytecodeCache(cache_dir)
+            _environments[search_path] = jinja2.Environment(
+                loader=jinja2.FileSystemLoader(search_path),
+                undefined=jinja2.DebugUndefined,
+                autoescape=jinja2.select_autoescape(['html', 'htm', 'xml']),
+                bytecode_cache=bytecode_cache,
+                cache_size=CACHE_SIZE,
+                auto_reload=True)
+        return _environments[search_path]
+
+
+def template(tpl_path, cache_dir=None):
+    path, filename = os.path.split(tpl_path)
+    return environment(path or './', cache_dir).get_template(filename)
+
+
+def render(tpl_path, cache_dir=None, **context):
+    """Render a template file to a unicode string"""
+
+    return template(tpl_path, cache_dir).render(**context)
+
+
+def render_to_file(tpl_path, dest, cache_dir=None, **context):
+    """Stream a rendered template to dest without building the whole output
+    in memory. The file is written next to dest and renamed into place."""
+
+    template(tpl_path, cache_dir).stream(**context).dump(dest + '.part', encoding='utf-8')
+    os.rename(dest + '.part', dest)
+    return dest
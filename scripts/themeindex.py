@@ -0,0 +1,65 @@
+"""Persistent index of theme version fingerprints for detect_new.
+
+Maps slug -> {version, last_updated, link_hash} for every theme that has
+been through the pipeline, so a fresh catalogue listing can be reduced to
+exactly the themes that are new or have changed since they were tested."""
+
+import os
+import json
+import hashlib
+import tempfile
+
+
+def download_link(theme):
+    if theme.get('download_link'):
+        return theme['download_link']
+    return theme.get('versions', {}).get(theme.get('version'), '')
+
+
+def fingerprint(theme):
+    return {
+        'version': theme.get('version'),
+        'last_updated': theme.get('last_updated'),
+        'link_hash': hashlib.sha1(download_link(theme).encode('utf-8')).hexdigest(),
+    }
+
+
+class ThemeIndex(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.themes = {}
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                self.themes = json.load(f)
+
+    def __len__(self):
+        return len(self.themes)
+
+    def diff(self, themes):
+        """Split a theme listing into (new, changed, removed). new and changed
+        are lists of theme dicts, removed is the slugs no longer listed."""
+
+        new = []
+        changed = []
+        listed = set()
+        for theme in themes:
+            listed.add(theme['slug'])
+            known = self.themes.get(theme['slug'])
+            if known is None:
+                new.append(theme)
+            elif known != fingerprint(theme):
+                changed.append(theme)
+        removed = [slug for slug in self.themes if slug not in listed]
+        return new, changed, removed
+
+    def update(self, themes):
+        for theme in themes:
+            self.themes[theme['slug']] = fingerprint(theme)
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.themes, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.filename)
@@ -2,115 +2,327 @@
 
 import os
 import sys
-# Load in the virtualenv
-activate_this = os.path.abspath(os.path.dirname(sys.argv[0])) + "/env/bin/activate_this.py"
-execfile(activate_this, dict(__file__=activate_this))
-
-from pipes import quote
 import traceback
 import argparse
-import time
-import requests
 import datetime
 import json
-from requests.auth import HTTPBasicAuth
-import jinja2
+import socket
 import logging
 import subprocess
 import shutil
-from local_settings import THEMETEST_CONFIG
+import tempfile
+import zipfile
+import threading
+import functools
+import importlib
+from multiprocessing.pool import ThreadPool
+import wpworker
+import sitedb
+import golden
+import themeindex
+import resultstore
+import pipeline
+import teardown
+import content
+import assets
+import workqueue
+import tracing
 
 # coding=utf8
 
-# Define where the test sites are installed and what URL to use to reach them
-testsite_basedir = THEMETEST_CONFIG['testsite_basedir']
-testsite_baseurl = THEMETEST_CONFIG['testsite_baseurl']
-images_path = THEMETEST_CONFIG['images_path']
+
+class LazyModule(object):
+    """Stands in for a module and imports it the first time it is used, so
+    actions that never touch HTTP, Jinja or Pillow don't pay to load them"""
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+        self.__dict__['_lock'] = threading.Lock()
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self.__dict__['_module'] = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+requests = LazyModule('requests')
+httpclient = LazyModule('httpclient')
+gtscheduler = LazyModule('gtscheduler')
+artifactcache = LazyModule('artifactcache')
+catalogue = LazyModule('catalogue')
+backends = LazyModule('backends')
+sampling = LazyModule('sampling')
+images = LazyModule('images')
+templating = LazyModule('templating')
+har = LazyModule('har')
+ranking = LazyModule('ranking')
+
+# Settings from local_settings.py, see load_config()
+THEMETEST_CONFIG = {}
+
+# Where the test sites are installed and what URL to use to reach them
+testsite_basedir = None
+testsite_baseurl = None
+images_path = None
 
 # The Target WordPress instance to create posts on
-wp_path = THEMETEST_CONFIG['wp_path']
+wp_path = None
+
+# Shared download cache, see artifact_cache()
+_artifact_cache = None
+_artifact_cache_lock = threading.Lock()
 
-with open('.gtcredentials') as f:
-    gtmetrix_api_username, gtmetrix_api_password = f.readline().split(":")
+# Test result history, see result_store()
+_result_store = None
+_result_store_lock = threading.Lock()
 
+# Per-resource index of every run's HAR, see har_index()
+_har_index = None
+_har_index_lock = threading.Lock()
+
+# Sites generate_sites has made and their removal, see site_manifest()
+_site_manifest = None
+_site_teardown = None
+_teardown_lock = threading.Lock()
+
+# GTMetrix API credentials, see gtmetrix_credentials()
+_gtmetrix_credentials = None
+
+# Stage names of pipeline_stages(), for queueing jobs without building them
+PIPELINE_STAGES = ['provision', 'test', 'publish']
+
+# Theme sites are cloned from this site when --golden is used
+GOLDEN_INSTANCE = '_golden'
+GOLDEN_PREFIX = 'golden_'
+
+# Theme packages analyze_assets downloads before analyzing them, a batch
+# has to fit in the download cache
+ASSET_BATCH_SIZE = 50
+
+# Parsed command line, set by cli()
+args = None
+
+# This host's name while running queued jobs, see work()
+_queue_host = None
 
 # Change this to logging.INFO to reduce the noise on the screen once everything is running nicely
 screen_logging_level = logging.INFO
-log_filename = __file__ + '.log'
+log_filename = os.path.abspath(__file__) + '.log'
 log_file_format = '%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
 log_screen_format = log_file_format
 
-# Logging setup
-logging.basicConfig(level=logging.DEBUG,
-                    format=log_file_format,
-                    datefmt='%Y-%m-%d %H:%M:%S',
-                    filename=log_filename)
-# define a Handler which writes INFO messages or higher to the sys.stderr
-console = logging.StreamHandler()
-console.setLevel(screen_logging_level)
-# set a format which is simpler for console use
-formatter = logging.Formatter(log_screen_format, datefmt='%Y-%m-%d %H:%M:%S')
-# tell the handler to use this format
-console.setFormatter(formatter)
-# add the handler to the root logger
-logging.getLogger('').addHandler(console)
-
-parser = argparse.ArgumentParser(
-    description="""A script to do several things:
-    Read a list of featured themes from a JSON file
-    Automatically install them
-    Test them with GTMetrix
-    Publish the results to WordPress
-
-    Neat eh?""")
-
-parser.add_argument(
-    '--dry_run', 
-    action='store_true',
-    help='perform a dry run (make no external calls) (default: true)')
-
-parser.add_argument(
-    'test_action',
-    choices=['get_featured', 'generate_sites', 'test_gt', 'post_pages', 'cleanup', 'rundown', 'auto', 'detect_new'],
-    help='Which part of the process to perform, or auto for fully automated operation.')
-
-args = parser.parse_args()
-logging.info('Started %s' % __file__)
-if args.dry_run:
-    print("Dry run %s" % args.test_action)
-else:
-    print("Real run %s" % args.test_action)
-
-@jinja2.contextfunction
-def get_context(c):
-    return c
+# Every option and the actions that take it. Options also work before the
+# action, the way they had to be given before actions were subcommands.
+OPTIONS = [
+    ('dry_run', dict(
+        action='store_true',
+        help='perform a dry run (make no external calls) (default: false)')),
+    ('workers', dict(
+        type=int, default=1,
+        help='number of sites to provision in parallel for generate_sites/auto (default: 1)')),
+    ('golden', dict(
+        action='store_true',
+        help='clone each theme site from one pre-imported golden site instead of installing it from scratch')),
+    ('gt_concurrency', dict(
+        type=int, default=2,
+        help='number of GTMetrix tests to keep queued at once, or local tests to run at once (default: 2)')),
+    ('backend', dict(
+        choices=['gtmetrix', 'local'], default='gtmetrix',
+        help='test with GTMetrix or the local page tester (default: gtmetrix)')),
+    ('resume', dict(
+        action='store_true',
+        help='skip the per-theme stages the last auto/detect_new run already finished')),
+    ('samples', dict(
+        type=int, default=1,
+        help='test each theme this many times and publish the median of each metric (default: 1)')),
+    ('warmup', dict(
+        type=int, default=1,
+        help='requests made to warm each site before taking samples (default: 1)')),
+    ('slug', dict(
+        help='theme to compare with the compare action')),
+    ('versions', dict(
+        help='two versions to compare with the compare action, e.g. 1.0.2,1.0.3')),
+    ('themes', dict(
+        default='',
+        help='theme list to use instead of fetching featured themes, a .json or get_catalogue .jsonl file')),
+    ('browse', dict(
+        choices=['featured', 'new', 'updated', 'popular'], default='featured',
+        help='catalogue segment to fetch with get_catalogue (default: featured)')),
+    ('content', dict(
+        default='',
+        help='comma separated content profiles (small, medium, large or content_profiles from the config) '
+             'to load into each site and test at in turn, the first is published (default: import testdata.xml)')),
+    ('queue', dict(
+        default='../data/workqueue.sqlite',
+        help='SQLite work queue shared by coordinate and work (default: ../data/workqueue.sqlite)')),
+    ('lease', dict(
+        type=int, default=900,
+        help='seconds a worker holds a job without a heartbeat before it is requeued (default: 900)')),
+    ('tag', dict(
+        help='fetch themes with this tag with get_catalogue')),
+    ('search', dict(
+        help='fetch themes matching this search with get_catalogue')),
+    ('resource', dict(
+        choices=['js', 'css', 'font', 'image', 'html', 'other'], default='js',
+        help='resource type to rank themes by with har_report (default: js)')),
+]
+
+PIPELINE_OPTIONS = ['workers', 'golden', 'gt_concurrency', 'backend', 'resume', 'samples', 'warmup', 'content']
+
+ACTIONS = [
+    ('get_featured', 'fetch the featured themes list from WordPress.org', []),
+    ('get_catalogue', 'fetch a catalogue segment, tag or search from WordPress.org',
+     ['workers', 'browse', 'tag', 'search']),
+    ('generate_sites', 'install a test site for every theme', ['themes', 'workers', 'golden', 'content']),
+    ('test_gt', 'test every theme site',
+     ['themes', 'workers', 'gt_concurrency', 'backend', 'samples', 'warmup', 'content']),
+    ('post_pages', 'publish the saved test results', ['themes']),
+    ('cleanup', 'tear down every test site', ['workers']),
+    ('rundown', 'post a rundown of the published results', []),
+    ('auto', 'provision, test and publish every theme, then post a rundown', ['themes'] + PIPELINE_OPTIONS),
+    ('detect_new', 'run auto on the featured themes that are new or changed since the last run',
+     PIPELINE_OPTIONS),
+    ('coordinate', 'queue every theme for work on any number of hosts, then post a rundown',
+     ['themes', 'resume', 'queue', 'lease', 'backend', 'content']),
+    ('work', 'run queued jobs on this host until the queue is drained', PIPELINE_OPTIONS + ['queue', 'lease']),
+    ('analyze_assets', 'statically analyze the packages of every theme in a theme list or catalogue',
+     ['themes', 'workers']),
+    ('compare', 'compare the stored results of two versions of a theme', ['slug', 'versions', 'backend']),
+    ('rank', 'rank every theme\'s latest published results and save the leaderboard the plugin reads',
+     ['backend', 'content']),
+    ('har_report', 'rank themes by the third-party resources they load, or break down one theme with --slug',
+     ['resource', 'slug']),
+]
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="""A script to do several things:
+        Read a list of featured themes from a JSON file
+        Automatically install them
+        Test them with GTMetrix
+        Publish the results to WordPress
+
+        Neat eh?""")
+    options = dict(OPTIONS)
+    for name, option in OPTIONS:
+        parser.add_argument('--' + name, **option)
+    subparsers = parser.add_subparsers(
+        dest='test_action', metavar='action',
+        help='Which part of the process to perform, or auto for fully automated operation: %s' % (
+            ', '.join(action for action, help_text, names in ACTIONS)))
+    for action, help_text, names in ACTIONS:
+        subparser = subparsers.add_parser(action, help=help_text, description=help_text)
+        for name in ['dry_run'] + names:
+            # SUPPRESS keeps an option given before the action from being reset
+            subparser.add_argument('--' + name, **dict(options[name], default=argparse.SUPPRESS))
+    return parser
+
+
+def setup_logging():
+    """Log everything to the log file and INFO and up to the console"""
+
+    logging.basicConfig(level=logging.DEBUG,
+                        format=log_file_format,
+                        datefmt='%Y-%m-%d %H:%M:%S',
+                        filename=log_filename)
+    # define a Handler which writes INFO messages or higher to the sys.stderr
+    console = logging.StreamHandler()
+    console.setLevel(screen_logging_level)
+    # set a format which is simpler for console use
+    formatter = logging.Formatter(log_screen_format, datefmt='%Y-%m-%d %H:%M:%S')
+    # tell the handler to use this format
+    console.setFormatter(formatter)
+    # add the handler to the root logger
+    logging.getLogger('').addHandler(console)
+
+
+def load_config():
+    """Read local_settings.py, the module can be imported without it"""
+
+    global THEMETEST_CONFIG, testsite_basedir, testsite_baseurl, images_path, wp_path
+    from local_settings import THEMETEST_CONFIG
+    testsite_basedir = THEMETEST_CONFIG['testsite_basedir']
+    testsite_baseurl = THEMETEST_CONFIG['testsite_baseurl']
+    images_path = THEMETEST_CONFIG['images_path']
+    wp_path = THEMETEST_CONFIG['wp_path']
+
+
+def configure_http():
+    """Set up the shared HTTP session every module uses, before any of them
+    makes a request"""
+
+    httpclient.configure(
+        timeout=THEMETEST_CONFIG.get('http_timeout', httpclient.DEFAULT_TIMEOUT),
+        retries=THEMETEST_CONFIG.get('http_retries', 3),
+        pool_size=max(10, args.workers, args.gt_concurrency))
+
+
+def activate_virtualenv():
+    """Load in the virtualenv next to the script, if there is one"""
+
+    activate_this = os.path.abspath(os.path.dirname(sys.argv[0])) + "/env/bin/activate_this.py"
+    if os.path.isfile(activate_this):
+        execfile(activate_this, dict(__file__=activate_this))
+
+
+def gtmetrix_credentials():
+    """(username, password) from .gtcredentials, read when first needed"""
+
+    global _gtmetrix_credentials
+    if _gtmetrix_credentials is None:
+        with open('.gtcredentials') as f:
+            username, password = f.readline().strip().split(":", 1)
+        _gtmetrix_credentials = (username, password)
+    return _gtmetrix_credentials
+
+
+def last_run_date():
+    """The day detect_new last started a test run as YYYYMMDD, '' if never"""
+
+    if not os.path.isfile('.lastrun'):
+        return ''
+    with open('.lastrun') as f:
+        return f.readline()
+
+
+def template_cache_dir():
+    return os.path.join(THEMETEST_CONFIG.get('cache_dir', '../cache'), 'jinja')
+
 
 def render(tpl_path, context):
     """ Standard Jinja render function, DebugUndefined leaves undefined 
-    variables in place."""
+    variables in place. Templates are compiled once and cached."""
 
-    path, filename = os.path.split(tpl_path)
-    return jinja2.Environment(
-        undefined=jinja2.DebugUndefined,
-        loader=jinja2.FileSystemLoader(path or './')
-    ).get_template(filename).render(context=context)
+    return templating.render(tpl_path, template_cache_dir(), context=context, **context)
+
+
+def render_to_file(tpl_path, dest, context):
+    """Like render() but streams the output to dest"""
+
+    return templating.render_to_file(tpl_path, dest, template_cache_dir(), context=context, **context)
 
 
 def load_theme_data(filename=''):
-    """This loads the theme data from a JSON formatted list like from 
-    api.wordpress.org"""
+    """This yields the themes from a JSON formatted list like from 
+    api.wordpress.org, or a .jsonl catalogue saved by get_catalogue which
+    is read from disk as it is iterated. Wrap it in list() to go over the
+    themes more than once."""
 
     if filename == '':
         filename = '../tmp/featured.json'
-	data = get_featured(filename)
+        data = get_featured(filename)
+    elif filename.endswith('.jsonl'):
+        data = {'themes': catalogue.CatalogueStore(filename)}
     else:
         with open(filename, "r") as f:
-	    data = json.load(f)       
-    goodthemes = []
+            data = json.load(f)
     for theme in data['themes']:
         if theme['slug'] != 'twentyseventeen':
-            goodthemes.append(theme)
-    return goodthemes
+            yield theme
 
 
 def load_gtmetrix_data(wp_instance_name):
@@ -122,93 +334,341 @@ def load_gtmetrix_data(wp_instance_name):
     return data
 
 
-def generate_sites(themedata):
+def site_db():
+    """Direct access to the shared test site database"""
+
+    return sitedb.SiteDB.from_config(THEMETEST_CONFIG, dry_run=args.dry_run)
+
+
+def artifact_cache():
+    """The shared download cache, created on first use"""
+
+    global _artifact_cache
+    with _artifact_cache_lock:
+        if _artifact_cache is None:
+            _artifact_cache = artifactcache.ArtifactCache(
+                THEMETEST_CONFIG.get('cache_dir', '../cache'),
+                THEMETEST_CONFIG.get('cache_max_bytes', artifactcache.DEFAULT_MAX_BYTES))
+        return _artifact_cache
+
+
+def result_store():
+    """The test result history, opened on first use"""
+
+    global _result_store
+    with _result_store_lock:
+        if _result_store is None:
+            _result_store = resultstore.ResultStore(THEMETEST_CONFIG.get('results_dir', '../data/results'))
+        return _result_store
+
+
+def har_index():
+    """The per-resource HAR index, opened on first use"""
+
+    global _har_index
+    with _har_index_lock:
+        if _har_index is None:
+            _har_index = har.HarIndex(THEMETEST_CONFIG.get('har_index', '../data/har.sqlite'))
+        return _har_index
+
+
+def site_manifest():
+    """The record of every provisioned site, loaded on first use"""
+
+    global _site_manifest
+    with _teardown_lock:
+        if _site_manifest is None:
+            _site_manifest = teardown.SiteManifest('../data/sites.json')
+        return _site_manifest
+
+
+def site_teardown():
+    """The shared Teardown, so one background reclaim runs at a time"""
+
+    global _site_teardown
+    with _teardown_lock:
+        if _site_teardown is None:
+            _site_teardown = teardown.Teardown(
+                site_db(), os.path.join(testsite_basedir, teardown.TRASH_DIR),
+                workers=max(4, args.workers), dry_run=args.dry_run)
+        return _site_teardown
+
+
+def instance_prefix(wp_instance_name):
+    """The table prefix of a test site"""
+
+    if wp_instance_name == GOLDEN_INSTANCE:
+        return GOLDEN_PREFIX
+    return wp_instance_name.replace('.', '').replace('-', '') + "_"
+
+
+def register_site(wp_instance_name, site_path, prefix_db, site_url):
+    """Clear out anything left at site_path by an earlier run and record the
+    new site in the manifest before it is built"""
+
+    if os.path.exists(site_path) or wp_instance_name in site_manifest().sites:
+        site_teardown().teardown([{'path': site_path, 'prefix': prefix_db}])
+    if not args.dry_run:
+        site_manifest().add(wp_instance_name, site_path, prefix_db, site_url)
+
+
+def download_core(site_path):
+    """Unpack WordPress core into site_path from the cached release zip"""
+
+    log = logging.getLogger('generate_sites')
+    core_url = THEMETEST_CONFIG.get('wp_core_url', 'https://wordpress.org/latest.zip')
+    if args.dry_run:
+        log.info("Dry run, not unpacking %s to %s" % (core_url, site_path))
+        return
+    with artifact_cache().use(core_url) as core_path, zipfile.ZipFile(core_path) as core_zip:
+        for member in core_zip.infolist():
+            # Everything in the release zip lives under wordpress/
+            name = member.filename.split('/', 1)[-1]
+            if not name:
+                continue
+            target = os.path.join(site_path, name)
+            if name.endswith('/'):
+                if not os.path.isdir(target):
+                    os.makedirs(target)
+                continue
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            with core_zip.open(member) as src, open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+
+
+def theme_package(theme):
+    """Path of a local zip of the theme's current version, via the cache"""
+
+    version = theme['version']
+    url = theme.get('download_link') or theme['versions'][version]
+    if args.dry_run:
+        return url
+    package = os.path.join(tempfile.gettempdir(), 'themetest-%s.%s.zip' % (theme['slug'], version))
+    return artifact_cache().copy_to(url, package, version=version)
+
+
+def install_core(site_path, site_url, prefix_db):
+    """Unpack, configure and install a bare WordPress. WordPress doesn't
+    exist until these have run, so they get their own processes."""
+
+    dbhost = THEMETEST_CONFIG['dbhost']
+    dbname = THEMETEST_CONFIG['dbname']
+    dbuser = THEMETEST_CONFIG['dbuser']
+    dbpass = THEMETEST_CONFIG['dbpass']
+    wp_admin_password = THEMETEST_CONFIG['wp_admin_password']
+    wp_cli_base = [THEMETEST_CONFIG['wp_cli_path'], "--path=%s" % site_path]
+    if args.dry_run: wp_cli_base = ['echo'] + wp_cli_base
+    download_core(site_path)
+    install_steps = [
+        ["core", "config", "--dbhost=%s" % dbhost, "--dbname=%s" % dbname, "--dbprefix=%s" % prefix_db,
+         "--dbuser=%s" % dbuser, "--dbpass=%s" % dbpass],
+        ["core", "install", "--url=%s" % site_url, "--title=Your Blog Title", "--admin_name=wpadmin",
+         "--admin_password=%s" % wp_admin_password, "--admin_email=you@example.com"],
+    ]
+    for step in install_steps:
+        with tracing.span('subprocess', command='wp ' + ' '.join(step[:2])) as span:
+            span.status = subprocess.call(wp_cli_base + step)
+            if span.status != 0:
+                raise subprocess.CalledProcessError(span.status, wp_cli_base + step)
+
+
+def import_test_content(worker):
+    worker.cli("plugin", "install", "wordpress-importer", activate=True)
+    worker.cli("import", "%swp-content/plugins/themetest/data/testdata.xml" % wp_path, authors="skip")
+
+
+def build_golden_site():
+    """Install and import the golden site that theme sites are cloned from.
+    A finished golden site is reused until cleanup removes it."""
+
+    log = logging.getLogger('generate_sites')
+    site_path = testsite_basedir + GOLDEN_INSTANCE
+    site_url = testsite_baseurl + GOLDEN_INSTANCE
+    if golden.is_golden(site_path):
+        log.info('Reusing golden site %s' % site_path)
+        return site_path
+    log.info('Building golden site %s' % site_path)
+    register_site(GOLDEN_INSTANCE, site_path, GOLDEN_PREFIX, site_url)
+    install_core(site_path, site_url, GOLDEN_PREFIX)
+    worker = wpworker.get_worker(site_path, THEMETEST_CONFIG['wp_cli_path'], dry_run=args.dry_run)
+    try:
+        import_test_content(worker)
+    finally:
+        wpworker.close_worker(site_path)
+    if not args.dry_run:
+        golden.mark_golden(site_path)
+    return site_path
+
+
+def provision_site(theme, golden_path=None):
+    """Install WordPress + the theme for a single theme, returns a
+    (slug, status) tuple so one broken theme doesn't stop the batch. With
+    golden_path the site is cloned from the golden site instead."""
+
+    log = logging.getLogger('generate_sites')
+    wp_theme = theme['slug']
+    log.info('Installing %s' % wp_theme)
+    wp_instance_name = wp_theme + "01"
+    prefix_db = instance_prefix(wp_instance_name)
+    site_url = testsite_baseurl + wp_instance_name
+    site_path = testsite_basedir + wp_instance_name
+    log.debug("%s | %s | %s | %s" % (wp_instance_name, prefix_db, site_url, site_path))
+    try:
+        register_site(wp_instance_name, site_path, prefix_db, site_url)
+        if golden_path is None:
+            install_core(site_path, site_url, prefix_db)
+        elif args.dry_run:
+            log.info("Dry run, not cloning %s to %s" % (golden_path, site_path))
+        else:
+            method = golden.clone_site(site_db(), golden_path, GOLDEN_PREFIX, site_path, prefix_db, site_url)
+            log.info("%s: cloned from golden site (%s)" % (wp_theme, method))
+        worker = wpworker.get_worker(site_path, THEMETEST_CONFIG['wp_cli_path'], dry_run=args.dry_run)
+        try:
+            if golden_path is not None:
+                worker.cli("search-replace", testsite_baseurl + GOLDEN_INSTANCE, site_url, skip_columns="guid")
+            package = theme_package(theme)
+            try:
+                worker.cli("theme", "install", package, activate=True)
+            finally:
+                if os.path.isfile(package):
+                    os.unlink(package)
+            if golden_path is None and not content_profiles():
+                import_test_content(worker)
+        finally:
+            wpworker.close_worker(site_path)
+    except subprocess.CalledProcessError as e:
+        log.error("%s: '%s' failed with exit status %s" % (wp_theme, ' '.join(e.cmd[2:4]), e.returncode))
+        return wp_theme, 'failed'
+    except wpworker.WPWorkerError as e:
+        log.error("%s: %s" % (wp_theme, e))
+        return wp_theme, 'failed'
+    except Exception:
+        log.error("%s: provisioning raised\n%s" % (wp_theme, traceback.format_exc()))
+        return wp_theme, 'failed'
+    return wp_theme, 'ok'
+
+
+def generate_sites(themedata, workers=1, use_golden=False):
     """This takes the JSON object created by load_theme_data and installs 
-    WordPress + the theme"""
+    WordPress + the theme, up to `workers` sites at a time. With use_golden
+    each site is cloned from one pre-imported golden site. Returns a dict of
+    slug: status ('ok' or 'failed')"""
 
     log = logging.getLogger('generate_sites')
-    for theme in themedata:
-        wp_theme = theme['slug']
-        log.info('Installing %s' % wp_theme)
-        wp_instance_name = wp_theme + "01"
-        prefix_db = wp_instance_name.replace('.', '').replace('-', '') + "_"
-        dbhost = THEMETEST_CONFIG['dbhost']
-        dbname = THEMETEST_CONFIG['dbname']
-        dbuser = THEMETEST_CONFIG['dbuser']
-        dbpass = THEMETEST_CONFIG['dbpass']
-        wp_admin_password = THEMETEST_CONFIG['wp_admin_password']
-        site_url = testsite_baseurl + wp_instance_name
-        site_path = testsite_basedir + wp_instance_name
-        wp_cli_base = "wp --path=%s " % site_path
-        if args.dry_run: wp_cli_base = 'echo ' + wp_cli_base
-        log.debug("%s | %s | %s | %s | %s" % (
-            wp_instance_name, prefix_db, site_url, site_path, wp_cli_base))
-        os.system(wp_cli_base + "core download")
-        #os.system(wp_cli_base + "core config --dbhost=localhost --dbname=wp03_themetest --dbprefix=%s --dbuser=wp03_themetest --dbpass=MYSwaterloo1815" % (dbname, prefix_db, dbuser, dbpass))
-        os.system(wp_cli_base + "core config --dbhost=%s --dbname=%s --dbprefix=%s --dbuser=%s --dbpass=%s" % (dbhost, dbname, prefix_db, dbuser, dbpass))
-        os.system(wp_cli_base + "core install --url=%s --title='Your Blog Title' --admin_name=wpadmin --admin_password=%s --admin_email=you@example.com" % (site_url, wp_admin_password))
-        os.system(wp_cli_base + "theme install %s --activate" % wp_theme)
-        os.system(wp_cli_base + "plugin install wordpress-importer --activate")
-        os.system(wp_cli_base + "import %swp-content/plugins/themetest/data/testdata.xml --authors=skip" % (wp_path))
-
-
-def test_gtmetrix(themedata, readonly=False):
+    golden_path = build_golden_site() if use_golden else None
+    workers = max(1, min(workers, len(themedata) or 1))
+    log.info('Provisioning %s sites with %s workers' % (len(themedata), workers))
+    pool = ThreadPool(workers)
+    statuses = {}
+    try:
+        def provision(theme):
+            with tracing.span('site', stage='provision', theme=theme['slug']):
+                return provision_site(theme, golden_path=golden_path)
+
+        for wp_theme, status in pool.imap_unordered(provision, themedata):
+            statuses[wp_theme] = status
+            log.info('%s: %s (%s/%s done)' % (wp_theme, status, len(statuses), len(themedata)))
+    finally:
+        pool.close()
+        pool.join()
+    failed = [slug for slug in statuses if statuses[slug] != 'ok']
+    if failed:
+        log.warning('%s of %s sites failed: %s' % (len(failed), len(themedata), ', '.join(sorted(failed))))
+    return statuses
+
+
+def provisioned(themedata, statuses):
+    """Filter themedata down to the themes generate_sites installed cleanly"""
+
+    return [theme for theme in themedata if statuses.get(theme['slug']) == 'ok']
+
+
+def make_backend(name, concurrency=1):
+    """The test backend to run tests with, 'gtmetrix' or 'local'"""
+
+    if name == 'local':
+        return backends.LocalBackend(concurrency=concurrency)
+    username, password = gtmetrix_credentials()
+    return backends.GTmetrixBackend(
+        username, password,
+        api_url=THEMETEST_CONFIG.get('gtmetrix_api_url', gtscheduler.GTMETRIX_API_URL),
+        concurrency=concurrency,
+        options={'x-metrix-cookies': 'c9.live.user.click-through = ok'})
+
+
+def record_result(theme, version, results, label):
+    """Append a test run to the result store, and to the work queue for the
+    coordinator when running queued jobs. Returns the run's timestamp."""
+
+    timestamp = result_store().append(theme, version, None, results, label=label)
+    if _queue_host is not None:
+        work_queue().add_result('run', _queue_host, dict(
+            theme=theme, version=version, timestamp=timestamp, label=label,
+            results=dict((metric, results.get(metric)) for metric in resultstore.METRICS)))
+    return timestamp
+
+
+def test_gtmetrix(themedata, readonly=False, concurrency=1, backend=None, samples=1, warmup=0, content=None):
     """This takes the JSON object created by load_theme_data and tests each 
-    site using GTMetrix"""
+    site using GTMetrix, or another test backend, keeping up to `concurrency`
+    tests running at once. With samples > 1 every theme is tested that many
+    times and the median of each metric is published. content names the
+    content profile the sites hold, results are kept apart per profile."""
 
     log = logging.getLogger('test_gtmetrix')
+    readonly = readonly or args.dry_run
+    backend = backend or make_backend('gtmetrix', concurrency)
+    themes = {}
     for theme in themedata:
-
+        themes[theme['slug'] + "01"] = theme
+
+    suffix = '-' + content if content else ''
+    label = backend.name + suffix
+
+    def gtmetrix_data_filename(wp_instance_name):
+        return "../data/" + wp_instance_name + suffix + "-test.log"
+
+    # Screenshots download in the background so the next result isn't held up
+    downloads = ThreadPool(max(1, args.workers))
+
+    trace_context = tracing.current()
+
+    def download_screenshot(url, filename, wp_theme):
+        try:
+            with tracing.context(theme=wp_theme, **trace_context):
+                artifact_cache().copy_to(url, filename, auth=requests.auth.HTTPBasicAuth(
+                    *gtmetrix_credentials()))
+        except Exception:
+            log.error("Downloading %s failed\n%s" % (url, traceback.format_exc()))
+
+    def ingest_har(url, theme, timestamp, site_url):
+        try:
+            auth = requests.auth.HTTPBasicAuth(*gtmetrix_credentials())
+            with tracing.context(theme=theme['slug'], **trace_context):
+                with artifact_cache().use(url, auth=auth) as filename:
+                    with tracing.span('har.ingest') as span, open(filename, 'rb') as f:
+                        span.bytes = os.path.getsize(filename)
+                        span.set(resources=har_index().ingest(
+                            f, theme['slug'], theme['version'] or '', label, timestamp, site_url, har_url=url))
+                if _queue_host is not None:
+                    work_queue().add_result('har', _queue_host, har_index().export_run(
+                        theme['slug'], theme['version'] or '', label, timestamp))
+        except Exception:
+            log.error("Indexing HAR %s failed\n%s" % (url, traceback.format_exc()))
+
+    def save_result(wp_instance_name, gtmetrix_data):
+        """Store each result as soon as its test completes"""
+
+        theme = themes[wp_instance_name]
         wp_theme = theme['slug']
-        wp_instance_name = wp_theme + "01"
-        prefix_db = wp_instance_name + "_"
-        site_url = "%s%s/" % (testsite_baseurl, wp_instance_name)
-        site_path = testsite_basedir + wp_instance_name
-        gtmetrix_data_filename = "../data/" + wp_instance_name + "-test.log"
         gtmetrix_screenshot_filename = "%s/%s-ss.png" % (images_path, wp_theme)
-        readonly = readonly or args.dry_run
-        #wp_cli_base = "wp --path=%s " % site_path
-        #print("%s | %s | %s | %s | %s" % (wp_instance_name, prefix_db, site_url, site_path, wp_cli_base))
-        if readonly:
-            log.info('Read only, loading data from %s' % gtmetrix_data_filename)
-            gtmetrix_data = json.load(open(gtmetrix_data_filename))
-        else:
-            log.info("Starting GTMetrix test for " + wp_instance_name)
-            r = requests.post('https://gtmetrix.com/api/0.1/test',
-                                auth=HTTPBasicAuth(
-                                    gtmetrix_api_username, gtmetrix_api_password),
-                                data={'url': site_url, 'x-metrix-cookies': 'c9.live.user.click-through = ok'})
-            log.info("Request finished, status code: %s" % r.status_code)
-            log.info("Complete Response: %s" % r.text)
-            data = r.json()
-            try:
-                test_id = data['test_id']
-                credits_left = data['credits_left']
-                log.info('Test %s successfully queued. %s credits left.' %
-                        (test_id, credits_left))
-            except:
-                trace = traceback.format_exc()
-                data['error']
-                log.error(r.json(), trace)
-            test_state = "just started"
-            total_run_time = 0
-
-            while (test_state != "completed") and (test_state != "error"):
-                r = requests.get('https://gtmetrix.com/api/0.1/test/%s' % test_id,
-                                auth=HTTPBasicAuth(gtmetrix_api_username, gtmetrix_api_password))
-                log.debug("HTTP Returned: %s" % r.status_code)
-                log.debug(r.text)
-                gtmetrix_data = r.json()
-                test_state = gtmetrix_data['state']
-                log.info(test_state)
-
-                if test_state != "completed":
-                    time.sleep(6)
-                    total_run_time += 6
-
-            log.info("Test completed, saving to: %s" % gtmetrix_data_filename)          
-            with open(gtmetrix_data_filename, "w") as f:
+        timestamp = None
+        if not readonly:
+            log.info("Test completed, saving to: %s" % gtmetrix_data_filename(wp_instance_name))
+            with open(gtmetrix_data_filename(wp_instance_name), "w") as f:
                 f.write(json.dumps(gtmetrix_data, indent=2))
+            timestamp = record_result(wp_theme, theme['version'], gtmetrix_data['results'], label)
 
         # Save the result to the theme object provided as an arugment
         theme['gtmetrix'] = gtmetrix_data
@@ -216,21 +676,136 @@ def test_gtmetrix(themedata, readonly=False):
         # Now save the screenshot
         screenshot_url = gtmetrix_data['resources']['screenshot']
         log.info("Screenshot URL: %s" % screenshot_url)
-        if readonly:
+        if not screenshot_url:
+            log.info("No screenshot from the %s backend" % backend.name)
+        elif readonly:
             log.info("Read only, not downloading to %s" % gtmetrix_screenshot_filename)
         else:
             log.info("Downloading to %s" % gtmetrix_screenshot_filename)
-            response = requests.get(screenshot_url, auth=HTTPBasicAuth(
-                gtmetrix_api_username, gtmetrix_api_password), stream=True)
-
-            # Throw an error for bad status codes
-            response.raise_for_status()
-
-            with open(gtmetrix_screenshot_filename, 'wb') as handle:
-                for block in response.iter_content(1024):
-                    handle.write(block)
-
-            time.sleep(6)
+            downloads.apply_async(download_screenshot, (screenshot_url, gtmetrix_screenshot_filename, wp_theme))
+
+        # And break the HAR down per resource into the index
+        har_url = gtmetrix_data['resources'].get('har')
+        if har_url and not readonly:
+            site_url = "%s%s/" % (testsite_baseurl, wp_instance_name)
+            downloads.apply_async(ingest_har, (har_url, theme, timestamp, site_url))
+
+    if readonly:
+        for wp_instance_name in themes:
+            log.info('Read only, loading data from %s' % gtmetrix_data_filename(wp_instance_name))
+            with open(gtmetrix_data_filename(wp_instance_name)) as f:
+                save_result(wp_instance_name, json.load(f))
+        downloads.close()
+        return
+
+    tests = []
+    for theme in themedata:
+        wp_instance_name = theme['slug'] + "01"
+        site_url = "%s%s/" % (testsite_baseurl, wp_instance_name)
+        log.info("Queueing %s test for %s" % (backend.name, wp_instance_name))
+        tests.append((wp_instance_name, site_url))
+    errors = {}
+    if samples > 1:
+        def record_sample(wp_instance_name, data):
+            theme = themes[wp_instance_name]
+            record_result(theme['slug'], theme['version'], data['results'], label + '-sample')
+
+        benchmarked = sampling.benchmark(backend, tests, samples=samples, warmup=warmup,
+                                         concurrency=concurrency, on_sample=record_sample)
+        for wp_instance_name, result in benchmarked.items():
+            if not result['samples']:
+                errors[wp_instance_name] = {'error': 'no samples'}
+                continue
+            samples_filename = "../data/" + wp_instance_name + suffix + "-samples.json"
+            log.info("%s samples taken, saving to: %s" % (len(result['samples']), samples_filename))
+            with open(samples_filename, "w") as f:
+                f.write(json.dumps(result, indent=2))
+            save_result(wp_instance_name, sampling.median_result(result))
+    else:
+        backend.run(tests, on_complete=save_result, on_error=errors.__setitem__)
+    if errors:
+        log.error('%s of %s tests failed: %s' % (
+            len(errors), len(themes), ', '.join(sorted(errors))))
+    log.info("Waiting for screenshot downloads")
+    downloads.close()
+    downloads.join()
+
+
+def content_profiles():
+    """The content profiles given with --content, [] to import testdata.xml"""
+
+    return [name.strip() for name in (args.content or '').split(',') if name.strip()]
+
+
+def load_content(theme, profile):
+    """Replace a theme site's content with a generated profile"""
+
+    wp_instance_name = theme['slug'] + "01"
+    with tracing.span('content', theme=theme['slug'], profile=profile):
+        content.load(site_db(), instance_prefix(wp_instance_name),
+                     content.get_profile(profile, THEMETEST_CONFIG.get('content_profiles')),
+                     testsite_baseurl + wp_instance_name,
+                     os.path.join(testsite_basedir + wp_instance_name, 'wp-content', 'uploads'))
+
+
+def run_tests(themedata, concurrency=1, backend=None, samples=1, warmup=0):
+    """test_gtmetrix at each --content profile in turn, loading the profile
+    into every site first. The first profile's results are the ones
+    published."""
+
+    log = logging.getLogger('run_tests')
+    profiles = content_profiles()
+    if not profiles:
+        return test_gtmetrix(themedata, concurrency=concurrency, backend=backend, samples=samples, warmup=warmup)
+    published = {}
+    for profile in profiles:
+        log.info('Loading the %s content profile into %s sites' % (profile, len(themedata)))
+        pool = ThreadPool(max(1, min(args.workers, len(themedata))))
+        try:
+            pool.map(functools.partial(load_content, profile=profile), themedata)
+        finally:
+            pool.close()
+            pool.join()
+        test_gtmetrix(themedata, concurrency=concurrency, backend=backend, samples=samples, warmup=warmup,
+                      content=profile)
+        for theme in themedata:
+            if profile == profiles[0] and 'gtmetrix' in theme:
+                published[theme['slug']] = theme['gtmetrix']
+    for theme in themedata:
+        theme.pop('gtmetrix', None)
+        if theme['slug'] in published:
+            theme['gtmetrix'] = published[theme['slug']]
+            if not args.dry_run:
+                with open("../data/" + theme['slug'] + "01-test.log", "w") as f:
+                    f.write(json.dumps(theme['gtmetrix'], indent=2))
+
+
+def analyze_assets(themedata):
+    """Statically analyze each theme's package, saving the result to
+    theme['assets']. Packages come from the download cache and results are
+    cached per slug and version. Packages are downloaded and analyzed a
+    batch at a time, so the download cache never has to hold more than a
+    batch of them before they are analyzed."""
+
+    log = logging.getLogger('analyze_assets')
+    cache = assets.AssetCache('../data/assets.json')
+    missing = [theme for theme in themedata if not cache.get(theme['slug'], theme['version'])]
+    if missing and args.dry_run:
+        log.info("Dry run, not downloading %s theme packages" % len(missing))
+        missing = []
+    results = {}
+    for start in range(0, len(missing), ASSET_BATCH_SIZE):
+        batch = missing[start:start + ASSET_BATCH_SIZE]
+        with artifact_cache().use_many(
+                [(theme.get('download_link') or theme['versions'][theme['version']], theme['version'], None)
+                 for theme in batch], workers=args.workers) as packages:
+            results.update(assets.analyze_many(cache, [(theme['slug'], theme['version'], path)
+                                                       for theme, path in zip(batch, packages)]))
+    for theme in themedata:
+        analysis = results.get((theme['slug'], theme['version'])) or cache.get(theme['slug'], theme['version'])
+        if analysis:
+            theme['assets'] = analysis
+    return results
 
 
 def build_acfdata(themedata):
@@ -239,7 +814,12 @@ def build_acfdata(themedata):
     res = {}
   
     log = logging.getLogger('build_acfdata')
+    analyze_assets(themedata)
+    screenshots = []
     for theme in themedata:
+        if 'gtmetrix' not in theme:
+            log.warning("No GTMetrix results for %s, skipping" % theme['slug'])
+            continue
         wp_theme = theme['name']
         log.info("Name %s, Slug: %s, Version %s" % (theme['name'], theme['slug'], theme['version']))
         screenshot_filename = "%s/%s.jpg" % (images_path, theme['slug'])
@@ -248,21 +828,8 @@ def build_acfdata(themedata):
         if args.dry_run:
             log.info("Read only, not downloading to %s" % screenshot_filename)
         else:
-            if not os.path.isfile(screenshot_filename):
-                log.info("Downloading to %s" % screenshot_filename)
-                response = requests.get(screenshot_url, auth=HTTPBasicAuth(
-                    gtmetrix_api_username, gtmetrix_api_password), stream=True)
-                # Throw an error for bad status codes
-                response.raise_for_status()
-
-                with open(screenshot_filename, 'wb') as handle:
-                    for block in response.iter_content(1024):
-                        handle.write(block)
-                
-                os.system('convert %s -quality 75 %s' % (screenshot_filename, os.path.splitext(screenshot_filename)[0]+'.jpg' ))
-
-            else:
-                log.info("File exists, skipping %s" % screenshot_filename)      
+            # Downloaded and converted below in one batch
+            screenshots.append((screenshot_url, theme['version'], screenshot_filename))
        
         # build post meta values for custom fields
         acfdata = {}
@@ -295,28 +862,16 @@ def build_acfdata(themedata):
         acfdata['theme_screenshot_url'] = theme['screenshot_url'] 
         acfdata['theme_active_installs'] = theme['active_installs']
         
+        # Static analysis of the theme package
+        if 'assets' in theme:
+            for field in assets.FIELDS:
+                acfdata['asset_' + field] = theme['assets'][field]
+            acfdata['asset_unminified'] = theme['assets']['unminified']
+
         # GTMetrix data
-        acfdata['gt_pagespeed_score'] = theme['gtmetrix']['results']['pagespeed_score']
-        acfdata['gt_yslow_score'] = theme['gtmetrix']['results']['yslow_score']
-        acfdata['gt_page_elements'] = theme['gtmetrix']['results']['page_elements']
-        acfdata['gt_html_bytes'] = theme['gtmetrix']['results']['html_bytes']
-        acfdata['gt_page_bytes'] = theme['gtmetrix']['results']['page_bytes']
+        for metric in resultstore.METRICS:
+            acfdata['gt_' + metric] = theme['gtmetrix']['results'][metric]
         acfdata['gt_report_url'] = theme['gtmetrix']['results']['report_url']
-        acfdata['gt_page_load_time'] = theme['gtmetrix']['results']['page_load_time']
-        acfdata['gt_fully_loaded_time'] = theme['gtmetrix']['results']['fully_loaded_time']
-        acfdata['gt_rum_speed_index'] = theme['gtmetrix']['results']['rum_speed_index']
-        acfdata['gt_html_load_time'] = theme['gtmetrix']['results']['html_load_time']
-        acfdata['gt_first_paint_time'] = theme['gtmetrix']['results']['first_paint_time']
-        acfdata['gt_report_url'] = theme['gtmetrix']['results']['report_url']
-        acfdata['gt_dom_content_loaded_time'] = theme['gtmetrix']['results']['dom_content_loaded_time']
-        acfdata['gt_onload_time'] = theme['gtmetrix']['results']['onload_time']
-        acfdata['gt_backend_duration'] = theme['gtmetrix']['results']['backend_duration']
-        acfdata['gt_onload_duration'] = theme['gtmetrix']['results']['onload_duration']
-        acfdata['gt_connect_duration'] = theme['gtmetrix']['results']['connect_duration']
-        acfdata['gt_first_contentful_paint_time'] = theme['gtmetrix']['results']['first_contentful_paint_time']
-        acfdata['gt_dom_content_loaded_duration'] = theme['gtmetrix']['results']['dom_content_loaded_duration']
-        acfdata['gt_redirect_duration'] = theme['gtmetrix']['results']['redirect_duration']
-        acfdata['gt_dom_interactive_time'] = theme['gtmetrix']['results']['dom_interactive_time']
         
         # GTMetrix Resources -- With the exception of the PDF these should actually be processed and saved.
         acfdata['gt_screenshot_url'] = theme['gtmetrix']['resources']['screenshot']
@@ -330,102 +885,144 @@ def build_acfdata(themedata):
         # Return the acfdata object as the value of an associated array whose key is the theme_slug
         res[acfdata['theme_slug']] = acfdata
 
+    with artifact_cache().use_many([(url, version, None) for url, version, dest in screenshots],
+                                   workers=args.workers) as sources:
+        images.convert_many([(src, dest, 75, None) for src, (url, version, dest) in zip(sources, screenshots)
+                             if src])
     return res
 
 
+def wp_target():
+    """The command worker for the WordPress instance reports are posted to"""
+
+    return wpworker.get_worker(wp_path, THEMETEST_CONFIG['wp_cli_path'], dry_run=args.dry_run)
+
+
 def create_wp_post(post_content, post_author, post_category, post_excerpt, post_title, post_status="draft"):
+    """Create a post, post_content can be the path of an .html file which
+    the worker reads the content from"""
+
     log = logging.getLogger('create_wp_post')
-    if not post_content.endswith('.html'):
-        post_content = "--post_content='%s'" % post_content      
-
-    log.debug("Params: %s, %s, %s, %s" % (post_content, post_category, post_excerpt, post_title))
-    wpcli_base = "%s --path=%s " % (THEMETEST_CONFIG['wp_cli_path'], wp_path)
-    if args.dry_run: wpcli_base = "echo " + wpcli_base
-    post_excerpt = post_excerpt.encode('ascii', 'ignore')
-    post_excerpt = post_excerpt.replace('\n', ' ').replace('\r', '')
-    import_command = wpcli_base + r"""post create %s --post_author=%s --post_status='%s' --post_category=%s --post_excerpt="%s" --porcelain --post_title="%s" """ % (
-            post_content,
-            post_author, 
-            post_status,
-            post_category, 
-            post_excerpt,
-            post_title)
-    log.info("Executing: " + import_command)
-    if args.dry_run:
-        post_id = 4321
+    post = {
+        'post_author': int(post_author),
+        'post_status': post_status,
+        'post_category': [int(post_category)],
+        'post_excerpt': post_excerpt.replace('\n', ' ').replace('\r', ''),
+        'post_title': post_title,
+    }
+    if post_content.endswith('.html'):
+        log.debug("Post '%s' in category %s, content from %s" % (post_title, post_category, post_content))
+        post_id = wp_target().call('create_post', post=post, post_content_file=os.path.abspath(post_content))
     else:
-        post_id = subprocess.check_output(import_command, shell=True)
-        post_id = post_id.replace('\n', ' ').replace('\r', '')
+        log.debug("Post '%s' in category %s, %s bytes of content" % (post_title, post_category, len(post_content)))
+        post['post_content'] = post_content
+        post_id = wp_target().call('create_post', post=post)
+    log.info("Created post %s: %s" % (post_id, post_title))
     return post_id
 
 
+def meta_value(value):
+    """Flatten a custom field value to the string stored in post meta"""
+
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    if isinstance(value, (int, long, float)):
+        return str(value)
+    return value
+
+
 def post_pages(acfdata):
+    """Publish a report post for every theme in acfdata, setting all of the
+    custom fields and the featured image in a single WordPress bootstrap.
+    Returns a dict of slug: {'post_id': .., 'image_id': ..}"""
+
     log = logging.getLogger('post_pages')
+    report_category_id = THEMETEST_CONFIG['report_category_id']
+    report_user_id = THEMETEST_CONFIG['report_user_id']
+    payload = []
     for wp_theme, theme in acfdata.iteritems():
-        log.debug(theme)
         wp_theme = theme['theme_slug']
-        wp_instance_name = wp_theme + "01"
         image_filename = "%s/%s.jpg" % (images_path, wp_theme)
-        ss_filename = "%s/%s-ss.png" % (images_path, wp_theme)
-        gtmetrix_data_filename = "gtmetrix/" + wp_instance_name + "-test.log"
-        gtmetrix_screenshot_filename = "%s/%s-ss.png" % (images_path, wp_theme)
-        report_category_id =  THEMETEST_CONFIG['report_category_id']
-        report_user_id = THEMETEST_CONFIG['report_user_id']
-
-        # TODO: set all of the metadata at post create, for now just do it afterwards
-        # porcelain makes it just output the ID
-        wpcli_base = "%s --path=%s " % (THEMETEST_CONFIG['wp_cli_path'], wp_path)
-        if args.dry_run: wpcli_base = "echo " + wpcli_base
-        value = theme['theme_description']
-        value_asc = value.encode('ascii', 'ignore')
-        value_asc = value_asc.replace('\n', ' ').replace('\r', '').replace("'", r"'\''")
-        import_command = wpcli_base + r"""post create --post_author=%s --post_status=publish --post_content='[themetest_results_full]' --post_category=%s --post_excerpt='%s' --post_title='%s' --porcelain""" % (
-            report_user_id,
-            report_category_id,
-            value_asc,
-            "%s - WordPress Theme Performance Report" % theme['theme_name'])
-        log.info("Import command: " + import_command)
-        if args.dry_run:
-            post_id = 4321
-        else:
-            res = subprocess.check_output(import_command, shell=True)
-            post_id = res.splitlines()[len(res.splitlines()) - 1].replace('\n', ' ').replace('\r', '')
-
-        log.info("Slug: %s Post ID: %s" % (theme['theme_slug'], post_id))
-        meta_command = wpcli_base + "post meta set %s " % str(post_id)
+        meta = {}
         for key in theme:
-            if isinstance(theme[key], int):
-                value = str(theme[key])
-            elif isinstance(theme[key], dict):
-                value = json.dumps(theme[key])
-            else:
-                value = theme[key]
-            log.info('%s: %s' % (key, value))
-            if (value is not None):
-                value_asc = value.encode('ascii', 'ignore')
-            value_asc = value_asc.replace('\n', ' ').replace('\r', '').replace("'", r"'\''")
-            set_meta_command = meta_command + """%s '%s' """ % (key, value_asc)
-            log.info("Setting meta: %s - %s" % (key, value_asc))
-            log.debug("Full Command: %s" % set_meta_command)
-            if not args.dry_run:
-                subprocess.check_output(set_meta_command, shell=True)
-        import_command = wpcli_base + r"""media import "%s" --post_id=%s --featured_image --porcelain""" % (
-            image_filename,
-            str(post_id).strip())
-        log.info("Import: " + import_command)
+            meta[key] = meta_value(theme[key])
+        log.debug('%s: %s custom fields' % (wp_theme, len(meta)))
+        payload.append({
+            'key': wp_theme,
+            'post': {
+                'post_author': int(report_user_id),
+                'post_status': 'publish',
+                'post_content': '[themetest_results_full]',
+                'post_category': [int(report_category_id)],
+                'post_excerpt': theme['theme_description'].replace('\n', ' ').replace('\r', ''),
+                'post_title': "%s - WordPress Theme Performance Report" % theme['theme_name'],
+            },
+            'meta': meta,
+            'image': image_filename,
+        })
+
+    log.info("Publishing %s reports" % len(payload))
+    results = wp_target().call('publish', items=payload)
+
+    published = {}
+    for result in results:
+        if result.get('error'):
+            log.error("Slug: %s Error: %s" % (result['key'], result['error']))
+        log.info("Slug: %s Post ID: %s Image ID: %s" % (result['key'], result['post_id'], result['image_id']))
+        published[result['key']] = {'post_id': result['post_id'], 'image_id': result['image_id']}
+    return published
+
+
+def rest_json(r):
+    """Decode a WP REST response, skipping any PHP notices printed before it"""
+
+    try:
+        return r.json()
+    except ValueError:
+        log = logging.getLogger('rest_json')
+        start = min(i for i in (r.text.find('['), r.text.find('{')) if i >= 0)
+        log.warning("Skipped %s bytes of noise before the JSON body" % start)
+        return json.loads(r.text[start:])
+
+
+def published_label():
+    """The result store label of the results that get published: the
+    backend and the first content profile"""
+
+    profiles = content_profiles()
+    return args.backend + ('-' + profiles[0] if profiles else '')
+
+
+def rank_results():
+    """Rank every theme's latest published results against all the others
+    and save the leaderboard the rundown and report shortcodes read"""
+
+    log = logging.getLogger('rank_results')
+    label = published_label()
+    filename = THEMETEST_CONFIG.get('leaderboard_file', os.path.join(images_path, 'leaderboard.json'))
+    with tracing.span('rank', label=label) as span:
+        snapshot = result_store().snapshot(['timestamp'] + resultstore.KEY_COLUMNS + ranking.METRICS)
+        ranked = ranking.rank(snapshot, label)
+        leaderboard = ranking.leaderboard(ranked, snapshot, label)
+        span.set(themes=leaderboard['total'])
         if args.dry_run:
-            log.info("Dry run, faking id")
-            image_feat_id = 5432
+            log.info("Read only, not saving the leaderboard of %s themes to %s" % (leaderboard['total'], filename))
         else:
-            image_feat_id = subprocess.check_output(import_command, shell=True)
-
-        log.info(image_feat_id)
+            ranking.save(leaderboard, filename)
+            log.info("Saved the leaderboard of %s themes to %s" % (leaderboard['total'], filename))
+    for slug in leaderboard['order'][:10]:
+        entry = leaderboard['themes'][slug]
+        log.info("%5s %-30s %s" % (entry['rank'], slug, entry['score']))
+    return leaderboard
 
 
 def post_rundown():
 
     log = logging.getLogger('post_rundown')
     log.info('Doing a rundown')
+    rank_results()
     rundown_category_id = THEMETEST_CONFIG['rundown_category_id']
     report_category_id = THEMETEST_CONFIG['report_category_id']
     rundown_user_id = THEMETEST_CONFIG['rundown_user_id']
@@ -433,83 +1030,71 @@ def post_rundown():
     params = dict(
         after=timestamp,
         categories=report_category_id,
-        per_page=20,
-        post_status="publish",
+        per_page=100,
+        status="publish",
+        _fields="id,slug",
     )
     wp_url = THEMETEST_CONFIG['wp_url']
-    tmp_filename = "../tmp/rundown-output.html"
     template_filename = '../templates/rundown-template.html'
-    r = requests.get("%swp-json/wp/v2/posts" % wp_url, params=params)
-    log.info("HTTP Request returned: %s" % r.status_code)
-    log.debug(r.text)
-    jsonstring = r.text.split('[{"id"', 1)[-1]
-    jsonstring = '[{"id"' + jsonstring
-    data = json.loads(jsonstring)
+    data = []
+    page = 1
+    total_pages = 1
+    while page <= total_pages:
+        params['page'] = page
+        r = httpclient.get_session().get("%swp-json/wp/v2/posts" % wp_url, params=params)
+        log.info("HTTP Request for page %s returned: %s" % (page, r.status_code))
+        r.raise_for_status()
+        data.extend(rest_json(r))
+        total_pages = int(r.headers.get('X-WP-TotalPages', 1))
+        page += 1
     postdata = {}
-    theme_images = ""
-    post_ids = ""
+    theme_images = []
+    post_ids = []
     theme_count = 0
     for key in data:
         post_id = str(key['id'])
         theme_name = key['slug']
         theme_name = theme_name.split('-wordpress-theme-performance')[0]
-        theme_images += "%s/%s.jpg " % (images_path, theme_name)
+        theme_images.append("%s/%s.jpg" % (images_path, theme_name))
         log.info("Proccesing %s:%s" % (theme_name, post_id))
-        post_ids += post_id + " "
+        post_ids.append(post_id)
         theme_count += 1
-    post_ids = post_ids.strip()
-    if not args.dry_run:
-        post_id = create_wp_post(
-            """<p>Hey back with another rundown</p> <!--more--> [themetest_results_rundown post_ids="%s"]""" % post_ids,
-            rundown_user_id,
-            rundown_category_id, 
-            "", 
-            "WordPress Theme Performance Rundown - %s" % datetime.datetime.today().strftime("%B %d %Y")
-        )
-    else:
-        log.info("Dry run, output saved to %s" % tmp_filename)
-
-    # Set a reasonable looking tile scheme based on the number of themes in this batch
-    if 16 <= theme_count <= 18: tile_string = '4x4'
-    elif 14 <= theme_count <= 15: tile_string = '5x3'
-    elif 10 <= theme_count <= 13: tile_string = '4x3'
-    elif 8 <= theme_count <= 9: tile_string = '3x3'
-    elif 8 <= theme_count <= 7: tile_string = '3x2'
-    
-    # Insert a blank as the first item for alignment if the count is certain numbers, adding "null:" does that
-    if theme_count == 10: theme_images = "null: " + theme_images
+    rundown_filename = render_to_file('../templates/rundown-template.html',
+                                      '../tmp/rundown-%s.html' % datetime.datetime.today().strftime("%y%m%d"),
+                                      {'post_ids': post_ids})
+    post_id = create_wp_post(
+        rundown_filename,
+        rundown_user_id,
+        rundown_category_id, 
+        "", 
+        "WordPress Theme Performance Rundown - %s" % datetime.datetime.today().strftime("%B %d %Y")
+    )
 
     image_filename = "../tmp/rundown_featured-%s.jpg" % datetime.datetime.today().strftime("%y%m%d")
-    montage_command = "montage %s -thumbnail 240x240 -sharpen 10  -background snow -geometry '240x240-50-30' +polaroid -resize 100%% -tile %s %s" % (
-        theme_images,
-        tile_string,
-        image_filename)
-
-    if args.dry_run: montage_command = "echo " + montage_command
-    log.info("Creating montage: %s" % montage_command)
-    subprocess.check_output(montage_command, shell=True)
-
-    wpcli_base = "%s --path=%s " % (THEMETEST_CONFIG['wp_cli_path'], wp_path)
-    if args.dry_run: wpcli_base = "echo " + wpcli_base
-    import_command = wpcli_base + r"""media import "%s" --post_id=%s --featured_image --porcelain""" % (
-        image_filename,
-        str(post_id).strip())
-    log.info("Import: " + import_command)
     if args.dry_run:
-        log.info("Dry run, faking id")
-        image_feat_id = 5432
+        log.info("Read only, not creating montage %s of %s themes" % (image_filename, theme_count))
     else:
-        image_feat_id = subprocess.check_output(import_command, shell=True)
+        image_filename, layout = images.montage(theme_images, image_filename)
+        log.info("Created %sx%s montage %s" % (layout + (image_filename,)))
 
+    log.info("Importing %s as featured image of %s" % (image_filename, post_id))
+    image_feat_id = wp_target().call('import_media', path=os.path.abspath(image_filename),
+                                     post_id=int(post_id), featured=True)
     log.info(image_feat_id)
 
+
 def load_featured(filename):
-    """Load featured themes from a previously saved featured.json"""
+    """Load featured themes from a previously saved featured.json, or a .jsonl
+    catalogue which is iterated from disk rather than loaded"""
 
     log = logging.getLogger('load_featured')
     log.info('Started load_featured, opening %s' % filename)
     data = {}
-    if os.path.isfile(filename):
+    if filename.endswith('.jsonl') and os.path.isfile(filename):
+        store = catalogue.CatalogueStore(filename)
+        data = {'info': store.info, 'themes': store}
+        log.info('Opened %s, %s themes total.' % (filename, len(store)))
+    elif os.path.isfile(filename):
         with open(filename, "r") as f:
             data = json.load(f)
      
@@ -524,29 +1109,11 @@ def load_featured(filename):
 def get_featured(filename):
     log = logging.getLogger('get_featured')
     log.info('Started get_featured, querying WordPress.org API')
-    r = requests.post('https://api.wordpress.org/themes/info/1.1/',
-        data={
-            'action': 'query_themes', 
-            'request[page]': '1',
-            'request[browse]':'featured',
-            'request[fields][description]': 'true',
-            'request[fields][sections]': 'true',
-            'request[fields][rating]': 'true',
-            'request[fields][ratings]': 'true',
-            'request[fields][downloaded]': 'true',
-            'request[fields][download_link]': 'true',
-            'request[fields][last_updated]': 'true',
-            'request[fields][homepage]': 'true',
-            'request[fields][tags]': 'true',
-            'request[fields][template]': 'true',
-            'request[fields][parent]': 'true',
-            'request[fields][versions]': 'true',
-            'request[fields][screenshot_url]': 'true',
-            'request[fields][active_installs]': 'true'
-        })
-    
+    r = httpclient.get_session().post(catalogue.THEMES_API_URL,
+        data=catalogue.query_params(browse='featured'))
+
     log.info("HTTP Returned: %s" % r.status_code)
-    log.debug("Body: %s" % r.text)
+    log.debug("Body: %s bytes" % len(r.content))
     data = r.json()
     if filename:
         with open(filename, "w") as f:
@@ -559,40 +1126,237 @@ def get_featured(filename):
     return data
 
 
+def compare_versions(slug, version_a, version_b, label):
+    """Compare the stored samples of two versions of a theme"""
+
+    log = logging.getLogger('compare')
+    store = result_store()
+    runs = []
+    for version in (version_a, version_b):
+        res = store.query(theme=slug, version=version, label=label + '-sample')
+        if not res['timestamp']:
+            res = store.query(theme=slug, version=version, label=label)
+        log.info('%s %s: %s runs' % (slug, version, len(res['timestamp'])))
+        runs.append([dict((metric, res[metric][i]) for metric in resultstore.METRICS)
+                     for i in range(len(res['timestamp']))])
+    comparison = sampling.compare(runs[0], runs[1])
+    for metric in resultstore.METRICS:
+        if metric in comparison:
+            c = comparison[metric]
+            log.info('%-28s %12.1f -> %12.1f  p=%.3f %s' % (
+                metric, c['median_a'], c['median_b'], c['p'],
+                'significant' if c['significant'] else ''))
+    return comparison
+
+
+def run_pipeline(themedata, resume=False):
+    """Stream themedata through provisioning, testing and publishing, then
+    post a rundown. Each theme moves on to the next stage as soon as it is
+    ready, and with resume the stages the journal has as done are skipped.
+    Returns the themes that made it all the way through."""
+
+    log = logging.getLogger('run_pipeline')
+    # A dry run provisions nothing, so it mustn't mark anything done for a real run
+    journal_filename = '../data/pipeline-journal%s.jsonl' % ('-dry-run' if args.dry_run else '')
+    journal = pipeline.Journal(journal_filename, resume=resume)
+    completed = []
+    try:
+        outcome = pipeline.Pipeline(pipeline_stages(), journal).run(themedata, on_done=completed.append)
+    finally:
+        journal.close()
+    failed = sorted(key for key in outcome if outcome[key] != 'done')
+    if failed:
+        log.warning('%s of %s themes failed: %s' % (
+            len(failed), len(outcome), ', '.join('%s %s (%s)' % (key + (outcome[key],)) for key in failed)))
+    if completed:
+        post_rundown()
+    return completed
+
+
+def pipeline_stages():
+    """The per-theme provision, test and publish stages, in order"""
+
+    golden_path = build_golden_site() if args.golden else None
+    backend = make_backend(args.backend, args.gt_concurrency)
+
+    def provision(theme):
+        wp_theme, status = provision_site(theme, golden_path=golden_path)
+        if status != 'ok':
+            raise RuntimeError('%s: provisioning %s' % (wp_theme, status))
+
+    def test(theme):
+        run_tests([theme], concurrency=1, backend=backend, samples=args.samples, warmup=args.warmup)
+        if 'gtmetrix' not in theme:
+            raise RuntimeError('%s: no test results' % theme['slug'])
+
+    def publish(theme):
+        if 'gtmetrix' not in theme:
+            # Tested in an earlier run, pick the saved results back up
+            test_gtmetrix([theme], readonly=True)
+        published = post_pages(build_acfdata([theme]))
+        if not published.get(theme['slug'], {}).get('post_id'):
+            raise RuntimeError('%s: not published' % theme['slug'])
+
+    return [
+        pipeline.Stage('provision', provision, workers=args.workers),
+        pipeline.Stage('test', test, workers=args.gt_concurrency),
+        pipeline.Stage('publish', publish, workers=1),
+    ]
+
+
+def work_queue():
+    return workqueue.WorkQueue(args.queue, lease=args.lease)
+
+
+def worker_host():
+    """The name this host's queue workers claim jobs under"""
+
+    return THEMETEST_CONFIG.get('worker_host') or socket.gethostname()
+
+
+def merge_worker_results(queue):
+    """Copy the test runs and HAR breakdowns that queue workers on other
+    hosts recorded into this host's result store and HAR index. Those from
+    this host are already in them. Returns the labels the runs were
+    recorded under."""
+
+    log = logging.getLogger('merge_worker_results')
+    host = worker_host()
+    merged = []
+    copied = 0
+    labels = set()
+    for result in queue.unmerged_results():
+        payload = result['payload']
+        if result['kind'] == 'run':
+            labels.add(payload['label'])
+        if result['host'] != host and result['kind'] == 'run':
+            result_store().append(payload['theme'], payload['version'], payload['timestamp'],
+                                  payload['results'], label=payload['label'])
+            copied += 1
+        elif result['host'] != host and result['kind'] == 'har' and payload:
+            har_index().add_run(payload['run'], payload['resources'])
+            copied += 1
+        merged.append(result['id'])
+        if len(merged) >= 100:
+            queue.mark_merged(merged)
+            merged = []
+    queue.mark_merged(merged)
+    log.info('Merged %s results from other hosts' % copied)
+    return labels
+
+
+def coordinate(themedata, resume=False):
+    """Queue themedata for queue workers on any number of hosts, wait for
+    them to finish and post a rundown"""
+
+    log = logging.getLogger('coordinate')
+    queue = work_queue()
+    queue.enqueue(themedata, PIPELINE_STAGES, resume=resume)
+    counts = queue.wait()
+    labels = merge_worker_results(queue)
+    if labels and published_label() not in labels:
+        # The workers' --backend and --content decide what was tested, this
+        # host's decide what is ranked
+        log.warning('Workers recorded results as %s but %s is ranked, give coordinate the same '
+                    '--backend and --content as the workers' % (', '.join(sorted(labels)), published_label()))
+    failed = queue.jobs(workqueue.FAILED)
+    if failed:
+        log.warning('%s of %s themes failed: %s' % (len(failed), sum(counts.values()), ', '.join(
+            '%s (%s)' % (job['slug'], job['stages'][job['stage']]) for job in failed)))
+    if counts.get(workqueue.DONE):
+        post_rundown()
+    return counts
+
+
+def work():
+    """Run queued jobs on this host until the queue is drained"""
+
+    global _queue_host
+    _queue_host = worker_host()
+    stages = dict((stage.name, stage.func) for stage in pipeline_stages())
+    workqueue.QueueWorker(work_queue(), stages, host=_queue_host, threads=args.workers).run()
+
+
+def write_trace():
+    """Dump this run's timing spans and per stage totals"""
+
+    log = logging.getLogger('trace')
+    trace_filename = '../data/trace-%s.json' % args.test_action
+    tracing.TRACER.write_json(trace_filename)
+    tracing.TRACER.write_prometheus(THEMETEST_CONFIG.get('metrics_textfile', '../data/themetest.prom'))
+    totals = sorted(tracing.TRACER.summary().items(), key=lambda item: -item[1]['seconds'])
+    for (name, stage), total in totals[:10]:
+        log.info('%-16s %-16s %5s spans %9.1fs %12s bytes %s errors' % (
+            name, stage, total['count'], total['seconds'], total['bytes'], total['errors']))
+    log.info('Trace written to %s' % trace_filename)
+
+
 def main():
     logging.info("Action: " + args.test_action)
     if args.test_action == "auto":
-        themedata = load_theme_data()
-        generate_sites(themedata)
-        test_gtmetrix(themedata)
-        acfdata = build_acfdata(themedata)
-        post_pages(acfdata)
-        post_rundown()
+        run_pipeline(load_theme_data(args.themes), resume=args.resume)
+
+    if args.test_action == "coordinate":
+        coordinate(load_theme_data(args.themes), resume=args.resume)
+
+    if args.test_action == "work":
+        work()
 
     if args.test_action == "generate_sites":
-        themedata = load_theme_data()
-        generate_sites(themedata)
+        themedata = list(load_theme_data(args.themes))
+        generate_sites(themedata, workers=args.workers, use_golden=args.golden)
 
     if args.test_action == "test_gt":
-        themedata = load_theme_data('../data/featured.json')
-        test_gtmetrix(themedata)
+        themedata = list(load_theme_data(args.themes or '../data/featured.json'))
+        run_tests(themedata, concurrency=args.gt_concurrency, backend=make_backend(args.backend, args.gt_concurrency),
+                      samples=args.samples, warmup=args.warmup)
 
     if args.test_action == "post_pages":
-        themedata = load_theme_data()
+        themedata = list(load_theme_data(args.themes))
         test_gtmetrix(themedata, readonly=True)
         acfdata = build_acfdata(themedata)
         post_pages(acfdata)
 
     if args.test_action == "cleanup":
-        site_path = os.listdir(testsite_basedir)[0]
-        wp_cli_base = "wp --path=%s " % site_path
-        if args.dry_run: wp_cli_base = 'echo ' + wp_cli_base
-        os.system("%s db reset --path=%s" % (wp_cli_base, site_path))
-        os.system("%s db optimize --path=%s" % (wp_cli_base, site_path))
-        for directory in os.listdir(testsite_basedir):
-            logging.info("Deleting: " + directory)
-            if not args.dry_run:
-                shutil.rmtree(directory)
+        sites = dict(site_manifest().sites)
+        # Sites from before the manifest existed
+        for name in os.listdir(testsite_basedir):
+            path = os.path.abspath(os.path.join(testsite_basedir, name))
+            if name != teardown.TRASH_DIR and os.path.isdir(path) and name not in sites:
+                sites[name] = {'path': path, 'prefix': instance_prefix(name)}
+        for name in sorted(sites):
+            logging.info("Deleting: %s (%s*)" % (sites[name]['path'], sites[name]['prefix']))
+        site_teardown().teardown(sites.values())
+        if not args.dry_run:
+            site_manifest().remove(sites)
+
+    if args.test_action == "analyze_assets":
+        themedata = list(load_theme_data(args.themes))
+        analyze_assets(themedata)
+        heaviest = sorted((theme for theme in themedata if 'assets' in theme),
+                          key=lambda theme: -theme['assets']['total_bytes'])
+        for theme in heaviest[:10]:
+            logging.info("%-30s %10s bytes, %s css, %s js, %s unminified" % (
+                theme['slug'], theme['assets']['total_bytes'], theme['assets']['css_bytes'],
+                theme['assets']['js_bytes'], theme['assets']['unminified_files']))
+
+    if args.test_action == "compare":
+        version_a, version_b = args.versions.split(',')
+        compare_versions(args.slug, version_a, version_b, args.backend)
+
+    if args.test_action == "rank":
+        rank_results()
+
+    if args.test_action == "har_report":
+        if args.slug:
+            for resource_type, first_party, requests_count, size, duration in har_index().breakdown(args.slug):
+                logging.info("%-6s %-11s %5s requests %10s bytes %8.0f ms" % (
+                    resource_type, 'first-party' if first_party else 'third-party',
+                    requests_count, size or 0, duration or 0))
+        else:
+            for theme, runs, size, requests_count in har_index().third_party(args.resource):
+                logging.info("%-30s %10.0f bytes %5.1f requests of third-party %s per run (%s runs)" % (
+                    theme, size, requests_count, args.resource, runs))
 
     if args.test_action == "archive":
         pass
@@ -601,43 +1365,46 @@ def main():
     if args.test_action == "get_featured":
         get_featured('../data/featured.json')  
 
+    if args.test_action == "get_catalogue":
+        name = args.tag or args.search or args.browse
+        catalogue.fetch_catalogue(
+            '../data/catalogue-%s.jsonl' % name.replace('/', '-').replace(' ', '-'),
+            workers=args.workers, browse=None if (args.tag or args.search) else args.browse,
+            tag=args.tag, search=args.search)
+
     if args.test_action == "detect_new":
         log = logging.getLogger('detect_new')
         log.info('Started detect_new, checking for new themes on WordPress.org')
-        last_run = ''
-        if os.path.isfile('.lastrun'):
-            with open('.lastrun') as f:
-                last_run = f.readline()
+        last_run = last_run_date()
         todays_date = datetime.datetime.now().strftime('%Y%m%d')
-        if not last_run == todays_date:          
-            old_themes = load_featured('../data/lastfeatured.json')
-            old_theme_list = []
-            for theme in old_themes['themes']:
-                old_theme_list.append(theme['slug'])
+        if args.resume or not last_run == todays_date:          
+            index = themeindex.ThemeIndex('../data/themeindex.json')
+            if not len(index):
+                # First run with an index, everything in the last batch was already tested
+                old_themes = load_featured('../data/lastfeatured.json')
+                index.update(old_themes.get('themes', []))
             new_themes = get_featured('../data/thisfeatured.json')
-            new_theme_list = []
-            for theme in new_themes['themes']:
-                new_theme_list.append(theme['slug'])
-            old_theme_list.sort()
-            new_theme_list.sort()
-            any_new_themes = []
-            any_new_themes = [c for c in old_theme_list if c not in new_theme_list] # Comprehension? Not for me.
-            if any_new_themes:
-                log.info("New themes detected! Beginning test")
+            goodthemes = [theme for theme in new_themes['themes'] if theme['slug'] != 'twentyseventeen']
+            added, changed, removed = index.diff(goodthemes)
+            for theme in added:
+                log.info("New theme: %s %s" % (theme['slug'], theme['version']))
+            for theme in changed:
+                log.info("Changed theme: %s %s (was %s)" % (
+                    theme['slug'], theme['version'], index.themes[theme['slug']]['version']))
+            if removed:
+                log.info("No longer featured: %s" % ', '.join(sorted(removed)))
+            delta = added + changed
+            if delta:
+                log.info("%s new or changed themes detected! Beginning test" % len(delta))
                 with open('../data/lastfeatured.json', 'w') as f:
                     f.write(json.dumps(new_themes))
                 with open('.lastrun', 'w') as f:
                     last_run = f.write(todays_date)
                 if not args.dry_run:
-                    goodthemes = []
-                    for theme in new_themes['themes']:
-                        if theme['slug'] != 'twentyseventeen':
-                            goodthemes.append(theme)                 
-                    generate_sites(goodthemes)
-                    test_gtmetrix(goodthemes)
-                    acfdata = build_acfdata(goodthemes)
-                    post_pages(acfdata)
-                    post_rundown()
+                    tested = run_pipeline(delta, resume=args.resume)
+                    # Anything that didn't make it through stays in the delta for the next run
+                    index.update(tested)
+                    index.save()
                 else:
                     log.info("Dry run, otherwise we would totally be doing some theme testing.")
             else:
@@ -653,5 +1420,36 @@ def main():
         #post_content = render('rundown-template.html', acfdata)
         #print(post_content)
     
-if __name__== "__main__":
-  main()
+def cli(argv=None):
+    """Parse the command line and run the action"""
+
+    global args
+    args = build_parser().parse_args(argv)
+    setup_logging()
+    if args.test_action == "detect_new" and not args.resume:
+        # The usual cron outcome, settle it before loading anything else
+        last_run = last_run_date()
+        if last_run == datetime.datetime.now().strftime('%Y%m%d'):
+            logging.getLogger('detect_new').info(
+                "Not running, hasn't been long enough since last run: %s" % last_run)
+            return
+    load_config()
+    configure_http()
+    logging.info('Started %s' % __file__)
+    if args.dry_run:
+        print("Dry run %s" % args.test_action)
+    else:
+        print("Real run %s" % args.test_action)
+    try:
+        with tracing.span('stage', stage=args.test_action):
+            main()
+    finally:
+        wpworker.close_all()
+        if _site_teardown is not None:
+            _site_teardown.wait()
+        write_trace()
+
+
+if __name__ == "__main__":
+    activate_virtualenv()
+    cli()
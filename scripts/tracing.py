@@ -0,0 +1,152 @@
+"""Timing spans for a run.
+
+Wrap a unit of work in span(name, ...) to record its start, duration, bytes
+moved and status. Spans pick up the stage and theme of the span or
+context() they run inside (per thread), so every wp-cli call, HTTP request,
+download or poll can be attributed to the stage and theme it was done for.
+At the end of a run write_json() dumps every span and write_prometheus()
+writes per stage totals in the node_exporter textfile format."""
+
+import os
+import json
+import time
+import tempfile
+import threading
+from contextlib import contextmanager
+
+CONTEXT_KEYS = ('stage', 'theme')
+
+
+class Span(object):
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self.duration = None
+        self.bytes = 0
+        self.status = None
+        self.error = False
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def as_dict(self):
+        return dict(self.attrs, name=self.name, start=self.start, duration=self.duration,
+                    bytes=self.bytes, status=self.status, error=self.error)
+
+
+class Tracer(object):
+
+    def __init__(self):
+        self.spans = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.time()
+
+    def current(self):
+        """The stage/theme context of this thread"""
+
+        return getattr(self.local, 'context', {})
+
+    @contextmanager
+    def context(self, **attrs):
+        """Attribute the spans inside to a stage and/or theme without timing
+        anything itself"""
+
+        previous = self.current()
+        self.local.context = dict(previous, **dict((k, v) for k, v in attrs.items() if v is not None))
+        try:
+            yield
+        finally:
+            self.local.context = previous
+
+    @contextmanager
+    def span(self, name, **attrs):
+        """Time the block. Yields the Span so the block can set bytes and
+        status on it. An exception marks the span as an error."""
+
+        span = Span(name, dict(self.current(), **attrs))
+        try:
+            with self.context(**dict((k, attrs.get(k)) for k in CONTEXT_KEYS)):
+                yield span
+        except BaseException as e:
+            span.error = True
+            span.attrs.setdefault('exception', type(e).__name__)
+            raise
+        finally:
+            span.duration = time.time() - span.start
+            with self.lock:
+                self.spans.append(span)
+
+    def summary(self):
+        """Totals per (span name, stage)"""
+
+        totals = {}
+        with self.lock:
+            spans = list(self.spans)
+        for span in spans:
+            key = (span.name, span.attrs.get('stage', ''))
+            total = totals.setdefault(key, {'count': 0, 'seconds': 0.0, 'bytes': 0, 'errors': 0})
+            total['count'] += 1
+            total['seconds'] += span.duration
+            total['bytes'] += span.bytes or 0
+            total['errors'] += 1 if span.error else 0
+        return totals
+
+    def write_json(self, filename):
+        with self.lock:
+            spans = [span.as_dict() for span in self.spans]
+        trace = {
+            'started': self.started,
+            'duration': time.time() - self.started,
+            'summary': [dict(total, name=name, stage=stage)
+                        for (name, stage), total in sorted(self.summary().items())],
+            'spans': spans,
+        }
+        write_atomic(filename, json.dumps(trace, indent=1, default=str))
+
+    def write_prometheus(self, filename, prefix='themetest'):
+        lines = []
+        metrics = [
+            ('span_seconds', 'seconds', 'Time spent in spans of each kind in the last run'),
+            ('span_count', 'count', 'Number of spans of each kind in the last run'),
+            ('span_bytes', 'bytes', 'Bytes moved by spans of each kind in the last run'),
+            ('span_errors', 'errors', 'Spans of each kind that failed in the last run'),
+        ]
+        summary = sorted(self.summary().items())
+        for metric, field, help_text in metrics:
+            lines.append('# HELP %s_%s %s' % (prefix, metric, help_text))
+            lines.append('# TYPE %s_%s gauge' % (prefix, metric))
+            for (name, stage), total in summary:
+                lines.append('%s_%s{span="%s",stage="%s"} %s' % (
+                    prefix, metric, label(name), label(stage), total[field]))
+        lines.append('# HELP %s_run_duration_seconds Wall clock time of the last run' % prefix)
+        lines.append('# TYPE %s_run_duration_seconds gauge' % prefix)
+        lines.append('%s_run_duration_seconds %s' % (prefix, time.time() - self.started))
+        lines.append('# HELP %s_run_timestamp_seconds When the last run started' % prefix)
+        lines.append('# TYPE %s_run_timestamp_seconds gauge' % prefix)
+        lines.append('%s_run_timestamp_seconds %s' % (prefix, self.started))
+        write_atomic(filename, '\n'.join(lines) + '\n')
+
+
+def label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def write_atomic(filename, data):
+    directory = os.path.dirname(os.path.abspath(filename))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.part')
+    with os.fdopen(fd, 'w') as f:
+        f.write(data)
+    os.chmod(tmp, 0o644)
+    os.rename(tmp, filename)
+
+
+# The tracer for this process
+TRACER = Tracer()
+span = TRACER.span
+context = TRACER.context
+current = TRACER.current
@@ -0,0 +1,407 @@
+"""Durable work queue for running the pipeline across several hosts.
+
+The coordinator puts one job per theme into a SQLite database that every
+worker can reach. A job carries the theme and the list of stages to run;
+workers claim a job with a lease, keep the lease alive with heartbeats while
+a stage runs, and on success move the job on to its next stage. A theme's
+site only exists on the host that provisioned it, so once provisioning is
+done the job is pinned to that host and waits for a worker there. Leases
+that expire, because a worker died or lost contact, are put back in the
+queue until the job runs out of attempts. A pinned job whose lease expires,
+or whose host stops checking in, starts over from its first stage on any
+host, since its site may be gone with the host.
+
+Test results only land in the stores of the host that ran the test, so
+workers also add them to the queue's results table and the coordinator
+merges them into its own stores when the jobs are done.
+
+Workers on other hosts open the same database file over a shared
+filesystem, so it uses SQLite's rollback journal (WAL needs memory shared
+between the processes and only works on one host) and relies on the
+filesystem's locking: NFS needs working lockd (no `nolock` mount option),
+and filesystems without POSIX locks can't hold the queue."""
+
+import os
+import json
+import time
+import socket
+import sqlite3
+import logging
+import threading
+import traceback
+
+QUEUED = 'queued'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    slug TEXT NOT NULL,
+    version TEXT NOT NULL,
+    theme TEXT NOT NULL,
+    stages TEXT NOT NULL,
+    stage INTEGER NOT NULL DEFAULT 0,
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL DEFAULT 3,
+    host TEXT,
+    worker TEXT,
+    lease_expires REAL,
+    heartbeat REAL,
+    error TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    UNIQUE (slug, version)
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, lease_expires);
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    host TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created REAL NOT NULL,
+    merged REAL
+);
+CREATE INDEX IF NOT EXISTS results_merged ON results (merged, id);
+CREATE TABLE IF NOT EXISTS hosts (
+    host TEXT PRIMARY KEY,
+    seen REAL NOT NULL
+);
+'''
+
+
+class LeaseLost(Exception):
+    """The job was requeued or taken by another worker"""
+
+
+class WorkQueue(object):
+
+    def __init__(self, filename, lease=600):
+        self.filename = filename
+        self.lease = lease
+        self.log = logging.getLogger('workqueue')
+        db = self.connect()
+        try:
+            db.execute('PRAGMA journal_mode=DELETE')
+            db.executescript(SCHEMA)
+        finally:
+            db.close()
+
+    def connect(self):
+        # One connection per call, so the queue can be used from any thread
+        db = sqlite3.connect(self.filename, timeout=60, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        return db
+
+    def transaction(self, func, *args):
+        """Run func(db, *args) inside BEGIN IMMEDIATE, so claims by
+        concurrent workers are serialized"""
+
+        db = self.connect()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                res = func(db, *args)
+            except Exception:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+            return res
+        finally:
+            db.close()
+
+    def enqueue(self, themes, stages, max_attempts=3, resume=False):
+        """Queue a job per theme. With resume, themes that already have a job
+        keep it and its progress, otherwise the job starts over."""
+
+        def insert(db):
+            now = time.time()
+            added = 0
+            total = 0
+            for theme in themes:
+                total += 1
+                values = (theme['slug'], theme['version'], json.dumps(theme), json.dumps(stages),
+                          max_attempts, now, now)
+                if resume:
+                    cursor = db.execute(
+                        'INSERT OR IGNORE INTO jobs (slug, version, theme, stages, max_attempts, created, updated) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?)', values)
+                else:
+                    cursor = db.execute(
+                        'INSERT OR REPLACE INTO jobs (slug, version, theme, stages, max_attempts, created, updated) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?)', values)
+                added += cursor.rowcount
+            return added, total
+
+        added, total = self.transaction(insert)
+        self.log.info('Queued %s of %s themes' % (added, total))
+        return added
+
+    def requeue_expired(self, db):
+        """Put jobs whose lease ran out back in the queue, or fail them if
+        they are out of attempts. Jobs pinned to a host go back to their
+        first stage on any host, as do queued jobs pinned to a host that
+        hasn't checked in for a lease period. Call inside a transaction."""
+
+        now = time.time()
+        expired = db.execute('SELECT id, slug, worker, host, attempts, max_attempts FROM jobs '
+                             'WHERE state = ? AND lease_expires < ?', (LEASED, now)).fetchall()
+        for job in expired:
+            if job['attempts'] >= job['max_attempts']:
+                state, error = FAILED, 'lease expired on %s, out of attempts' % job['worker']
+            else:
+                state, error = QUEUED, 'lease expired on %s' % job['worker']
+            self.log.warning('%s: %s' % (job['slug'], error))
+            if job['host'] is not None and state == QUEUED:
+                self.log.warning('%s: starting over, its site was on %s' % (job['slug'], job['host']))
+                db.execute('UPDATE jobs SET stage = 0, host = NULL WHERE id = ?', (job['id'],))
+            db.execute('UPDATE jobs SET state = ?, worker = NULL, lease_expires = NULL, error = ?, '
+                       'updated = ? WHERE id = ?', (state, error, now, job['id']))
+        stranded = db.execute('SELECT id, slug, host FROM jobs WHERE state = ? AND host IS NOT NULL '
+                              'AND host NOT IN (SELECT host FROM hosts WHERE seen >= ?)',
+                              (QUEUED, now - self.lease)).fetchall()
+        for job in stranded:
+            self.log.warning('%s: %s has gone away, starting over' % (job['slug'], job['host']))
+            db.execute('UPDATE jobs SET stage = 0, host = NULL, error = ?, updated = ? WHERE id = ?',
+                       ('%s stopped checking in' % job['host'], now, job['id']))
+        return len(expired) + len(stranded)
+
+    @staticmethod
+    def seen(db, host):
+        db.execute('INSERT OR REPLACE INTO hosts (host, seen) VALUES (?, ?)', (host, time.time()))
+
+    def claim(self, worker, host):
+        """Lease the oldest job this host can run, returns it as a dict or
+        None if there is nothing for it right now"""
+
+        def take(db):
+            self.seen(db, host)
+            self.requeue_expired(db)
+            row = db.execute('SELECT * FROM jobs WHERE state = ? AND (host IS NULL OR host = ?) '
+                             'ORDER BY updated LIMIT 1', (QUEUED, host)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            db.execute('UPDATE jobs SET state = ?, worker = ?, attempts = attempts + 1, lease_expires = ?, '
+                       'heartbeat = ?, updated = ? WHERE id = ?',
+                       (LEASED, worker, now + self.lease, now, now, row['id']))
+            return self.job(db.execute('SELECT * FROM jobs WHERE id = ?', (row['id'],)).fetchone())
+
+        return self.transaction(take)
+
+    @staticmethod
+    def job(row):
+        job = dict(row)
+        job['theme'] = json.loads(row['theme'])
+        job['stages'] = json.loads(row['stages'])
+        return job
+
+    def heartbeat(self, job, worker, host):
+        """Extend the lease, raises LeaseLost if the job isn't ours anymore"""
+
+        def extend(db):
+            self.seen(db, host)
+            now = time.time()
+            cursor = db.execute('UPDATE jobs SET lease_expires = ?, heartbeat = ? '
+                                'WHERE id = ? AND state = ? AND worker = ?',
+                                (now + self.lease, now, job['id'], LEASED, worker))
+            return cursor.rowcount
+
+        if not self.transaction(extend):
+            raise LeaseLost('%s: lease lost' % job['slug'])
+
+    def complete(self, job, worker, host):
+        """Move the job on to its next stage, or mark it done after the
+        last one. The job stays on host from here on."""
+
+        def advance(db):
+            stage = job['stage'] + 1
+            state = DONE if stage >= len(job['stages']) else QUEUED
+            cursor = db.execute('UPDATE jobs SET stage = ?, state = ?, attempts = 0, host = ?, worker = NULL, '
+                                'lease_expires = NULL, error = NULL, updated = ? '
+                                'WHERE id = ? AND state = ? AND worker = ?',
+                                (stage, state, host, time.time(), job['id'], LEASED, worker))
+            return cursor.rowcount
+
+        if not self.transaction(advance):
+            raise LeaseLost('%s: lease lost before completing' % job['slug'])
+
+    def fail(self, job, worker, error):
+        """Record a failed attempt, the job is retried until it runs out of
+        attempts"""
+
+        def record(db):
+            state = FAILED if job['attempts'] >= job['max_attempts'] else QUEUED
+            db.execute('UPDATE jobs SET state = ?, worker = NULL, lease_expires = NULL, error = ?, updated = ? '
+                       'WHERE id = ? AND state = ? AND worker = ?',
+                       (state, error[-2000:], time.time(), job['id'], LEASED, worker))
+            return state
+
+        return self.transaction(record)
+
+    def counts(self):
+        """Number of jobs in each state"""
+
+        db = self.connect()
+        try:
+            rows = db.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall()
+        finally:
+            db.close()
+        return dict((state, count) for state, count in rows)
+
+    def pending(self, host):
+        """Jobs still queued or running that a worker on host could end up
+        running"""
+
+        db = self.connect()
+        try:
+            return db.execute('SELECT COUNT(*) FROM jobs WHERE state IN (?, ?) AND (host IS NULL OR host = ?)',
+                              (QUEUED, LEASED, host)).fetchone()[0]
+        finally:
+            db.close()
+
+    def jobs(self, state=None):
+        db = self.connect()
+        try:
+            if state is None:
+                rows = db.execute('SELECT * FROM jobs ORDER BY id').fetchall()
+            else:
+                rows = db.execute('SELECT * FROM jobs WHERE state = ? ORDER BY id', (state,)).fetchall()
+        finally:
+            db.close()
+        return [self.job(row) for row in rows]
+
+    def add_result(self, kind, host, payload):
+        """Record a result of the given kind from host for the coordinator
+        to merge, payload is anything JSON serializable"""
+
+        def insert(db):
+            db.execute('INSERT INTO results (kind, host, payload, created) VALUES (?, ?, ?, ?)',
+                       (kind, host, json.dumps(payload), time.time()))
+
+        self.transaction(insert)
+
+    def unmerged_results(self, batch_size=100):
+        """Yield every result not yet marked merged, oldest first, as a dict
+        with its payload decoded"""
+
+        last_id = 0
+        while True:
+            db = self.connect()
+            try:
+                rows = db.execute('SELECT * FROM results WHERE merged IS NULL AND id > ? ORDER BY id LIMIT ?',
+                                  (last_id, batch_size)).fetchall()
+            finally:
+                db.close()
+            if not rows:
+                return
+            for row in rows:
+                result = dict(row)
+                result['payload'] = json.loads(row['payload'])
+                yield result
+            last_id = rows[-1]['id']
+
+    def mark_merged(self, ids):
+        def mark(db):
+            now = time.time()
+            db.executemany('UPDATE results SET merged = ? WHERE id = ?', [(now, i) for i in ids])
+
+        if ids:
+            self.transaction(mark)
+
+    def wait(self, poll_interval=10):
+        """Block until every job is done or failed, requeueing expired leases
+        meanwhile. Returns the final counts."""
+
+        while True:
+            self.transaction(self.requeue_expired)
+            counts = self.counts()
+            if not counts.get(QUEUED) and not counts.get(LEASED):
+                return counts
+            self.log.info('Jobs: %s' % ', '.join('%s %s' % (counts[state], state) for state in sorted(counts)))
+            time.sleep(poll_interval)
+
+
+class QueueWorker(object):
+    """Claims jobs from a WorkQueue and runs their stages. stage_funcs maps
+    stage name to func(theme), which raises on failure."""
+
+    def __init__(self, queue, stage_funcs, host=None, threads=1, poll_interval=5, heartbeat_interval=None):
+        self.queue = queue
+        self.stage_funcs = stage_funcs
+        self.host = host or socket.gethostname()
+        self.threads = max(1, threads)
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval or max(1, queue.lease / 4.0)
+        self.log = logging.getLogger('queueworker')
+
+    def worker_id(self, index):
+        return '%s:%s:%s' % (self.host, os.getpid(), index)
+
+    def run_job(self, job, worker):
+        stage = job['stages'][job['stage']]
+        theme = job['theme']
+        self.log.info('%s: %s (attempt %s) on %s' % (job['slug'], stage, job['attempts'], worker))
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.heartbeat_interval):
+                try:
+                    self.queue.heartbeat(job, worker, self.host)
+                except LeaseLost:
+                    self.log.error('%s: lease lost while running %s' % (job['slug'], stage))
+                    return
+                except Exception:
+                    self.log.warning('%s: heartbeat failed\n%s' % (job['slug'], traceback.format_exc()))
+
+        heart = threading.Thread(target=beat, name='heartbeat-%s' % job['slug'])
+        heart.daemon = True
+        heart.start()
+        try:
+            self.stage_funcs[stage](theme)
+        except Exception:
+            error = traceback.format_exc()
+            self.log.error('%s: %s failed\n%s' % (job['slug'], stage, error))
+            state = self.queue.fail(job, worker, error)
+            self.log.info('%s: %s' % (job['slug'], 'requeued' if state == QUEUED else 'out of attempts'))
+            return
+        finally:
+            stop.set()
+            heart.join()
+        try:
+            self.queue.complete(job, worker, self.host)
+            self.log.info('%s: %s done' % (job['slug'], stage))
+        except LeaseLost as e:
+            self.log.error(str(e))
+
+    def loop(self, index):
+        worker = self.worker_id(index)
+        while True:
+            try:
+                job = self.queue.claim(worker, self.host)
+            except sqlite3.OperationalError:
+                self.log.warning('Could not claim a job\n%s' % traceback.format_exc())
+                job = None
+            if job is not None:
+                self.run_job(job, worker)
+                continue
+            if not self.queue.pending(self.host):
+                return
+            # Jobs running elsewhere may still come back to the queue
+            time.sleep(self.poll_interval)
+
+    def run(self):
+        """Work until there is nothing left in the queue"""
+
+        threads = []
+        for index in range(self.threads):
+            thread = threading.Thread(target=self.loop, args=(index,), name='queueworker-%s' % index)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            while thread.is_alive():
+                # A timeout keeps the wait interruptible with Ctrl-C
+                thread.join(1)
@@ -0,0 +1,146 @@
+<?php
+/*
+ * Long-lived WordPress command server for themetest.py (see wpworker.py):
+ *
+ *   wp --path=/path/to/site eval-file wp_worker.php
+ *
+ * Reads one JSON command per line from stdin, {"id", "command", "params"},
+ * and answers each with one JSON line on stdout prefixed by \x1e so that
+ * anything else WordPress prints can be told apart from the responses.
+ * Whatever a command echoes is buffered and sent back as the response's
+ * "output" instead of being mixed into the stream.
+ */
+
+require_once ABSPATH . 'wp-admin/includes/file.php';
+require_once ABSPATH . 'wp-admin/includes/media.php';
+require_once ABSPATH . 'wp-admin/includes/image.php';
+
+function themetest_cli($params) {
+  // Run a wp-cli command inside this process, nothing is re-bootstrapped
+  $command = implode(' ', array_map('escapeshellarg', $params['args']));
+  if (!empty($params['assoc'])) {
+    foreach ($params['assoc'] as $key => $value) {
+      $command .= ($value === true) ? " --$key" : " --$key=" . escapeshellarg($value);
+    }
+  }
+  $res = WP_CLI::runcommand($command, array(
+    'return' => 'all',
+    'launch' => false,
+    'exit_error' => false,
+  ));
+  return array(
+    'stdout' => $res->stdout,
+    'stderr' => $res->stderr,
+    'return_code' => $res->return_code,
+  );
+}
+
+function themetest_create_post($params) {
+  // Long content such as the rundown comes as a file rather than in the request
+  if (!empty($params['post_content_file'])) {
+    $content = file_get_contents($params['post_content_file']);
+    if ($content === false) {
+      throw new Exception("Can't read " . $params['post_content_file']);
+    }
+    $params['post']['post_content'] = trim($content);
+  }
+  $post_id = wp_insert_post(wp_slash($params['post']), true);
+  if (is_wp_error($post_id)) {
+    throw new Exception($post_id->get_error_message());
+  }
+  return $post_id;
+}
+
+function themetest_set_meta($params) {
+  foreach ($params['meta'] as $meta_key => $meta_value) {
+    update_post_meta($params['post_id'], $meta_key, wp_slash($meta_value));
+  }
+  return count($params['meta']);
+}
+
+function themetest_import_media($params) {
+  if (!file_exists($params['path'])) {
+    throw new Exception("Missing image " . $params['path']);
+  }
+  // media_handle_sideload moves the file, so hand it a copy
+  $tmp = wp_tempnam($params['path']);
+  copy($params['path'], $tmp);
+  $file = array('name' => basename($params['path']), 'tmp_name' => $tmp);
+  $image_id = media_handle_sideload($file, $params['post_id']);
+  if (is_wp_error($image_id)) {
+    @unlink($tmp);
+    throw new Exception($image_id->get_error_message());
+  }
+  if (!empty($params['featured'])) {
+    set_post_thumbnail($params['post_id'], $image_id);
+  }
+  return $image_id;
+}
+
+function themetest_publish($params) {
+  // Create a batch of posts with their custom fields and featured images
+  wp_defer_term_counting(true);
+  $results = array();
+  foreach ($params['items'] as $item) {
+    $result = array('key' => $item['key'], 'post_id' => null, 'image_id' => null);
+    try {
+      $result['post_id'] = themetest_create_post($item);
+      themetest_set_meta(array('post_id' => $result['post_id'], 'meta' => $item['meta']));
+      if (!empty($item['image'])) {
+        $result['image_id'] = themetest_import_media(array(
+          'path' => $item['image'],
+          'post_id' => $result['post_id'],
+          'featured' => true,
+        ));
+      }
+    } catch (Throwable $e) {
+      $result['error'] = $e->getMessage();
+    } catch (Exception $e) {
+      // PHP 5, which has no Throwable
+      $result['error'] = $e->getMessage();
+    }
+    $results[] = $result;
+  }
+  wp_defer_term_counting(false);
+  return $results;
+}
+
+$themetest_commands = array(
+  'ping' => function ($params) { return get_bloginfo('url'); },
+  'cli' => 'themetest_cli',
+  'create_post' => 'themetest_create_post',
+  'set_meta' => 'themetest_set_meta',
+  'import_media' => 'themetest_import_media',
+  'publish' => 'themetest_publish',
+);
+
+while (($line = fgets(STDIN)) !== false) {
+  $request = json_decode($line, true);
+  if (!is_array($request)) {
+    continue;
+  }
+  if ($request['command'] === 'quit') {
+    break;
+  }
+  $response = array('id' => $request['id']);
+  ob_start();
+  try {
+    if (!isset($themetest_commands[$request['command']])) {
+      throw new Exception("Unknown command " . $request['command']);
+    }
+    $params = isset($request['params']) ? $request['params'] : array();
+    $response['result'] = call_user_func($themetest_commands[$request['command']], $params);
+    $response['ok'] = true;
+  } catch (Throwable $e) {
+    // Errors as well as exceptions, one bad call mustn't end the worker
+    $response['ok'] = false;
+    $response['error'] = get_class($e) . ': ' . $e->getMessage();
+  } catch (Exception $e) {
+    // PHP 5, which has no Throwable
+    $response['ok'] = false;
+    $response['error'] = $e->getMessage();
+  }
+  $response['output'] = ob_get_clean();
+  fwrite(STDOUT, "\x1e" . json_encode($response) . "\n");
+  fflush(STDOUT);
+}
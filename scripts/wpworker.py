@@ -0,0 +1,194 @@
+"""Persistent WordPress command workers.
+
+A WPWorker keeps one `wp eval-file wp_worker.php` process open per site and
+sends it structured commands over a pipe, so every call after the first
+skips the shell, PHP startup and WordPress load. FakeWPWorker has the same
+interface but only logs the commands, for dry runs and tests.
+
+Responses are JSON lines starting with RESPONSE_MARKER. Output a command
+prints itself is captured into the response, but anything written straight
+to the stdout descriptor can still end up in front of the marker on the
+same line, so the marker is looked for anywhere in a line. A worker that
+doesn't answer within timeout seconds is killed."""
+
+import os
+import json
+import time
+import errno
+import select
+import logging
+import threading
+import subprocess
+
+import tracing
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wp_worker.php')
+RESPONSE_MARKER = '\x1e'
+RESPONSE_TIMEOUT = 600
+
+_workers = {}
+_workers_lock = threading.Lock()
+
+
+class WPWorkerError(Exception):
+    pass
+
+
+class WPWorker(object):
+    """A running wp_worker.php bound to one WordPress install"""
+
+    def __init__(self, site_path, wp_cli_path='wp', timeout=RESPONSE_TIMEOUT):
+        self.site_path = site_path
+        self.wp_cli_path = wp_cli_path
+        self.timeout = timeout
+        self.proc = None
+        self.buffer = ''
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.log = logging.getLogger('wpworker')
+
+    def start(self):
+        command = [self.wp_cli_path, '--path=%s' % self.site_path, 'eval-file', WORKER_SCRIPT]
+        self.log.info('Starting worker: %s' % ' '.join(command))
+        self.proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE, bufsize=1,
+                                     universal_newlines=True)
+        self.buffer = ''
+
+    def readline(self, deadline):
+        """The next line of output, '' at end of file. Reads the pipe
+        directly so select() sees everything that hasn't been consumed"""
+
+        fd = self.proc.stdout.fileno()
+        while '\n' not in self.buffer:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.proc.kill()
+                self.proc.wait()
+                raise WPWorkerError('Worker for %s did not answer within %s seconds' % (
+                    self.site_path, self.timeout))
+            try:
+                ready, _, _ = select.select([fd], [], [], remaining)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not ready:
+                continue
+            data = os.read(fd, 65536)
+            if not data:
+                line, self.buffer = self.buffer, ''
+                return line
+            self.buffer += data
+        line, self.buffer = self.buffer.split('\n', 1)
+        return line + '\n'
+
+    def call(self, command, **params):
+        """Run a command in the worker and return its result, raises
+        WPWorkerError if the command failed"""
+
+        attrs = {'command': command, 'site': os.path.basename(self.site_path)}
+        if command == 'cli':
+            attrs['cli'] = ' '.join(params['args'][:2])
+        with self.lock, tracing.span('wp', **attrs) as span:
+            if self.proc is None or self.proc.poll() is not None:
+                self.start()
+            self.next_id += 1
+            request = {'id': self.next_id, 'command': command, 'params': params}
+            self.log.debug('%s: %s' % (self.site_path, command))
+            self.proc.stdin.write(json.dumps(request) + '\n')
+            self.proc.stdin.flush()
+            deadline = time.time() + self.timeout
+            while True:
+                line = self.readline(deadline)
+                if not line:
+                    self.proc.wait()
+                    raise WPWorkerError('Worker for %s exited with status %s' % (
+                        self.site_path, self.proc.returncode))
+                output, marker, reply = line.partition(RESPONSE_MARKER)
+                if output.strip():
+                    self.log.debug('%s: %s' % (self.site_path, output.rstrip()))
+                if marker:
+                    response = json.loads(reply)
+                    if response.get('output'):
+                        self.log.debug('%s: %s' % (self.site_path, response['output'].rstrip()))
+                    if response.get('id') == request['id']:
+                        span.bytes = len(line)
+                        span.status = 'ok' if response['ok'] else 'failed'
+                        if response['ok'] and command == 'cli':
+                            span.status = response['result']['return_code']
+                        span.error = span.status not in ('ok', 0)
+                        break
+        if not response['ok']:
+            raise WPWorkerError('%s failed: %s' % (command, response['error']))
+        return response['result']
+
+    def cli(self, *args, **assoc):
+        """Run a wp-cli command in-process, returns its stdout. Pass
+        flag=True for bare --flag options"""
+
+        res = self.call('cli', args=list(args), assoc=assoc)
+        if res['return_code'] != 0:
+            raise WPWorkerError('wp %s failed (%s): %s' % (
+                ' '.join(args), res['return_code'], res['stderr'].strip()))
+        return res['stdout']
+
+    def close(self):
+        with self.lock:
+            if self.proc is not None and self.proc.poll() is None:
+                self.proc.stdin.write(json.dumps({'id': 0, 'command': 'quit'}) + '\n')
+                self.proc.stdin.close()
+                self.proc.wait()
+            self.proc = None
+
+
+class FakeWPWorker(WPWorker):
+    """Logs every command instead of running it, results are placeholders"""
+
+    fake_results = {
+        'ping': 'http://example.test/',
+        'create_post': 4321,
+        'set_meta': 0,
+        'import_media': 5432,
+    }
+
+    def __init__(self, site_path, wp_cli_path='wp', timeout=RESPONSE_TIMEOUT):
+        super(FakeWPWorker, self).__init__(site_path, wp_cli_path, timeout)
+        self.commands = []
+
+    def call(self, command, **params):
+        self.commands.append((command, params))
+        self.log.info('Dry run %s: %s %s' % (self.site_path, command, json.dumps(params)[:200]))
+        if command == 'cli':
+            return {'stdout': '', 'stderr': '', 'return_code': 0}
+        if command == 'publish':
+            return [{'key': item['key'], 'post_id': 4321, 'image_id': 5432} for item in params['items']]
+        return self.fake_results.get(command)
+
+    def close(self):
+        pass
+
+
+def get_worker(site_path, wp_cli_path='wp', dry_run=False):
+    """Return the shared worker for site_path, starting it on first use"""
+
+    with _workers_lock:
+        if site_path not in _workers:
+            cls = FakeWPWorker if dry_run else WPWorker
+            _workers[site_path] = cls(site_path, wp_cli_path)
+        return _workers[site_path]
+
+
+def close_worker(site_path):
+    with _workers_lock:
+        worker = _workers.pop(site_path, None)
+    if worker:
+        worker.close()
+
+
+def close_all():
+    with _workers_lock:
+        workers = list(_workers.values())
+        _workers.clear()
+    for worker in workers:
+        worker.close()
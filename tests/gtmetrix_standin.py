@@ -0,0 +1,106 @@
+"""A local stand-in for the GTMetrix 0.1 API.
+
+Serves the calls GTmetrixScheduler makes, POST /test, GET /test/<id> and
+GET /status, from memory on a free port. Tests finish after a number of
+polls and every submit spends a credit. A URL can be made to fail: put it
+in `errors` and its test ends in the error state, put it in `expired` and
+polling it returns 404 forever, like a test GTMetrix has forgotten."""
+
+import json
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs
+
+
+class StandinServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, credits=10, polls_to_complete=2, max_queued=None):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StandinHandler)
+        self.credits = credits
+        self.polls_to_complete = polls_to_complete
+        self.max_queued = max_queued
+        self.errors = set()
+        self.expired = set()
+        self.tests = {}
+        self.submitted = []
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s' % self.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name='gtmetrix-standin')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+    def running(self):
+        return len([test for test in self.tests.values() if test['state'] != 'completed'])
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body):
+        data = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        server = self.server
+        form = parse_qs(self.rfile.read(int(self.headers.getheader('Content-Length') or 0)))
+        url = form.get('url', [''])[0]
+        with server.lock:
+            if server.max_queued is not None and server.running() >= server.max_queued:
+                return self.reply(429, {'error': 'Too many tests queued'})
+            if server.credits <= 0:
+                return self.reply(402, {'error': 'Maximum number of API calls reached'})
+            server.credits -= 1
+            test_id = 'test%s' % (len(server.tests) + 1)
+            server.tests[test_id] = {'url': url, 'polls': 0, 'state': 'queued'}
+            server.submitted.append(url)
+            credits = server.credits
+        self.reply(200, {
+            'test_id': test_id,
+            'poll_state_url': '%s/test/%s' % (server.url, test_id),
+            'credits_left': credits,
+        })
+
+    def do_GET(self):
+        server = self.server
+        if self.path == '/status':
+            with server.lock:
+                return self.reply(200, {'api_credits': server.credits})
+        test_id = self.path.rstrip('/').split('/')[-1]
+        with server.lock:
+            test = server.tests.get(test_id)
+            if test is None or test['url'] in server.expired:
+                return self.reply(404, {'error': 'Test not found'})
+            test['polls'] += 1
+            if test['polls'] >= server.polls_to_complete:
+                test['state'] = 'error' if test['url'] in server.errors else 'completed'
+            else:
+                test['state'] = 'started'
+            state = test['state']
+            url = test['url']
+        body = {'state': state, 'error': '', 'results': {}, 'resources': {}}
+        if state == 'completed':
+            body['results'] = {'page_load_time': 1000, 'pagespeed_score': 90, 'report_url': url}
+            body['resources'] = {'screenshot': None, 'har': None}
+        elif state == 'error':
+            body['error'] = 'Could not reach %s' % url
+        self.reply(200, body)
@@ -0,0 +1,130 @@
+import os
+import re
+import json
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import httpclient
+from artifactcache import ArtifactCache
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serves the server's body with its etag, honouring Range/If-Range.
+    While the server's cut is set a full response stops after that many
+    bytes and the body is replaced by the server's next body."""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        body, status = server.body, 200
+        match = re.match(r'bytes=(\d+)-', self.headers.getheader('Range') or '')
+        if match and self.headers.getheader('If-Range') in (None, server.etag):
+            body, status = body[int(match.group(1)):], 206
+        self.send_response(status)
+        self.send_header('ETag', server.etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if status == 200 and server.cut:
+            self.wfile.write(body[:server.cut])
+            server.cut = None
+            if server.next_body != server.body:
+                server.body, server.etag = server.next_body, '"%s"' % len(server.requests)
+            return
+        self.wfile.write(body)
+
+
+class ArtifactCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.server.requests = []
+        self.server.body, self.server.etag, self.server.cut, self.server.next_body = 'a' * 1000, '"a"', None, None
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%s/latest.zip' % self.server.server_address[1]
+        self.cache = ArtifactCache(self.directory, http=httpclient.new_session(retries=0))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def read(self, url, cache=None):
+        with (cache or self.cache).use(url) as path, open(path) as f:
+            return f.read()
+
+    def test_resumes_an_unchanged_download(self):
+        self.server.cut, self.server.next_body = 400, 'a' * 1000
+        self.assertEqual(self.read(self.url), 'a' * 1000)
+        self.assertEqual(self.server.requests[1].get('range'), 'bytes=400-')
+
+    def test_changed_resource_is_not_spliced(self):
+        self.server.cut, self.server.next_body = 400, 'b' * 1200
+        self.assertEqual(self.read(self.url), 'b' * 1200)
+        self.assertEqual(self.server.requests[1].get('if-range'), '"a"')
+
+    def test_partial_without_validator_is_discarded(self):
+        partial = self.cache.partial_path(self.cache.key(self.url))
+        with open(partial, 'w') as f:
+            f.write('old')
+        self.assertEqual(self.read(self.url), 'a' * 1000)
+        self.assertNotIn('range', self.server.requests[0])
+
+    def test_replaced_blob_is_deleted(self):
+        with self.cache.use(self.url) as first:
+            pass
+        self.server.body, self.server.etag = 'c' * 10, '"c"'
+        self.assertEqual(self.read(self.url), 'c' * 10)
+        self.assertFalse(os.path.exists(first))
+
+    def test_blob_in_use_outlives_its_entry(self):
+        with self.cache.use(self.url) as first:
+            self.server.body, self.server.etag = 'c' * 10, '"c"'
+            self.assertEqual(self.read(self.url), 'c' * 10)
+            self.assertTrue(os.path.exists(first))
+        self.server.body, self.server.etag = 'd' * 10, '"d"'
+        self.read(self.url)
+        self.assertFalse(os.path.exists(first))
+        self.assertEqual(len(self.cache.index), 1)
+
+    def test_eviction_skips_blobs_in_use(self):
+        self.cache.max_bytes = 1500
+        with self.cache.use(self.url) as first:
+            self.server.body = 'e' * 1000
+            self.read(self.url + '?2')
+            self.assertTrue(os.path.exists(first))
+        self.server.body = 'f' * 1000
+        self.read(self.url + '?3')
+        self.assertFalse(os.path.exists(first))
+
+    def test_caches_sharing_a_directory(self):
+        other = ArtifactCache(self.directory, http=httpclient.new_session(retries=0))
+        self.read(self.url)
+        self.read(self.url + '?2', cache=other)
+        self.read(self.url + '?3')
+        with open(os.path.join(self.directory, 'index.json')) as f:
+            self.assertEqual(len(json.load(f)), 3)
+        requests = len(self.server.requests)
+        self.read(self.url + '?2')
+        self.assertEqual(len(self.server.requests), requests + 1)
+        self.assertIn('if-none-match', self.server.requests[-1])
+
+    def test_use_many(self):
+        urls = [(self.url + '?%s' % i, '1.0', None) for i in range(3)] + [('http://127.0.0.1:1/', None, None)]
+        with self.cache.use_many(urls, workers=2) as paths:
+            self.assertEqual([os.path.getsize(path) for path in paths[:3]], [1000] * 3)
+            self.assertIsNone(paths[3])
+
+if __name__ == '__main__':
+    unittest.main()
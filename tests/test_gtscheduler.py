@@ -0,0 +1,93 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import httpclient
+from gtscheduler import GTmetrixScheduler
+from gtmetrix_standin import StandinServer
+
+
+class GTmetrixSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandinServer().start()
+        self.completed = []
+        self.errors = []
+
+    def tearDown(self):
+        self.server.stop()
+
+    def scheduler(self, **kwargs):
+        kwargs.setdefault('concurrency', 2)
+        kwargs.setdefault('poll_interval', 0.01)
+        kwargs.setdefault('max_poll_interval', 0.05)
+        kwargs.setdefault('on_complete', lambda key, data: self.completed.append(key))
+        kwargs.setdefault('on_error', lambda key, data: self.errors.append(key))
+        return GTmetrixScheduler('user', 'key', api_url=self.server.url, http=httpclient.new_session(retries=0),
+                                 **kwargs)
+
+    def add_sites(self, scheduler, count):
+        for i in range(count):
+            scheduler.add('site%s' % i, 'http://example.test/site%s/' % i)
+
+    def test_runs_every_test(self):
+        scheduler = self.scheduler()
+        self.add_sites(scheduler, 5)
+        results = scheduler.run()
+        self.assertEqual(sorted(results), ['site%s' % i for i in range(5)])
+        self.assertEqual(sorted(self.completed), sorted(results))
+        self.assertEqual(self.errors, [])
+        self.assertEqual(results['site0']['results']['pagespeed_score'], 90)
+        self.assertEqual(self.server.credits, 5)
+
+    def test_stops_when_credits_run_out(self):
+        self.server.credits = 2
+        scheduler = self.scheduler()
+        self.add_sites(scheduler, 5)
+        results = scheduler.run()
+        self.assertEqual(len(results), 2)
+        self.assertEqual(sorted(self.errors), ['site2', 'site3', 'site4'])
+        self.assertEqual(len(self.server.submitted), 2)
+
+    def test_waits_when_too_many_tests_are_queued(self):
+        self.server.max_queued = 1
+        scheduler = self.scheduler(concurrency=3)
+        self.add_sites(scheduler, 3)
+        self.assertEqual(len(scheduler.run()), 3)
+        self.assertEqual(self.errors, [])
+
+    def test_errored_test(self):
+        self.server.errors.add('http://example.test/site1/')
+        scheduler = self.scheduler()
+        self.add_sites(scheduler, 3)
+        self.assertEqual(sorted(scheduler.run()), ['site0', 'site2'])
+        self.assertEqual(self.errors, ['site1'])
+
+    def test_gives_up_on_a_test_that_never_finishes(self):
+        self.server.expired.add('http://example.test/site0/')
+        scheduler = self.scheduler(max_test_age=0.3)
+        self.add_sites(scheduler, 2)
+        started = time.time()
+        self.assertEqual(sorted(scheduler.run()), ['site1'])
+        self.assertEqual(self.errors, ['site0'])
+        self.assertLess(time.time() - started, 5)
+
+    def test_failing_callback_does_not_stop_other_tests(self):
+        def on_complete(key, data):
+            if key == 'site0':
+                raise IOError('disk full')
+            self.completed.append(key)
+
+        scheduler = self.scheduler(on_complete=on_complete)
+        self.add_sites(scheduler, 4)
+        results = scheduler.run()
+        self.assertEqual(sorted(results), ['site1', 'site2', 'site3'])
+        self.assertEqual(sorted(self.completed), ['site1', 'site2', 'site3'])
+        self.assertEqual(self.errors, ['site0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import ranking
+from resultstore import ResultStore
+
+
+class PercentileRanksTest(unittest.TestCase):
+
+    def test_mid_ranks_with_ties_and_missing_values(self):
+        values = np.array([[1.0, 5.0], [2.0, np.nan], [2.0, 3.0], [4.0, 4.0]])
+        res = ranking.percentile_ranks(values)
+        np.testing.assert_allclose(res[:, 0], [12.5, 50.0, 50.0, 87.5])
+        np.testing.assert_allclose(res[[0, 2, 3], 1], [100 * 2.5 / 3, 100 * 0.5 / 3, 100 * 1.5 / 3])
+        self.assertTrue(np.isnan(res[1, 1]))
+
+    def test_last_per_group(self):
+        self.assertEqual(ranking.last_per_group(np.array([1, 1, 2, 3, 3, 3])).tolist(), [1, 2, 5])
+        self.assertEqual(ranking.last_per_group(np.array([], dtype=np.intc)).tolist(), [])
+
+
+class RankTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = ResultStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def add(self, theme, version, timestamp, pagespeed, load_time, label='gtmetrix'):
+        self.store.append(theme, version, timestamp,
+                          {'pagespeed_score': pagespeed, 'fully_loaded_time': load_time}, label=label)
+
+    def leaderboard(self, label='gtmetrix'):
+        snapshot = self.store.snapshot()
+        return ranking.leaderboard(ranking.rank(snapshot, label), snapshot, label)
+
+    def test_latest_runs_are_ranked(self):
+        self.add('fast', '1.0', 100, 95, 800)
+        self.add('slow', '1.0', 110, 60, 4000)
+        self.add('middle', '1.0', 120, 80, 2000)
+        self.add('slow', '1.0', 130, 99, 500, label='local')
+        board = self.leaderboard()
+        self.assertEqual(board['order'], ['fast', 'middle', 'slow'])
+        self.assertEqual(board['total'], 3)
+        fast = board['themes']['fast']
+        self.assertEqual((fast['rank'], fast['version'], fast['timestamp']), (1, '1.0', 100))
+        self.assertEqual(len(fast['percentiles']), len(board['metrics']))
+        self.assertNotIn('deltas', fast)
+
+    def test_deltas_against_the_previous_version(self):
+        self.add('a', '1.0', 100, 80, 2000)
+        self.add('a', '1.0', 110, 82, 1900)
+        self.add('a', '1.1', 120, 90, 1500)
+        self.add('b', '2.0', 130, 70, 3000)
+        board = self.leaderboard()
+        entry = board['themes']['a']
+        self.assertEqual((entry['version'], entry['previous_version']), ('1.1', '1.0'))
+        deltas = dict(zip(board['metrics'], entry['deltas']))
+        self.assertEqual(deltas['pagespeed_score'], 8)
+        self.assertEqual(deltas['fully_loaded_time'], -400)
+        self.assertIsNone(deltas['page_bytes'])
+
+    def test_runs_out_of_time_order(self):
+        self.add('a', '1.1', 200, 90, 1500)
+        self.add('a', '1.0', 100, 50, 5000)
+        self.add('b', '1.0', 150, 70, 3000)
+        entry = self.leaderboard()['themes']['a']
+        self.assertEqual((entry['version'], entry['previous_version'], entry['rank']), ('1.1', '1.0', 1))
+
+    def test_unknown_label(self):
+        self.add('a', '1.0', 100, 90, 1500)
+        board = self.leaderboard(label='missing')
+        self.assertEqual((board['total'], board['order'], board['themes']), (0, [], {}))
+
+    def test_save(self):
+        self.add('a', '1.0', 100, 90, 1500)
+        filename = os.path.join(self.directory, 'out', 'leaderboard.json')
+        ranking.save(self.leaderboard(), filename)
+        with open(filename) as f:
+            self.assertEqual(json.load(f)['order'], ['a'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from resultstore import ResultStore, METRICS
+
+
+def append_runs(directory, worker, count):
+    store = ResultStore(directory)
+    for i in range(count):
+        store.append('theme%s' % (i % 3), '1.%s' % worker, None, {'page_bytes': worker * 1000 + i})
+
+
+class ResultStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = ResultStore(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_append_and_query(self):
+        self.store.append('a', '1.0', 100, {'page_bytes': 10, 'pagespeed_score': 'n/a'}, label='gtmetrix')
+        self.store.append('b', '1.0', 200, {'page_bytes': 20}, label='gtmetrix')
+        self.store.append('a', '1.1', 300, {'page_bytes': 30}, label='local')
+        res = self.store.query(theme='a')
+        self.assertEqual(res['version'], ['1.0', '1.1'])
+        self.assertEqual(res['page_bytes'], [10, 30])
+        self.assertNotEqual(res['pagespeed_score'][0], res['pagespeed_score'][0])
+        self.assertEqual(self.store.query(label='gtmetrix', columns=['theme'])['theme'], ['a', 'b'])
+        self.assertEqual(self.store.query(theme='missing')['timestamp'], [])
+        self.assertEqual(sorted(self.store.query()), sorted(['timestamp', 'theme', 'version', 'label'] + METRICS))
+
+    def test_time_range(self):
+        for timestamp in (100, 200, 300, 400):
+            self.store.append('a', '1.0', timestamp, {})
+        self.assertEqual(self.store.query(start=200, end=400)['timestamp'], [200, 300])
+        self.assertTrue(self.store.sorted)
+
+    def test_time_range_out_of_order(self):
+        for timestamp in (300, 100, 400, 200):
+            self.store.append('a', '1.0', timestamp, {})
+        self.assertFalse(self.store.sorted)
+        self.assertEqual(sorted(self.store.query(start=200, end=400)['timestamp']), [200, 300])
+
+    def test_append_stamps_runs_without_a_timestamp(self):
+        first = self.store.append('a', '1.0', None, {})
+        second = self.store.append('a', '1.0', None, {})
+        self.assertLessEqual(first, second)
+        self.assertEqual(self.store.query()['timestamp'], [first, second])
+
+    def test_latest(self):
+        self.store.append('a', '1.0', 200, {'page_bytes': 2})
+        self.store.append('a', '0.9', 100, {'page_bytes': 1})
+        self.store.append('b', '1.0', 300, {'page_bytes': 3})
+        self.assertEqual(self.store.latest('a')['version'], '1.0')
+        self.assertIsNone(self.store.latest('missing'))
+
+    def test_reopen(self):
+        self.store.append('a', '1.0', 100, {'page_bytes': 10})
+        store = ResultStore(self.directory)
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.latest('a')['page_bytes'], 10)
+
+    def test_torn_append_is_repaired(self):
+        self.store.append('a', '1.0', 100, {})
+        with open(os.path.join(self.directory, 'timestamp.col'), 'ab') as f:
+            f.write('\0' * 12)
+        store = ResultStore(self.directory)
+        self.assertEqual(len(store), 1)
+        store.append('b', '1.0', 200, {})
+        self.assertEqual(store.query(columns=['theme'])['theme'], ['a', 'b'])
+
+    def test_partial_value_is_repaired(self):
+        self.store.append('a', '1.0', 100, {'page_bytes': 1})
+        with open(os.path.join(self.directory, 'page_bytes.col'), 'ab') as f:
+            f.write('\0' * 4)
+        store = ResultStore(self.directory)
+        store.append('b', '1.0', 200, {'page_bytes': 2})
+        self.assertEqual(ResultStore(self.directory).query(columns=['page_bytes'])['page_bytes'], [1, 2])
+
+    def test_appends_from_several_processes(self):
+        processes = [multiprocessing.Process(target=append_runs, args=(self.directory, worker, 20))
+                     for worker in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        store = ResultStore(self.directory)
+        res = store.query()
+        self.assertEqual(len(res['timestamp']), 80)
+        self.assertEqual(len(store.strings), len(set(store.strings)))
+        self.assertEqual(res['timestamp'], sorted(res['timestamp']))
+        for version, page_bytes in zip(res['version'], res['page_bytes']):
+            self.assertEqual(int(page_bytes) // 1000, int(version.split('.')[1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
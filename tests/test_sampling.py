@@ -0,0 +1,85 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import sampling
+
+
+class FakeBackend(object):
+    """Hands out page_bytes from a list per site, no result once it runs out"""
+
+    def __init__(self, values):
+        self.values = dict((key, list(values)) for key, values in values.items())
+
+    def run(self, tests):
+        res = {}
+        for key, url in tests:
+            if self.values[key]:
+                value = self.values[key].pop(0)
+                res[key] = {'results': {'page_bytes': value, 'report_url': url}}
+        return res
+
+
+class StatisticsTest(unittest.TestCase):
+
+    def test_percentile(self):
+        self.assertEqual(sampling.percentile([5, 1, 3], 50), 3)
+        self.assertEqual(sampling.percentile([1, 2, 3, 4], 50), 2.5)
+        self.assertAlmostEqual(sampling.percentile(range(1, 11), 90), 9.1)
+        self.assertEqual(sampling.percentile([7], 90), 7)
+        self.assertIsNone(sampling.percentile([], 50))
+
+    def test_summarize_skips_non_numeric_values(self):
+        samples = [{'page_bytes': 10, 'pagespeed_score': None}, {'page_bytes': float('nan')},
+                   {'page_bytes': 30, 'pagespeed_score': True}, {'page_bytes': 20}]
+        summary = sampling.summarize(samples, metrics=['page_bytes', 'pagespeed_score'])
+        self.assertEqual(summary, {'page_bytes': {'median': 20, 'p90': 28.0, 'min': 10, 'max': 30, 'n': 3}})
+
+    def test_mann_whitney(self):
+        u, p = sampling.mann_whitney([1, 2, 3, 4, 5, 6], [11, 12, 13, 14, 15, 16])
+        self.assertEqual(u, 0)
+        self.assertLess(p, 0.01)
+        u, p = sampling.mann_whitney([1, 3, 5, 7], [2, 4, 6, 8])
+        self.assertGreater(p, 0.5)
+        self.assertEqual(sampling.mann_whitney([1, 1, 1], [1, 1, 1]), (4.5, 1.0))
+        self.assertEqual(sampling.mann_whitney([], [1]), (None, 1.0))
+
+    def test_compare(self):
+        a = [{'page_bytes': value} for value in (100, 101, 102, 103, 104, 105)]
+        b = [{'page_bytes': value} for value in (150, 151, 152, 153, 154, 155)]
+        res = sampling.compare(a, b, metrics=['page_bytes', 'pagespeed_score'])
+        self.assertEqual(list(res), ['page_bytes'])
+        self.assertEqual(res['page_bytes']['change'], 50)
+        self.assertAlmostEqual(res['page_bytes']['change_pct'], 50 * 100.0 / 102.5)
+        self.assertTrue(res['page_bytes']['significant'])
+        self.assertFalse(sampling.compare(a, a)['page_bytes']['significant'])
+
+
+class BenchmarkTest(unittest.TestCase):
+
+    def test_benchmark_and_median_result(self):
+        backend = FakeBackend({'a': [30, 10, 20], 'b': [5]})
+        stored = []
+        res = sampling.benchmark(backend, [('a', 'http://a.test/'), ('b', 'http://b.test/')], samples=3,
+                                 warmup=0, concurrency=2, on_sample=lambda key, data: stored.append(key))
+        self.assertEqual(len(res['a']['samples']), 3)
+        self.assertEqual(len(res['b']['samples']), 1)
+        self.assertEqual(sorted(stored), ['a', 'a', 'a', 'b'])
+        self.assertEqual(res['a']['summary']['page_bytes']['median'], 20)
+        median = sampling.median_result(res['a'])
+        self.assertEqual(median['results'], {'page_bytes': 20, 'report_url': 'http://a.test/'})
+        self.assertEqual(res['a']['samples'][-1]['results']['page_bytes'], 20)
+
+    def test_failing_callback_keeps_sampling(self):
+        def on_sample(key, data):
+            raise IOError('disk full')
+
+        backend = FakeBackend({'a': [1, 2]})
+        res = sampling.benchmark(backend, [('a', 'http://a.test/')], samples=2, warmup=0, on_sample=on_sample)
+        self.assertEqual(len(res['a']['samples']), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import workqueue
+
+STAGES = ['provision', 'test', 'publish']
+
+
+class WorkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.queue = workqueue.WorkQueue(os.path.join(self.directory, 'queue.db'), lease=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def enqueue(self, *slugs, **kwargs):
+        themes = ({'slug': slug, 'version': '1.0'} for slug in slugs)
+        return self.queue.enqueue(themes, STAGES, **kwargs)
+
+    def expire(self, job):
+        db = self.queue.connect()
+        try:
+            db.execute('UPDATE jobs SET lease_expires = ? WHERE id = ?', (time.time() - 1, job['id']))
+        finally:
+            db.close()
+
+    def test_enqueue_and_resume(self):
+        self.assertEqual(self.enqueue('a', 'b'), 2)
+        job = self.queue.claim('w1', 'host1')
+        self.queue.complete(job, 'w1', 'host1')
+        self.assertEqual(self.enqueue('a', 'b', 'c', resume=True), 1)
+        jobs = dict((job['slug'], job) for job in self.queue.jobs())
+        self.assertEqual(jobs[job['slug']]['stage'], 1)
+        self.assertEqual(jobs['c']['theme'], {'slug': 'c', 'version': '1.0'})
+
+    def test_claim_runs_stages_in_order_on_one_host(self):
+        self.enqueue('a')
+        for stage in range(len(STAGES)):
+            if stage:
+                # Pinned to the host that provisioned it
+                self.assertIsNone(self.queue.claim('w2', 'host2'))
+            job = self.queue.claim('w1', 'host1')
+            self.assertEqual(job['stage'], stage)
+            self.assertEqual(job['attempts'], 1)
+            self.queue.complete(job, 'w1', 'host1')
+        self.assertEqual(self.queue.counts(), {workqueue.DONE: 1})
+        self.assertIsNone(self.queue.claim('w1', 'host1'))
+
+    def test_fail_retries_until_out_of_attempts(self):
+        self.enqueue('a')
+        claims = 0
+        while True:
+            job = self.queue.claim('w1', 'host1')
+            if job is None:
+                break
+            claims += 1
+            self.assertEqual(job['attempts'], claims)
+            state = self.queue.fail(job, 'w1', 'boom')
+        self.assertEqual(claims, 3)
+        self.assertEqual(state, workqueue.FAILED)
+        self.assertEqual(self.queue.jobs(workqueue.FAILED)[0]['error'], 'boom')
+
+    def test_expired_lease_is_requeued(self):
+        self.enqueue('a')
+        job = self.queue.claim('w1', 'host1')
+        self.expire(job)
+        again = self.queue.claim('w2', 'host1')
+        self.assertEqual(again['id'], job['id'])
+        self.assertEqual(again['attempts'], 2)
+        self.assertRaises(workqueue.LeaseLost, self.queue.heartbeat, job, 'w1', 'host1')
+        self.assertRaises(workqueue.LeaseLost, self.queue.complete, job, 'w1', 'host1')
+
+    def test_expired_pinned_job_starts_over_on_any_host(self):
+        self.enqueue('a')
+        job = self.queue.claim('w1', 'host1')
+        self.queue.complete(job, 'w1', 'host1')
+        job = self.queue.claim('w1', 'host1')
+        self.expire(job)
+        again = self.queue.claim('w2', 'host2')
+        self.assertEqual((again['id'], again['stage'], again['host']), (job['id'], 0, None))
+
+    def test_job_pinned_to_a_vanished_host_starts_over(self):
+        self.enqueue('a')
+        job = self.queue.claim('w1', 'host1')
+        self.queue.complete(job, 'w1', 'host1')
+        db = self.queue.connect()
+        try:
+            db.execute('UPDATE hosts SET seen = ? WHERE host = ?', (time.time() - 120, 'host1'))
+        finally:
+            db.close()
+        again = self.queue.claim('w2', 'host2')
+        self.assertEqual((again['id'], again['stage']), (job['id'], 0))
+
+    def test_results_are_merged_once(self):
+        for i in range(5):
+            self.queue.add_result('run', 'host%s' % (i % 2), {'n': i})
+        results = list(self.queue.unmerged_results(batch_size=2))
+        self.assertEqual([result['payload']['n'] for result in results], range(5))
+        self.queue.mark_merged([result['id'] for result in results[:3]])
+        self.assertEqual([result['payload']['n'] for result in self.queue.unmerged_results()], [3, 4])
+
+    def test_wait_returns_when_everything_is_finished(self):
+        self.enqueue('a', 'b')
+        for slug in ('a', 'b'):
+            job = self.queue.claim('w1', 'host1')
+            self.queue.fail(dict(job, attempts=job['max_attempts']), 'w1', 'boom')
+        self.assertEqual(self.queue.wait(poll_interval=0), {workqueue.FAILED: 2})
+
+
+if __name__ == '__main__':
+    unittest.main()